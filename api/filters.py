@@ -18,6 +18,7 @@ class ExchangeFilter(FilterSet):
             "volume": ["lte", "gte"],
             "interval": ["lte", "gte", "exact"],
             "created": ["lte", "gte"],
+            "priority_tier": ["exact"],
         }
 
 
@@ -38,6 +39,16 @@ class MarketFilter(FilterSet):
         }
 
 
+class MarketChangeFilter(FilterSet):
+    class Meta:
+        model = models.Market
+        fields = {
+            "exchange": ["exact"],
+            "base": ["exact"],
+            "quote": ["exact"],
+        }
+
+
 class ExchangeStatusFilter(FilterSet):
     """Django filters ExchangeStatus filter meta class."""
 
@@ -46,6 +57,7 @@ class ExchangeStatusFilter(FilterSet):
         fields = {
             "exchange": ["exact"],
             "running": ["exact"],
+            "circuit_state": ["exact"],
             "last_run": ["lte", "gte"],
             "time_started": ["lte", "gte"]
         }
@@ -0,0 +1,99 @@
+import statistics
+import time
+from urllib.parse import quote
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.urls import reverse
+from rest_framework.test import APIClient
+
+from api.models import Market
+from marketmanager.pagination import KeysetPagination
+from marketmanager.snapshots import delete_market_snapshot
+from marketmanager.synthetic import seed_markets
+
+
+class Command(BaseCommand):
+    help = "Benchmark the latency of the API endpoints on a seeded data set."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--markets", action="store", dest="markets", type=int, default=500000,
+                            help="Number of markets to seed")
+        parser.add_argument("--exchanges", action="store", dest="exchanges", type=int, default=100,
+                            help="Number of exchanges to seed")
+        parser.add_argument("--repeat", action="store", dest="repeat", type=int, default=10,
+                            help="Number of requests per case")
+        parser.add_argument("--page", action="store", dest="page", type=int, default=2000,
+                            help="The deep page to benchmark")
+
+    def get_cursor(self, position: int) -> str:
+        """Get the cursor pointing right before the row at the position of the volume ordering."""
+        if not position:
+            return ""
+        paginator = KeysetPagination()
+        paginator.ordering = "-volume"
+        markets = Market.objects.filter(active=True, volume__isnull=False)
+        row = markets.order_by("-volume", "-id")[position - 1]
+        return quote(paginator.encode_cursor(row))
+
+    def get_cases(self, options, exchange_id: int) -> dict:
+        """The benchmarked requests - name: (url, cached, extra request headers).
+        The uncached requests are made unique so the response cache stays out of the measurement."""
+        url = reverse("api:market-list")
+        page_size = KeysetPagination.page_size
+        deep = options["page"]
+        max_size = KeysetPagination.max_page_size
+        snapshot = reverse("api:market-snapshot", args=[exchange_id])
+        exchange = f"{url}?exchange={exchange_id}&page_size={max_size}"
+        return {
+            "Markets page 1": (f"{url}?ordering=-volume&page=1", False, {}),
+            f"Markets page {deep}": (f"{url}?ordering=-volume&page={deep}", False, {}),
+            f"Markets page {deep}(exact count)":
+                (f"{url}?ordering=-volume&page={deep}&count=exact", False, {}),
+            "Markets cursor page 1": (f"{url}?ordering=-volume&cursor=", False, {}),
+            f"Markets cursor page {deep}":
+                (f"{url}?ordering=-volume&cursor={self.get_cursor((deep - 1) * page_size)}", False, {}),
+            "Markets page 1(fields=name,last,volume)":
+                (f"{url}?ordering=-volume&page=1&fields=name,last,volume", False, {}),
+            "Markets max page": (f"{url}?ordering=-volume&page_size={max_size}", False, {}),
+            "Markets max page(fields=name,last,volume)":
+                (f"{url}?ordering=-volume&page_size={max_size}&fields=name,last,volume", False, {}),
+            "Exchange markets": (exchange, False, {}),
+            "Exchange markets(cached)": (exchange, True, {}),
+            "Exchange market snapshot": (snapshot, True, {}),
+            "Exchange market snapshot(gzip)": (snapshot, True, {"HTTP_ACCEPT_ENCODING": "gzip"}),
+        }
+
+    def measure(self, client, url: str, cached: bool, headers: dict, repeat: int) -> tuple:
+        """Get the timings and the payload size of the requests."""
+        if cached:
+            # Warm up the cache
+            client.get(url, HTTP_HOST=self.host, secure=True, **headers)
+        timings = []
+        size = 0
+        for i in range(repeat):
+            request_url = url if cached else f"{url}{'&' if '?' in url else '?'}nonce={time.time()}-{i}"
+            start = time.perf_counter()
+            response = client.get(request_url, HTTP_HOST=self.host, secure=True, **headers)
+            timings.append(time.perf_counter() - start)
+            size = len(response.content)
+            if response.status_code != 200:
+                self.stderr.write(f"{url}: {response.status_code} {response.content[:200]}")
+                break
+        return timings, size
+
+    def handle(self, *args, **options):
+        client = APIClient()
+        hosts = [x for x in settings.ALLOWED_HOSTS if x != "*"]
+        self.host = hosts[0].lstrip(".") if hosts else "localhost"
+        with transaction.atomic():
+            self.stdout.write(f"Seeding {options['markets']} markets on {options['exchanges']} exchanges...")
+            exchange_ids = seed_markets(options["markets"], options["exchanges"])
+            for name, (url, cached, headers) in self.get_cases(options, exchange_ids[0]).items():
+                timings, size = self.measure(client, url, cached, headers, options["repeat"])
+                self.stdout.write(f"{name:<45} | median {statistics.median(timings) * 1000:>9.2f} ms | "
+                                  f"max {max(timings) * 1000:>9.2f} ms | "
+                                  f"{len(timings) / sum(timings):>9.1f} rps | {size / 1024:>9.1f} KiB")
+            transaction.set_rollback(True)
+        # The seeded exchanges are rolled back
+        delete_market_snapshot(exchange_ids[0])
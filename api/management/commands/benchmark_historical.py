@@ -0,0 +1,61 @@
+import asyncio
+import statistics
+import time
+import aiohttp
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = ("Load test a historical endpoint at increasing concurrency - run it against the WSGI and the "
+            "ASGI deployment to compare the concurrent historical requests they sustain.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("urls", nargs="+",
+                            help="Base URLs of the deployments(e.g. http://localhost:8000)")
+        parser.add_argument("--path", action="store", dest="path",
+                            default="/historical/markets/?base=BTC&quote=USDT&time_start=-1h",
+                            help="The requested historical endpoint")
+        parser.add_argument("--concurrency", action="store", dest="concurrency", type=int, nargs="+",
+                            default=[1, 10, 50, 100, 200, 500], help="Concurrent clients per level")
+        parser.add_argument("--requests", action="store", dest="requests", type=int, default=5,
+                            help="Sequential requests per client")
+        parser.add_argument("--latency-limit", action="store", dest="latency_limit", type=float, default=2,
+                            help="p95 latency(seconds) a level may have to count as sustained")
+
+    async def client(self, session, url: str, requests: int, results: list):
+        for _ in range(requests):
+            start = time.perf_counter()
+            try:
+                async with session.get(url) as response:
+                    await response.read()
+                    status = response.status
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                status = None
+            results.append((status, time.perf_counter() - start))
+
+    async def run_level(self, url: str, concurrency: int, requests: int) -> tuple:
+        results = []
+        connector = aiohttp.TCPConnector(limit=concurrency)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            start = time.perf_counter()
+            await asyncio.gather(*[self.client(session, url, requests, results) for _ in range(concurrency)])
+        return results, time.perf_counter() - start
+
+    def handle(self, *args, **options):
+        for base_url in options["urls"]:
+            url = base_url.rstrip("/") + options["path"]
+            sustained = 0
+            self.stdout.write(url)
+            for concurrency in options["concurrency"]:
+                results, elapsed = asyncio.run(self.run_level(url, concurrency, options["requests"]))
+                timings = sorted(x[1] for x in results)
+                ok = sum(1 for x in results if x[0] == 200)
+                rejected = sum(1 for x in results if x[0] in (503, 504))
+                p95 = timings[int(len(timings) * 0.95) - 1] if len(timings) > 1 else timings[0]
+                self.stdout.write(f"{concurrency:>6} clients | {ok:>6} ok | {rejected:>6} 503/504 | "
+                                  f"{len(results) - ok - rejected:>6} failed | "
+                                  f"median {statistics.median(timings) * 1000:>9.2f} ms | "
+                                  f"p95 {p95 * 1000:>9.2f} ms | {len(results) / elapsed:>9.1f} rps")
+                if ok == len(results) and p95 <= options["latency_limit"]:
+                    sustained = concurrency
+            self.stdout.write(f"Max sustained concurrency: {sustained}\n")
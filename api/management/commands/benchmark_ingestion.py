@@ -0,0 +1,132 @@
+import json
+import os
+import platform
+import time
+import tracemalloc
+from unittest.mock import patch
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from influxdb_client import Point
+
+from api import utils
+from api.models import Exchange
+from marketmanager.synthetic import generate_tickers
+from marketmanager.updaters import ExchangeUpdater, InfluxUpdater
+from marketmanager.utils import prepare_fiat_data
+
+
+class StubInfluxModel:
+    """Local stand-in for the InfluxDB models - encodes the points to line protocol without sending."""
+    def __init__(self, data):
+        self.data = data
+
+    def save(self):
+        for values in self.data:
+            Point.from_dict({"measurement": "benchmark", "tags": {}, "fields": values}).to_line_protocol()
+
+
+class Command(BaseCommand):
+    help = "Benchmark the ingestion pipeline on synthetic exchanges and compare with the stored baseline."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", action="store", dest="sizes", nargs="+", type=int,
+                            default=[100, 1000, 10000, 50000], help="Number of pairs of the exchanges")
+        parser.add_argument("--baseline", action="store", dest="baseline",
+                            default="benchmarks/ingestion_baseline.json", help="Path to the baseline file")
+        parser.add_argument("--update-baseline", action="store_true", dest="update_baseline",
+                            help="Store the results as the new baseline")
+        parser.add_argument("--tolerance", action="store", dest="tolerance", type=float, default=0.1,
+                            help="Allowed relative increase of the peak memory over the baseline")
+        parser.add_argument("--time-tolerance", action="store", dest="time_tolerance", type=float,
+                            default=None, help="Allowed relative increase of the time over the baseline - "
+                                               "not checked by default as it depends on the machine")
+
+    def measure(self, results: dict, stage: str, method, *args, **kwargs):
+        """Run a stage and record its time, DB queries and peak memory."""
+        tracemalloc.start()
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            output = method(*args, **kwargs)
+            elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[stage] = {"time": round(elapsed, 4), "queries": len(queries), "memory": peak}
+        return output
+
+    def run_size(self, pairs: int) -> dict:
+        results = {}
+        data = generate_tickers(pairs)
+        exchange = Exchange.objects.create(name=f"benchmark-{pairs}", interval=300)
+        market_data = self.measure(results, "parse_market_data", utils.parse_market_data,
+                                   data, exchange.id, consume=True)
+        fiat_data = self.measure(results, "prepare_fiat_data", prepare_fiat_data, market_data)
+        # The prices are the ones from the payload so CoinManager isn't called
+        price_cache = {"base_prices": fiat_data, "fiat_symbol_rates": {}}
+        updater = ExchangeUpdater(exchange.id, dict(market_data), fiat_data, price_cache=price_cache)
+        self.measure(results, "summarize_data", updater.summarize_data)
+        influx_updater = InfluxUpdater(exchange.id, market_data, fiat_data)
+        stub_models = {"pairs": StubInfluxModel, "fiat": StubInfluxModel}
+        with patch.dict("marketmanager.updaters.model_map", stub_models):
+            self.measure(results, "InfluxUpdater", influx_updater.write)
+        updater = ExchangeUpdater(exchange.id, dict(market_data), fiat_data, price_cache=price_cache)
+        self.measure(results, "ExchangeUpdater create", updater.run)
+        for values in market_data.values():
+            values["last"] *= 1.01
+        updater = ExchangeUpdater(exchange.id, dict(market_data), fiat_data, price_cache=price_cache)
+        self.measure(results, "ExchangeUpdater update", updater.run)
+        return results
+
+    def compare(self, results: dict, baseline: dict, tolerance: float, time_tolerance: float = None) -> list:
+        """Get the list of regressions against the baseline - the stages missing from it included.
+        The query counts must not increase at all."""
+        regressions = []
+        for size, stages in results.items():
+            for stage, values in stages.items():
+                expected = baseline.get(size, {}).get(stage)
+                if not expected:
+                    regressions.append(f"{size} pairs - {stage}: missing from the baseline")
+                    continue
+                if values["queries"] > expected["queries"]:
+                    regressions.append(f"{size} pairs - {stage}: {values['queries']} queries, "
+                                       f"baseline {expected['queries']}")
+                limits = {"memory": tolerance}
+                if time_tolerance is not None:
+                    limits["time"] = time_tolerance
+                for key, limit in limits.items():
+                    if values[key] > expected[key] * (1 + limit):
+                        regressions.append(f"{size} pairs - {stage}: {key} {values[key]}, "
+                                           f"baseline {expected[key]}")
+        return regressions
+
+    def handle(self, *args, **options):
+        results = {}
+        # The peak memory depends on the Python version - the baseline is generated in the CI image
+        python = ".".join(platform.python_version_tuple()[:2])
+        # Every run must write all markets and the data must not stay in the DB
+        with override_settings(CHANGE_DETECTION_ENABLED=False), transaction.atomic():
+            for size in options["sizes"]:
+                results[str(size)] = self.run_size(size)
+                for stage, values in results[str(size)].items():
+                    self.stdout.write(f"{size:>6} pairs | {stage:<24} | {values['time']:>8.4f}s | "
+                                      f"{values['queries']:>5} queries | "
+                                      f"{values['memory'] / 1024 / 1024:>8.1f} MiB")
+            transaction.set_rollback(True)
+        if options["update_baseline"]:
+            os.makedirs(os.path.dirname(options["baseline"]) or ".", exist_ok=True)
+            with open(options["baseline"], "w") as f:
+                json.dump({"python": python, "sizes": results}, f, indent=4)
+            return self.stdout.write(self.style.SUCCESS(f"Baseline saved to {options['baseline']}"))
+        if not os.path.exists(options["baseline"]):
+            raise CommandError(f"Baseline {options['baseline']} not found - create it with --update-baseline")
+        with open(options["baseline"]) as f:
+            baseline = json.load(f)
+        if baseline.get("python") != python:
+            raise CommandError(f"The baseline was generated with Python {baseline.get('python')}, running "
+                               f"{python} - generate it in the CI image")
+        regressions = self.compare(results, baseline["sizes"], options["tolerance"],
+                                   options["time_tolerance"])
+        if regressions:
+            raise CommandError("Performance regressions found:\n" + "\n".join(regressions))
+        self.stdout.write(self.style.SUCCESS("No regressions against the baseline."))
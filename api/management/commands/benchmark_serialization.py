@@ -0,0 +1,58 @@
+import statistics
+import time
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from rest_framework.renderers import JSONRenderer
+
+from api import serializers
+from api.models import Exchange, ExchangeStatus, Market
+from marketmanager.encoders import EXCHANGE_ENCODER, EXCHANGE_STATUS_ENCODER, MARKET_ENCODER, render_json
+from marketmanager.synthetic import seed_markets
+
+
+class Command(BaseCommand):
+    help = "Benchmark the serialization of the list pages - the DRF serializers against the row encoders."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", action="store", dest="rows", type=int, default=250,
+                            help="Number of rows per page")
+        parser.add_argument("--repeat", action="store", dest="repeat", type=int, default=50,
+                            help="Number of serialized pages per case")
+
+    def drf(self, queryset, serializer):
+        return JSONRenderer().render(serializer(queryset, many=True).data)
+
+    def fast(self, queryset, encoder):
+        return render_json(encoder.encode(encoder.get_rows(queryset)))
+
+    def measure(self, func, *args, repeat: int) -> list:
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func(*args)
+            timings.append(time.perf_counter() - start)
+        return timings
+
+    def handle(self, *args, **options):
+        rows = options["rows"]
+        with transaction.atomic():
+            exchange_ids = seed_markets(rows, rows)
+            ExchangeStatus.objects.bulk_create([ExchangeStatus(exchange_id=x) for x in exchange_ids])
+            cases = {
+                "Markets": (Market.objects.filter(exchange_id__in=exchange_ids).order_by("id")[:rows],
+                            serializers.MarketSerializer, MARKET_ENCODER),
+                "Exchanges": (Exchange.objects.filter(id__in=exchange_ids).order_by("id")[:rows],
+                              serializers.ExchangeSerializer, EXCHANGE_ENCODER),
+                "Exchange statuses": (ExchangeStatus.objects.filter(exchange_id__in=exchange_ids)
+                                      .order_by("id")[:rows],
+                                      serializers.ExchangeStatusSerializer, EXCHANGE_STATUS_ENCODER),
+            }
+            for name, (queryset, serializer, encoder) in cases.items():
+                if self.drf(queryset, serializer) != self.fast(queryset, encoder):
+                    self.stderr.write(f"{name}: the row encoder output differs from the serializer")
+                repeat = options["repeat"]
+                drf = statistics.median(self.measure(self.drf, queryset, serializer, repeat=repeat))
+                fast = statistics.median(self.measure(self.fast, queryset, encoder, repeat=repeat))
+                self.stdout.write(f"{name:<20} | {rows} rows | DRF {drf * 1000:>8.2f} ms | "
+                                  f"encoder {fast * 1000:>8.2f} ms | {drf / fast:>5.1f}x")
+            transaction.set_rollback(True)
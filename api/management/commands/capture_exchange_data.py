@@ -0,0 +1,50 @@
+import ccxt
+from django.core.management.base import BaseCommand
+
+from api import utils
+from api.models import Exchange
+from marketmanager.replay import RecordingExchange
+
+
+class Command(BaseCommand):
+    help = "Capture the raw ccxt responses of exchanges to fixture files for offline replays."
+
+    def add_arguments(self, parser):
+        group = parser.add_mutually_exclusive_group(required=True)
+        group.add_argument("--name", action="append", dest="names",
+                           help="Name of the exchange(can be repeated)")
+        group.add_argument("--enabled", action="store_true", dest="enabled",
+                           help="Capture all enabled exchanges")
+        parser.add_argument("--output", action="store", dest="output", default="fixtures/exchanges",
+                            help="Directory for the fixture files")
+
+    def capture(self, exchange: Exchange, output: str):
+        recorder = RecordingExchange(getattr(ccxt, exchange.name.lower())(), output)
+        if not exchange.fiat_markets:
+            exchange.fiat_markets = bool(utils.check_fiat_markets(recorder))
+        data = utils.fetch_tickers(recorder, exchange)
+        # Save once more so the fixture has the symbols loaded during the calls
+        recorder.save()
+        return len(data) if isinstance(data, dict) else 0
+
+    def handle(self, *args, **options):
+        if options["enabled"]:
+            exchanges = list(Exchange.objects.filter(enabled=True))
+        else:
+            exchanges = []
+            for name in options["names"]:
+                try:
+                    exchanges.append(Exchange.objects.get(name=name))
+                except Exchange.DoesNotExist:
+                    # The exchange doesn't have to be added to capture its data
+                    exchanges.append(Exchange(name=name, interval=300))
+        for exchange in exchanges:
+            if exchange.name.lower() not in ccxt.exchanges:
+                self.stderr.write(f"Exchange {exchange.name} doesn't exist in CCXT.")
+                continue
+            try:
+                tickers = self.capture(exchange, options["output"])
+            except ccxt.BaseError as e:
+                self.stderr.write(f"Capture of {exchange.name} failed(the error is recorded). {e}")
+                continue
+            self.stdout.write(self.style.SUCCESS(f"Captured {tickers} tickers for {exchange.name}"))
@@ -10,12 +10,16 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument("--json", action="store", dest="json", default="configs/influx_tasks.json",
                             help="Path to JSON file to use for import")
+        parser.add_argument("--names", action="store", dest="names", nargs="+",
+                            help="Create only the tasks with these names(e.g. Rollups15m Rollups1h)")
 
     def handle(self, *args, **options):
         json_file = options["json"]
         with open(json_file, "r") as f:
             json_data = json.load(f)
         for task in json_data:
+            if options["names"] and task["name"] not in options["names"]:
+                continue
             with open(f'flux/{task["flux_filename"]}') as f:
                 flux = f.read()
             task.pop("flux_filename")
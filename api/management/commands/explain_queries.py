@@ -0,0 +1,58 @@
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from api.models import Exchange, Market
+from marketmanager.synthetic import seed_markets
+
+
+class Command(BaseCommand):
+    help = "Run EXPLAIN ANALYZE on the query shapes of the API and the updaters on a seeded data set."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--markets", action="store", dest="markets", type=int, default=1000000,
+                            help="Number of markets to seed")
+        parser.add_argument("--exchanges", action="store", dest="exchanges", type=int, default=100,
+                            help="Number of exchanges to seed")
+        parser.add_argument("--keep", action="store_true", dest="keep",
+                            help="Keep the seeded data(rolled back by default)")
+
+    def get_queries(self, exchange_ids: list) -> dict:
+        """The query shapes of the API views, filters and the updaters."""
+        active = Market.objects.filter(active=True)
+        names = list(Market.objects.filter(exchange_id=exchange_ids[0]).values_list("name", flat=True)[:1000])
+        stale = timezone.now() - timedelta(days=settings.MARKET_STALE_DAYS)
+        return {
+            "Market list by volume": active.order_by("-volume")[:100],
+            "Market list by name": active.order_by("name")[:100],
+            "Market filter exchange": active.filter(exchange_id=exchange_ids[0])[:100],
+            "Market filter base/quote": active.filter(base="C42", quote="BTC")[:100],
+            "Market filter quote": active.filter(quote="ETH")[:100],
+            "Market filter volume range": active.filter(volume__gte=999000, volume__lte=1000000)[:100],
+            "Market filter last range": active.filter(last__gte=99.9, last__lte=100)[:100],
+            "Market filter bid range": active.filter(bid__gte=99.9)[:100],
+            "Market search": active.filter(Q(base__icontains="C4242") | Q(quote__icontains="C4242"))[:100],
+            "Local fiat prices": active.filter(quote__in=settings.FIAT_SYMBOLS).values("base", "last"),
+            "Upsert chunk": Market.objects.filter(exchange_id=exchange_ids[0], name__in=names),
+            "Deactivate missing": Market.objects.filter(exchange_id=exchange_ids[0], active=True).exclude(
+                name__in=names[:-10]).values("id"),
+            "Stale cleanup batch": Market.objects.filter(updated__lte=stale).values_list("id")[
+                :settings.MARKET_DELETE_BATCH_SIZE],
+            "Enabled exchanges": Exchange.objects.filter(enabled=True).select_related("exchangestatus"),
+        }
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            self.stdout.write(f"Seeding {options['markets']} markets on {options['exchanges']} exchanges...")
+            exchange_ids = seed_markets(options["markets"], options["exchanges"])
+            for name, queryset in self.get_queries(exchange_ids).items():
+                plan = queryset.explain(analyze=True, buffers=True)
+                self.stdout.write(self.style.SUCCESS(f"\n{name}"))
+                self.stdout.write(plan)
+                if "Seq Scan on markets" in plan:
+                    self.stdout.write(self.style.WARNING(f"{name}: sequential scan on markets"))
+            if not options["keep"]:
+                transaction.set_rollback(True)
@@ -1,7 +1,9 @@
 from django.core.management.base import BaseCommand
+from django.test import override_settings
 
 from api.tasks import fetch_exchange_data
 from api.models import Exchange
+from marketmanager.utils import get_exchange_queue
 
 
 class Command(BaseCommand):
@@ -11,6 +13,10 @@ class Command(BaseCommand):
         parser.add_argument('id', action="store", type=int)
         parser.add_argument('--celery', action="store_true", dest="celery",
                             help="Send to celery as a task", required=False)
+        parser.add_argument('--replay', action="store", dest="replay", required=False,
+                            help="Replay the ccxt responses from the fixtures in this directory")
+        parser.add_argument('--latency-factor', action="store", dest="latency_factor", type=float,
+                            default=1.0, help="Multiplier of the recorded latency when replaying")
 
     def handle(self, *args, **options):
         # Check if the exchange exists
@@ -20,9 +26,15 @@ class Command(BaseCommand):
             msg = "No exchange with that ID exists."
             return self.stdout.write(self.style.ERROR(msg))
         if options["celery"]:
-            task_id = fetch_exchange_data.delay(exchange.id)
+            task_id = fetch_exchange_data.apply_async(args=[exchange.id],
+                                                      queue=get_exchange_queue(exchange))
             msg = "Running exchange data fetch through celery. "
             msg += "Task ID: {}".format(task_id)
             return self.stdout.write(self.style.SUCCESS(msg))
-        fetch_exchange_data(exchange.id)
+        if options["replay"]:
+            with override_settings(CCXT_REPLAY_DIR=options["replay"],
+                                   CCXT_REPLAY_LATENCY_FACTOR=options["latency_factor"]):
+                fetch_exchange_data(exchange.id)
+        else:
+            fetch_exchange_data(exchange.id)
         return self.style.SUCCESS("Finished running exchange gathering data.")
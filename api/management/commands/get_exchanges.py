@@ -34,6 +34,7 @@ class Command(BaseCommand):
             exchanges = Exchange.objects.filter(enabled=False)
         else:
             exchanges = Exchange.objects.all()
+        exchanges = exchanges.select_related("exchangestatus")
         if options['json']:
             serializer = ExchangeSerializer(exchanges, many=True)
             self.stdout.write(self.style.SUCCESS(json.dumps(serializer.data, indent=4)))
@@ -42,7 +43,7 @@ class Command(BaseCommand):
             msg = f'ID: {exchange.id}, Name: {exchange.name}, Interval: {exchange.interval},\
 Enabled: {exchange.enabled}, Fiat: {exchange.fiat_markets}'
             try:
-                status = ExchangeStatus.objects.get(exchange=exchange)
+                status = exchange.exchangestatus
                 msg += f", Last run: {exchange.updated}, Running: {status.running}"
             except ExchangeStatus.DoesNotExist:
                 pass
@@ -0,0 +1,56 @@
+import resource
+import tracemalloc
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.db import transaction
+
+from api import utils
+from api.models import Exchange
+from marketmanager.replay import ReplayExchange
+from marketmanager.synthetic import generate_tickers
+from marketmanager.updaters import ExchangeUpdater, InfluxUpdater
+from marketmanager.utils import chunked, prepare_fiat_data
+
+
+class Command(BaseCommand):
+    help = "Profile the peak memory of the ingestion pipeline on a synthetic exchange payload."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--pairs", action="store", dest="pairs", type=int, default=20000,
+                            help="Number of pairs in the payload")
+        parser.add_argument("--fixture", action="store", dest="fixture",
+                            help="Use the tickers of a captured fixture file instead of a synthetic payload")
+        parser.add_argument("--db", action="store_true", dest="db",
+                            help="Also upsert the markets(in a transaction which is rolled back)")
+
+    def run_pipeline(self, data, with_db):
+        exchange = Exchange.objects.create(name="profile-ingestion", interval=300)
+        market_data = utils.parse_market_data(data, exchange.id, consume=True)
+        fiat_data = prepare_fiat_data(market_data)
+        influx_updater = InfluxUpdater(exchange.id, market_data, fiat_data)
+        # Encode the points in chunks like the writes do without sending them
+        for _ in chunked(influx_updater.iter_pairs_points(), settings.INFLUX_WRITE_CHUNK_SIZE):
+            pass
+        if with_db:
+            updater = ExchangeUpdater(exchange.id, market_data, fiat_data, price_cache={
+                "base_prices": fiat_data, "fiat_symbol_rates": {}})
+            updater.run()
+        return len(market_data)
+
+    def handle(self, *args, **options):
+        if options["fixture"]:
+            data = ReplayExchange.from_file(options["fixture"], latency_factor=0).fetchTickers()
+        else:
+            data = generate_tickers(options["pairs"])
+        baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        tracemalloc.start()
+        with transaction.atomic():
+            pairs = self.run_pipeline(data, options["db"])
+            transaction.set_rollback(True)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self.stdout.write(f"Pairs: {pairs}")
+        self.stdout.write(f"Peak traced memory of the pipeline: {peak / 1024 / 1024:.1f} MiB")
+        self.stdout.write(f"Peak RSS: {peak_rss / 1024:.1f} MiB"
+                          f" (before the pipeline: {baseline_rss / 1024:.1f} MiB)")
@@ -0,0 +1,18 @@
+# Generated by Django 3.2 on 2026-10-19 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0014_currencyfiatprices'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exchange',
+            name='priority_tier',
+            field=models.CharField(blank=True, choices=[('high', 'High'), ('default', 'Default'), ('low', 'Low')], max_length=16, null=True),
+        ),
+    ]
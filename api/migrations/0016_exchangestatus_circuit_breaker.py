@@ -0,0 +1,28 @@
+# Generated by Django 3.2 on 2026-10-19 10:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0015_exchange_priority_tier'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exchangestatus',
+            name='circuit_state',
+            field=models.CharField(choices=[('closed', 'Closed'), ('open', 'Open'), ('half-open', 'Half open')], default='closed', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='exchangestatus',
+            name='consecutive_failures',
+            field=models.IntegerField(blank=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='exchangestatus',
+            name='retry_after',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
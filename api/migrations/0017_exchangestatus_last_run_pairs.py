@@ -0,0 +1,18 @@
+# Generated by Django 3.2 on 2026-10-19 11:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0016_exchangestatus_circuit_breaker'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exchangestatus',
+            name='last_run_pairs',
+            field=models.IntegerField(null=True),
+        ),
+    ]
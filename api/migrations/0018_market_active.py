@@ -0,0 +1,24 @@
+# Generated by Django 3.2 on 2026-10-19 14:02
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('api', '0017_exchangestatus_last_run_pairs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='market',
+            name='active',
+            field=models.BooleanField(default=True),
+        ),
+        AddIndexConcurrently(
+            model_name='market',
+            index=models.Index(condition=models.Q(('active', True)), fields=['exchange'], name='markets_active_idx'),
+        ),
+    ]
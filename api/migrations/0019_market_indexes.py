@@ -0,0 +1,49 @@
+# Generated by Django 3.2 on 2026-10-19 15:10
+
+from django.contrib.postgres.operations import AddIndexConcurrently, TrigramExtension
+from django.db import migrations, models
+
+TRIGRAM_INDEXES = (
+    ("markets_base_trgm_idx", "base"),
+    ("markets_quote_trgm_idx", "quote"),
+)
+
+
+class Migration(migrations.Migration):
+    # The indexes are built concurrently so the ingestion isn't blocked on the markets table
+    atomic = False
+
+    dependencies = [
+        ('api', '0018_market_active'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        AddIndexConcurrently(
+            model_name='market',
+            index=models.Index(condition=models.Q(('active', True)), fields=['quote'], name='markets_active_quote_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='market',
+            index=models.Index(condition=models.Q(('active', True)), fields=['base', 'quote'], name='markets_active_base_quote_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='market',
+            index=models.Index(condition=models.Q(('active', True)), fields=['volume'], name='markets_active_volume_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='market',
+            index=models.Index(fields=['updated'], name='markets_updated_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='exchange',
+            index=models.Index(condition=models.Q(('enabled', True)), fields=['name'], name='exchanges_enabled_idx'),
+        ),
+    ] + [
+        # icontains is UPPER(column) LIKE UPPER(pattern) in PostgreSQL
+        migrations.RunSQL(
+            f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON markets USING gin (UPPER({column}) gin_trgm_ops)",
+            f"DROP INDEX CONCURRENTLY IF EXISTS {name}",
+        )
+        for name, column in TRIGRAM_INDEXES
+    ]
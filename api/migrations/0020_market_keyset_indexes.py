@@ -0,0 +1,27 @@
+# Generated by Django 3.2 on 2026-10-19 16:05
+
+from django.contrib.postgres.operations import AddIndexConcurrently, RemoveIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('api', '0019_market_indexes'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='market',
+            index=models.Index(condition=models.Q(('active', True)), fields=['volume', 'id'], name='markets_active_volume_id_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='market',
+            index=models.Index(condition=models.Q(('active', True)), fields=['name', 'id'], name='markets_active_name_id_idx'),
+        ),
+        RemoveIndexConcurrently(
+            model_name='market',
+            name='markets_active_volume_idx',
+        ),
+    ]
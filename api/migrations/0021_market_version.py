@@ -0,0 +1,33 @@
+# Generated by Django 3.2 on 2026-10-19 18:20
+
+from django.db import migrations, models
+
+VERSION_TRIGGER_SQL = """
+CREATE FUNCTION markets_set_version() RETURNS trigger AS $$
+BEGIN
+    NEW.version := txid_current();
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER markets_version BEFORE INSERT OR UPDATE ON markets
+    FOR EACH ROW EXECUTE PROCEDURE markets_set_version();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0020_market_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='market',
+            name='version',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.RunSQL(
+            VERSION_TRIGGER_SQL,
+            "DROP TRIGGER IF EXISTS markets_version ON markets; DROP FUNCTION IF EXISTS markets_set_version();",
+        ),
+    ]
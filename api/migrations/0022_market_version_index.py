@@ -0,0 +1,19 @@
+# Generated by Django 3.2 on 2026-10-19 18:21
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('api', '0021_market_version'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='market',
+            index=models.Index(fields=['version', 'id'], name='markets_version_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.2 on 2026-10-19 21:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0022_market_version_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exchangestatus',
+            name='batch_size',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='exchangestatus',
+            name='batch_started',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
@@ -6,6 +6,11 @@ from django_influxdb.models import InfluxModel
 
 class Exchange(models.Model):
     """Exchange model - summary and info on different crypto exchanges."""
+    PRIORITY_TIERS = (
+        ("high", "High"),
+        ("default", "Default"),
+        ("low", "Low"),
+    )
     name = models.CharField(max_length=64, unique=True)
     logo = models.CharField(max_length=256, null=True)
     url = models.URLField(max_length=128, null=True)
@@ -20,6 +25,8 @@ class Exchange(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
     interval = models.IntegerField()
+    # Manual override of the fetch priority tier - derived from the volume when not set
+    priority_tier = models.CharField(max_length=16, choices=PRIORITY_TIERS, null=True, blank=True)
 
     def __str__(self):
         """Return a human readable representation of the model instance."""
@@ -30,6 +37,9 @@ class Exchange(models.Model):
     class Meta():
         """Define the db table name."""
         db_table = "exchanges"
+        indexes = [
+            models.Index(fields=["name"], condition=models.Q(enabled=True), name="exchanges_enabled_idx"),
+        ]
 
 
 class Market(models.Model):
@@ -47,6 +57,11 @@ class Market(models.Model):
     high = models.FloatField(default=0)
     low = models.FloatField(default=0)
     updated = models.DateTimeField(auto_now=True)
+    # Markets missing from the latest exchange run(delisted) are inactive until they reappear
+    active = models.BooleanField(default=True)
+    # Id of the transaction which wrote the market last - set by a trigger(migration 0021) on each
+    # write, it orders the change feed
+    version = models.BigIntegerField(default=0, editable=False)
 
     def __str__(self):
         """Return a human readable representation of the model instance."""
@@ -57,6 +72,21 @@ class Market(models.Model):
     class Meta:
         db_table = "markets"
         unique_together = (('name', 'exchange'))
+        # The base/quote icontains search uses the trigram indexes on UPPER(base) and UPPER(quote)
+        # created in migration 0019 - expression indexes with an operator class aren't supported here
+        indexes = [
+            models.Index(fields=["exchange"], condition=models.Q(active=True), name="markets_active_idx"),
+            models.Index(fields=["quote"], condition=models.Q(active=True), name="markets_active_quote_idx"),
+            models.Index(fields=["base", "quote"], condition=models.Q(active=True),
+                         name="markets_active_base_quote_idx"),
+            # The (field, id) indexes serve the ordering and the keyset pagination
+            models.Index(fields=["volume", "id"], condition=models.Q(active=True),
+                         name="markets_active_volume_id_idx"),
+            models.Index(fields=["name", "id"], condition=models.Q(active=True),
+                         name="markets_active_name_id_idx"),
+            models.Index(fields=["updated"], name="markets_updated_idx"),
+            models.Index(fields=["version", "id"], name="markets_version_idx"),
+        ]
 
 
 class CurrencyFiatPrices(models.Model):
@@ -72,6 +102,11 @@ class CurrencyFiatPrices(models.Model):
 
 class ExchangeStatus(models.Model):
     """Exchange status model - current status of the exchange data gather."""
+    CIRCUIT_STATES = (
+        ("closed", "Closed"),
+        ("open", "Open"),
+        ("half-open", "Half open"),
+    )
 
     exchange = models.OneToOneField(Exchange, on_delete=models.CASCADE)
     last_run = models.DateTimeField(null=True)
@@ -81,6 +116,15 @@ class ExchangeStatus(models.Model):
     running = models.BooleanField(blank=True, default=False)
     timeout = models.IntegerField(blank=True,
                                   default=settings.EXCHANGE_TIMEOUT)
+    # Circuit breaker fed by the run outcomes
+    consecutive_failures = models.IntegerField(blank=True, default=0)
+    circuit_state = models.CharField(max_length=16, choices=CIRCUIT_STATES, default="closed")
+    retry_after = models.DateTimeField(null=True)
+    # Number of market pairs fetched in the last successful run
+    last_run_pairs = models.IntegerField(null=True)
+    # Size and scheduling time of the batch task of the run(null for single exchange runs)
+    batch_size = models.IntegerField(null=True)
+    batch_started = models.DateTimeField(null=True)
 
     def __str__(self):
         """Return a human readable representation of the model instance."""
@@ -14,7 +14,7 @@ class ExchangeSerializer(serializers.ModelSerializer):
         model = models.Exchange
         fields = ('id', 'name', 'created', 'updated', "url", "api_url",
                   "volume", "top_pair", "top_pair_volume", "interval",
-                  "enabled", "last_data_fetch", "logo")
+                  "enabled", "last_data_fetch", "logo", "priority_tier")
         read_only_fields = ('created', 'updated')
 
     def get_type(self, obj):
@@ -37,7 +37,8 @@ class ExchangeStatusSerializer(serializers.ModelSerializer):
 
         model = models.ExchangeStatus
         fields = ('id', 'exchange', 'last_run', 'last_run_id',
-                  'last_run_status', 'time_started', 'running')
+                  'last_run_status', 'time_started', 'running',
+                  'consecutive_failures', 'circuit_state', 'retry_after')
 
 
 class TaskResultSerializer(serializers.ModelSerializer):
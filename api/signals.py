@@ -0,0 +1,23 @@
+"""Invalidate the cached API responses on exchange changes outside of the exchange runs.
+The markets aren't connected - receivers would stop their bulk deletes from being fast deletes."""
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from api.models import Exchange
+from marketmanager.cache import bump_versions
+from marketmanager.snapshots import delete_market_snapshot
+
+
+@receiver(post_save, sender=Exchange)
+def exchange_saved(sender, instance, **kwargs):
+    transaction.on_commit(lambda: bump_versions("exchanges"))
+
+
+@receiver(post_delete, sender=Exchange)
+def exchange_deleted(sender, instance, **kwargs):
+    # The markets of the exchange are deleted with it
+    def invalidate():
+        bump_versions("exchanges", "markets", f"markets:{instance.id}")
+        delete_market_snapshot(instance.id)
+    transaction.on_commit(invalidate)
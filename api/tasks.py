@@ -1,19 +1,23 @@
 import ccxt
 import logging
 import traceback
-from copy import deepcopy
+from datetime import timedelta
 from django.db.utils import OperationalError
 from django_celery_results.models import TaskResult
-from django.db import transaction
 from django.utils import timezone
 from django.conf import settings
 from celery import Task
 
-from marketmanager.updaters import ExchangeUpdater, InfluxUpdater
+from marketmanager.updaters import ExchangeUpdater, InfluxUpdater, write_points
+from marketmanager.fingerprints import MarketFingerprints
+from marketmanager.replay import get_ccxt_exchange
+from marketmanager.cache import bump_versions
+from marketmanager.querylog import profile_queries
+from marketmanager.runcontext import ExchangeRunContext
 from marketmanager.celery import app
 from api.models import Exchange, Market
 from api import utils
-from marketmanager.utils import set_running_status, prepare_fiat_data
+from marketmanager.utils import set_running_status, finish_run, prepare_fiat_data
 
 
 class LogErrorsTask(Task):
@@ -25,14 +29,106 @@ class LogErrorsTask(Task):
         super(LogErrorsTask, self).on_failure(exc, task_id, args, kwargs, einfo)
 
 
-@app.task(bind=True, base=LogErrorsTask)
+def fetch_market_data(run: ExchangeRunContext, logger: logging.LoggerAdapter):
+    """Fetch and parse the market data of the exchange via ccxt.
+    Failures are fed to the exchange circuit breaker - ccxt errors are re-raised and None is
+    returned if the exchange didn't return any data.
+    """
+    exchange = run.exchange
+    set_running_status(run, running=True)
+    try:
+        # Init the exchange from the ccxt module(or a fixture replay)
+        ccxt_exchange = get_ccxt_exchange(exchange.name)
+        # Check if the exchange has new fiat markets and is not flagged
+        if not exchange.fiat_markets:
+            if utils.check_fiat_markets(ccxt_exchange):
+                exchange.fiat_markets = True
+        # Get the data
+        logger.info("Fetching tickers.")
+        data = utils.fetch_tickers(ccxt_exchange, exchange)
+    except ccxt.BaseError as e:
+        msg = "Fetching exchange data failed. Exception: {}".format(e)
+        logger.error(msg)
+        finish_run(run, success=False, message=msg)
+        raise
+    if not data or isinstance(data, str):
+        msg = "No data fetched from the exchange. {}".format(data or "")
+        logger.error(msg)
+        finish_run(run, success=False, message=msg)
+        return None
+    # Lazy formatting - the raw payload must not be turned into a string unless debugging
+    logger.debug("Raw data: %s", data)
+    # Parse the data - the raw entries are dropped while parsing to bound the memory
+    logger.info("Parsing the data.")
+    return utils.parse_market_data(data, exchange.id, consume=True)
+
+
+def update_market_data(run: ExchangeRunContext, market_data: dict, logger: logging.LoggerAdapter,
+                       task_id: str = None, price_cache: dict = None, influx_points: dict = None,
+                       pending_runs: list = None):
+    """Run the updaters on the parsed market data and finish the exchange run.
+    If influx_points is passed the InfluxDB points are collected in it instead of written and the
+    run is added to pending_runs - it's finished and its market fingerprints are saved once the
+    points are written.
+    """
+    logger.info("Starting updaters.")
+    exchange = run.exchange
+    result = None
+    pairs = len(market_data)
+    fiat_data = prepare_fiat_data(market_data)
+    fingerprints = MarketFingerprints(exchange.id)
+    changed = fingerprints.detect(market_data) if fingerprints.enabled else None
+    failed = []
+    try:
+        influx_updater = InfluxUpdater(exchange.id, market_data, fiat_data, task_id, changed)
+        if influx_points is None:
+            influx_updater.write()
+        else:
+            for model, points in influx_updater.get_points().items():
+                influx_points.setdefault(model, []).extend(points)
+    except Exception as e:
+        traceback.print_exc()
+        logger.critical("Influx updater failed. Exception: {}".format(e))
+        failed.append(f"InfluxDB: {e}")
+    try:
+        updater = ExchangeUpdater(exchange.id, market_data, fiat_data, task_id, price_cache=price_cache,
+                                  changed=changed, run_context=run)
+        result = updater.run()
+    except Exception as e:
+        traceback.print_exc()
+        logger.critical("DB updater failed. Exception: {}".format(e))
+        failed.append(f"DB: {e}")
+    written = not failed
+    if changed is not None:
+        msg = f"Changed markets: {len(changed)}/{pairs}. Write reduction: {fingerprints.reduction:.1%}"
+        logger.info(msg)
+        if written and pending_runs is None:
+            # A failed write must be retried in the next run
+            fingerprints.save()
+        if result:
+            result = f"{result}. {msg}"
+    if not written:
+        # The failed writes count against the circuit breaker
+        result = f"Failed to write the market data. {'. '.join(failed)}"
+    if pending_runs is not None:
+        pending_runs.append((run, written, result, pairs, fingerprints))
+        return result
+    finish_run(run, success=written, message=result, pairs=pairs)
+    return result
+
+
+# The outcome of every run is kept in the ExchangeStatus so the results of the successful runs
+# can be skipped - failures are always stored
+@app.task(bind=True, base=LogErrorsTask, ignore_result=not settings.TASK_RESULT_STORE_SUCCESS,
+          store_errors_even_if_ignored=True)
 def fetch_exchange_data(self, exchange_id: int):
     """Task to fetch and update exchange data via ccxt."""
     logger = logging.getLogger("marketmanager-celery")
     extra = {"task_id": self.request.id, "exchange": None}
     logger = logging.LoggerAdapter(logger, extra)
     try:
-        exchange = Exchange.objects.get(id=exchange_id)
+        run = ExchangeRunContext.load(exchange_id)
+        exchange = run.exchange
         logger.info("Got exchange {}".format(exchange))
         extra['exchange'] = exchange
         logger = logging.LoggerAdapter(logger, extra)
@@ -44,56 +140,126 @@ def fetch_exchange_data(self, exchange_id: int):
         msg = "Exchange doesn't exist in CCXT."
         logger.error(msg)
         raise ValueError(msg)
-    set_running_status(exchange, running=True)
-    # Init the exchange from the ccxt module
-    ccxt_exchange = getattr(ccxt, exchange.name.lower())()
-    # Check if the exchange has new fiat markets and is not flagged
-    if not exchange.fiat_markets:
-        if utils.check_fiat_markets(ccxt_exchange):
-            exchange.fiat_markets = True
-            exchange.save()
-    # Get the data
-    logger.info("Fetching tickers.")
-    data = utils.fetch_tickers(ccxt_exchange, exchange)
-    logger.debug("Raw data: {}".format(data))
-    # Parse the data
-    logger.info("Parsing the data.")
-    market_data = utils.parse_market_data(data, exchange_id)
-    # Create/update the data
-    logger.info("Starting updaters.")
-    result = None
-    fiat_data = prepare_fiat_data(market_data)
+    with profile_queries(f"exchange_run {exchange.name}", "exchange_run"):
+        market_data = fetch_market_data(run, logger)
+        if market_data is None:
+            return "No data fetched from the exchange."
+        return update_market_data(run, market_data, logger, self.request.id)
+
+
+@app.task(bind=True, base=LogErrorsTask, ignore_result=not settings.TASK_RESULT_STORE_SUCCESS,
+          store_errors_even_if_ignored=True)
+def fetch_exchanges_batch(self, exchange_ids: list):
+    """Task to fetch and update the data of several small exchanges in a single run.
+    The CoinManager price lookups and the InfluxDB writes are shared by the exchanges while
+    errors stay isolated - a failing exchange doesn't affect the rest of the batch.
+    """
+    base_logger = logging.getLogger("marketmanager-celery")
+    logger = logging.LoggerAdapter(base_logger, {"task_id": self.request.id, "exchange": None})
     try:
-        influx_data = deepcopy(market_data)
-        influx_updater = InfluxUpdater(exchange_id, influx_data, fiat_data, self.request.id)
-        influx_updater.write()
-    except Exception as e:
-        traceback.print_exc()
-        logger.critical("Influx updater failed. Exception: {}".format(e))
+        runs = ExchangeRunContext.load_many(exchange_ids)
+    except OperationalError as e:
+        msg = "DB operational error. Error: {}".format(e)
+        logger.error(msg)
+        return msg
+    price_cache = {}
+    influx_points = {}
+    pending_runs = []
+    results = {}
+    for run in runs:
+        exchange = run.exchange
+        exchange_logger = logging.LoggerAdapter(base_logger, {"task_id": self.request.id,
+                                                              "exchange": exchange})
+        if exchange.name.lower() not in ccxt.exchanges:
+            msg = "Exchange doesn't exist in CCXT."
+            exchange_logger.error(msg)
+            finish_run(run, success=False, message=msg)
+            results[exchange.id] = msg
+            continue
+        try:
+            with profile_queries(f"exchange_run {exchange.name}", "exchange_run"):
+                # Sets the start time of the exchange - the poller times it out on its own
+                market_data = fetch_market_data(run, exchange_logger)
+                if market_data is None:
+                    results[exchange.id] = "No data fetched from the exchange."
+                    continue
+                results[exchange.id] = update_market_data(run, market_data, exchange_logger,
+                                                          self.request.id, price_cache, influx_points,
+                                                          pending_runs)
+        except Exception as e:
+            msg = "Exchange run failed. Exception: {}".format(e)
+            exchange_logger.error(msg)
+            if not isinstance(e, ccxt.BaseError):
+                finish_run(run, success=False, message=msg)
+            results[exchange.id] = msg
+    failure = None
     try:
-        updater = ExchangeUpdater(exchange_id, market_data, fiat_data, self.request.id)
-        result = updater.run()
+        write_points(influx_points)
     except Exception as e:
         traceback.print_exc()
-        logger.critical("DB updater failed. Exception: {}".format(e))
-    set_running_status(exchange, running=False)
-    return result
+        logger.critical("Influx batch write failed. Exception: {}".format(e))
+        failure = f"Failed to write the market data. InfluxDB: {e}"
+    # The runs are finished only once their points are written - a failed write fails all of them
+    for run, written, result, pairs, fingerprints in pending_runs:
+        if written and failure:
+            written = False
+            result = results[run.exchange.id] = failure
+        elif written:
+            fingerprints.save()
+        finish_run(run, success=written, message=result, pairs=pairs)
+    return results
 
 
 @app.task
 def clear_task_results():
-    """Aggregate and clear all task results from the DB."""
-    tasks = TaskResult.objects.all()
-    with transaction.atomic():
-        for task in tasks:
-            task.delete()
-    return "Clearing success"
+    """Clear the task results older than TASK_RESULT_RETENTION_DAYS.
+    The results are deleted in batches of TASK_RESULT_DELETE_BATCH_SIZE so the transactions are short."""
+    logger = logging.getLogger("marketmanager-celery")
+    d = timezone.now() - timedelta(days=settings.TASK_RESULT_RETENTION_DAYS)
+    results = TaskResult.objects.filter(date_done__lt=d).order_by("date_done")
+    deleted = 0
+    while True:
+        ids = list(results.values_list("id", flat=True)[:settings.TASK_RESULT_DELETE_BATCH_SIZE])
+        if not ids:
+            break
+        deleted += TaskResult.objects.filter(id__in=ids).delete()[0]
+        logger.info(f"Deleted {deleted} task results so far")
+    return "Cleared {} task results".format(deleted)
 
 
 @app.task
 def clear_stale_markets():
-    """ Clear markets that haven't been updated in the configured period"""
-    d = timezone.now() - timezone.delta(days=settings.MARKET_STALE_DAYS)
+    """Delete markets that haven't been seen in the configured period.
+    Only inactive markets are deleted - the stale markets which are still active(their exchange
+    stopped running) are deactivated first, which puts them in the change feed, and are deleted once
+    they stay inactive for the period. The markets are handled in batches of MARKET_DELETE_BATCH_SIZE
+    so the locks are short."""
+    logger = logging.getLogger("marketmanager-celery")
+    d = timezone.now() - timedelta(days=settings.MARKET_STALE_DAYS)
     markets = Market.objects.filter(updated__lte=d)
-    markets.delete()
-    return "Cleared {} stale markets".format(len(markets))
+    deleted = 0
+    deactivated = 0
+    exchanges = set()
+    while True:
+        rows = list(markets.filter(active=False).values_list("id", "exchange_id")[
+            :settings.MARKET_DELETE_BATCH_SIZE])
+        if not rows:
+            break
+        exchanges.update(x[1] for x in rows)
+        deleted += Market.objects.filter(id__in=[x[0] for x in rows]).delete()[0]
+        logger.info(f"Deleted {deleted} stale markets so far")
+    while True:
+        rows = list(markets.filter(active=True).values_list("id", "exchange_id")[
+            :settings.MARKET_DELETE_BATCH_SIZE])
+        if not rows:
+            break
+        exchanges.update(x[1] for x in rows)
+        # Touches the updated timestamp so the feed clients syncing with ?since= get the deactivation
+        deactivated += Market.objects.filter(id__in=[x[0] for x in rows]).update(
+            active=False, updated=timezone.now())
+        logger.info(f"Deactivated {deactivated} stale markets so far")
+    if deleted or deactivated:
+        # Outdates the cached responses, the market snapshots and the Last-Modified of the exchanges
+        Exchange.objects.filter(id__in=exchanges).update(updated=timezone.now())
+        bump_versions("markets", *(f"markets:{x}" for x in exchanges))
+    return "Cleared {} stale markets, deactivated {}".format(deleted, deactivated)
@@ -1,10 +1,24 @@
 """Tests for the marketmanager API."""
-from django.test import TestCase
+import logging
+from datetime import timedelta
+from unittest.mock import patch
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from rest_framework.test import APIClient
 from rest_framework import status
 from django.urls import reverse
+from django.utils import timezone
+from django_celery_results.models import TaskResult
 
 from api import models
+from api import tasks
+from api.utils import parse_market_data
+from marketmanager.pagination import encode_cursor
+from marketmanager.runcontext import ExchangeRunContext
+from marketmanager.synthetic import generate_tickers
 
 
 def check_response_items(request, response, test_object):
@@ -106,6 +120,12 @@ class MarketsTest(TestCase):
         resp = self.client.get("/markets/?volume__lte=5000")
         self.assertEqual(resp.json()["results"][0]["name"], new_market["name"])
 
+    def testInactiveFiltered(self):
+        """Delisted markets must not be served."""
+        models.Market.objects.filter(id=self.get_id).update(active=False)
+        resp = self.client.get(reverse("api:market-list"))
+        self.assertEqual(resp.json()["count"], 0)
+
     def testUnallowedMethods(self):
         """Test the unallowed methods - DELETE, POST, PUT, PATCH."""
         # POST
@@ -134,3 +154,288 @@ class ExchangeStatusTest(TestCase):
     def testGetList(self):
         """Test getting the list of exchanges."""
         self.assertEqual(self.get.status_code, status.HTTP_200_OK)
+
+
+class FetchExchangesBatchTest(TestCase):
+    def setUp(self):
+        self.exchanges = [models.Exchange.objects.create(name=name, interval=300)
+                          for name in ("Binance", "Bittrex")]
+        self.ids = [x.id for x in self.exchanges]
+
+    @patch("api.tasks.write_points")
+    @patch("api.tasks.update_market_data")
+    @patch("api.tasks.fetch_market_data")
+    def testErrorIsolation(self, mock_fetch, mock_update, mock_write):
+        """A failing exchange must not stop the rest of the batch."""
+        def fetch(run, logger):
+            if run.exchange.name == "Binance":
+                raise RuntimeError("Exchange is down")
+            return {"ETH-BTC": {}}
+        mock_fetch.side_effect = fetch
+        mock_update.return_value = "Updater finished successfully"
+        results = tasks.fetch_exchanges_batch(self.ids)
+        self.assertIn("Exchange is down", results[self.ids[0]])
+        self.assertEqual(results[self.ids[1]], mock_update.return_value)
+        status = models.ExchangeStatus.objects.get(exchange_id=self.ids[0])
+        self.assertEqual(status.consecutive_failures, 1)
+        self.assertFalse(status.running)
+        mock_write.assert_called_once()
+
+    @patch("api.tasks.write_points", side_effect=RuntimeError("InfluxDB is down"))
+    @patch("api.tasks.prepare_fiat_data", return_value={})
+    @patch("api.tasks.ExchangeUpdater.run", return_value="Updater finished successfully")
+    @patch("api.tasks.fetch_market_data")
+    def testFailedWrite(self, mock_fetch, mock_run, mock_fiat, mock_write):
+        """A failed batch write must finish all the exchanges of the batch as failures."""
+        mock_fetch.side_effect = lambda run, logger: parse_market_data(generate_tickers(5), run.exchange.id)
+        results = tasks.fetch_exchanges_batch(self.ids)
+        for exchange_id in self.ids:
+            self.assertIn("InfluxDB is down", results[exchange_id])
+            status = models.ExchangeStatus.objects.get(exchange_id=exchange_id)
+            self.assertEqual(status.consecutive_failures, 1)
+            self.assertFalse(status.running)
+            self.assertIn("InfluxDB is down", status.last_run_status)
+
+
+class UpdateMarketDataTest(TestCase):
+    def setUp(self):
+        self.exchange = models.Exchange.objects.create(name="Binance", interval=300)
+        models.ExchangeStatus.objects.create(exchange=self.exchange)
+        self.market_data = parse_market_data(generate_tickers(5), self.exchange.id)
+        self.logger = logging.LoggerAdapter(logging.getLogger("marketmanager-celery"), {})
+
+    @patch("api.tasks.prepare_fiat_data", return_value={})
+    @patch("api.tasks.ExchangeUpdater.run", side_effect=RuntimeError("DB is down"))
+    @patch("api.tasks.InfluxUpdater.write", side_effect=RuntimeError("InfluxDB is down"))
+    def testFailedWrites(self, mock_write, mock_run, mock_fiat):
+        """A run which couldn't write its data must be finished as a failure."""
+        result = tasks.update_market_data(ExchangeRunContext.load(self.exchange.id), self.market_data,
+                                          self.logger)
+        status = models.ExchangeStatus.objects.get(exchange=self.exchange)
+        self.assertEqual(status.consecutive_failures, 1)
+        self.assertFalse(status.running)
+        self.assertIn("InfluxDB is down", status.last_run_status)
+        self.assertIn("DB is down", result)
+
+
+class QueryBudgetTest(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.exchange = models.Exchange.objects.create(name="Bittrex", interval=300)
+
+    def create_markets(self, start, count):
+        models.Market.objects.bulk_create([
+            models.Market(name=f"C{i}-BTC", base=f"C{i}", quote="BTC", exchange=self.exchange,
+                          volume=i, last=1, bid=1, ask=1)
+            for i in range(start, start + count)])
+
+    def count_list_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("api:market-list"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return len(queries)
+
+    def testMarketListQueries(self):
+        """Listing markets must run a constant number of queries per page."""
+        self.create_markets(0, 5)
+        small = self.count_list_queries()
+        self.create_markets(5, 200)
+        self.assertEqual(self.count_list_queries(), small)
+        self.assertLessEqual(small, settings.QUERY_BUDGETS["api:market-list"])
+
+    @override_settings(QUERY_PROFILING=True)
+    def testQueryProfile(self):
+        self.client.get(reverse("api:market-list"))
+        response = self.client.get(reverse("api:query_profile-list"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        operations = [x["operation"] for x in response.json()]
+        self.assertIn("GET " + reverse("api:market-list"), operations)
+
+    def testQueryProfileDisabled(self):
+        response = self.client.get(reverse("api:query_profile-list"))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class ClearStaleMarketsTest(TestCase):
+    @override_settings(MARKET_DELETE_BATCH_SIZE=2)
+    def testClearStaleMarkets(self):
+        """Markets not seen for MARKET_STALE_DAYS must be deactivated and deleted once they stay inactive
+        for MARKET_STALE_DAYS across several batches."""
+        exchange = models.Exchange.objects.create(name="Bittrex", interval=300)
+        models.Market.objects.bulk_create([
+            models.Market(name=f"C{i}-BTC", base=f"C{i}", quote="BTC", exchange=exchange,
+                          last=1, bid=1, ask=1)
+            for i in range(6)])
+        stale = timezone.now() - timedelta(days=settings.MARKET_STALE_DAYS + 1)
+        models.Market.objects.exclude(name="C0-BTC").update(updated=stale)
+        self.assertEqual(tasks.clear_stale_markets(), "Cleared 0 stale markets, deactivated 5")
+        self.assertEqual(list(models.Market.objects.filter(active=True).values_list("name", flat=True)),
+                         ["C0-BTC"])
+        # Deleted only once they stay inactive for MARKET_STALE_DAYS
+        self.assertEqual(tasks.clear_stale_markets(), "Cleared 0 stale markets, deactivated 0")
+        models.Market.objects.filter(active=False).update(updated=stale)
+        self.assertEqual(tasks.clear_stale_markets(), "Cleared 5 stale markets, deactivated 0")
+        self.assertEqual(list(models.Market.objects.values_list("name", flat=True)), ["C0-BTC"])
+
+    @override_settings(CHANGE_DETECTION_ENABLED=True)
+    @patch("api.tasks.prepare_fiat_data", return_value={"BTC": 50000, "ETH": 3000})
+    @patch("api.tasks.InfluxUpdater.write")
+    def testChangeDetection(self, mock_write, mock_fiat):
+        """Markets which didn't change must still be written within the heartbeat so they aren't
+        cleaned up as stale."""
+        exchange = models.Exchange.objects.create(name="Bittrex", interval=300)
+        models.ExchangeStatus.objects.create(exchange=exchange)
+        logger = logging.LoggerAdapter(logging.getLogger("marketmanager-celery"), {})
+        price_cache = {"base_prices": {"BTC": 50000, "ETH": 3000}, "fiat_symbol_rates": {}}
+        market_data = generate_tickers(5)
+
+        def run():
+            tasks.update_market_data(ExchangeRunContext.load(exchange.id),
+                                     parse_market_data(market_data, exchange.id), logger,
+                                     price_cache=price_cache)
+        run()
+        # The markets haven't changed since they were written MARKET_STALE_DAYS ago
+        stale = timezone.now() - timedelta(days=settings.MARKET_STALE_DAYS + 1)
+        models.Market.objects.update(updated=stale)
+        key = f"fingerprints:{exchange.id}"
+        cache.set(key, {name: (x[0], stale.timestamp()) for name, x in cache.get(key).items()}, None)
+        run()
+        self.assertEqual(tasks.clear_stale_markets(), "Cleared 0 stale markets, deactivated 0")
+        self.assertEqual(models.Market.objects.filter(active=True).count(), 5)
+
+
+class ClearTaskResultsTest(TestCase):
+    @override_settings(TASK_RESULT_DELETE_BATCH_SIZE=2)
+    def testClearTaskResults(self):
+        """Only the results older than the retention must be deleted."""
+        TaskResult.objects.bulk_create([TaskResult(task_id=str(i)) for i in range(5)])
+        old = timezone.now() - timedelta(days=settings.TASK_RESULT_RETENTION_DAYS + 1)
+        TaskResult.objects.exclude(task_id="0").update(date_done=old)
+        self.assertEqual(tasks.clear_task_results(), "Cleared 4 task results")
+        self.assertEqual(list(TaskResult.objects.values_list("task_id", flat=True)), ["0"])
+
+
+class KeysetPaginationTest(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        exchange = models.Exchange.objects.create(name="Bittrex", interval=300)
+        volumes = [5, 1, 3, 3, 8, 3, None]
+        models.Market.objects.bulk_create([
+            models.Market(name=f"C{i}-BTC", base=f"C{i}", quote="BTC", exchange=exchange,
+                          volume=volume, last=1, bid=1, ask=1)
+            for i, volume in enumerate(volumes)])
+
+    def testCursorPages(self):
+        """Following the next links must return every market with a volume once and in order."""
+        url = reverse("api:market-list") + "?ordering=-volume&page_size=2&cursor="
+        names = []
+        while url:
+            response = self.client.get(url).json()
+            self.assertNotIn("count", response)
+            names += [x["name"] for x in response["results"]]
+            url = response["next"]
+        expected = models.Market.objects.filter(volume__isnull=False).order_by("-volume", "-id")
+        self.assertEqual(names, [x.name for x in expected])
+
+    def testCursorByName(self):
+        url = reverse("api:market-list") + "?ordering=name&page_size=4&cursor="
+        first = self.client.get(url).json()
+        second = self.client.get(first["next"]).json()
+        names = [x["name"] for x in first["results"] + second["results"]]
+        self.assertEqual(names, sorted(names))
+        self.assertEqual(len(names), 7)
+
+    def testInvalidCursor(self):
+        response = self.client.get(reverse("api:market-list") + "?cursor=invalid")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(reverse("api:market-list") + "?cursor=&ordering=bid")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def testMalformedCursor(self):
+        """Cursors which decode to anything but a [value, id] pair of the ordering types must get a 400."""
+        positions = [{"volume": 1, "id": 2}, [1], [1, 2, 3], [{"a": 1}, 2], [[1], 2], [1, "2"], [1, 2.5],
+                     [True, 2], "cursor", None]
+        for position in positions:
+            url = reverse("api:market-list") + f"?ordering=-volume&cursor={encode_cursor(position)}"
+            self.assertEqual(self.client.get(url).status_code, status.HTTP_400_BAD_REQUEST, position)
+        url = reverse("api:market-list") + f"?ordering=name&cursor={encode_cursor([5, 2])}"
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_400_BAD_REQUEST)
+        url = reverse("api:market-list") + f"?ordering=name&cursor={encode_cursor(['C1-BTC', 2])}"
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_200_OK)
+        url = reverse("api:market_changes-list") + f"?cursor={encode_cursor(['1', 2])}"
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_400_BAD_REQUEST)
+
+    def testPageNumberCount(self):
+        """Small results are counted exactly."""
+        response = self.client.get(reverse("api:market-list")).json()
+        self.assertEqual(response["count"], 7)
+        self.assertFalse(response["count_estimated"])
+
+    @override_settings(ESTIMATED_COUNT_THRESHOLD=0)
+    def testEstimatedCount(self):
+        response = self.client.get(reverse("api:market-list")).json()
+        self.assertTrue(response["count_estimated"])
+        response = self.client.get(reverse("api:market-list") + "?count=exact").json()
+        self.assertEqual(response["count"], 7)
+        self.assertFalse(response["count_estimated"])
+
+    @override_settings(ESTIMATED_COUNT_THRESHOLD=0)
+    def testExactCountElsewhere(self):
+        """Only the markets are counted by the planner estimate."""
+        response = self.client.get(reverse("api:exchange-list")).json()
+        self.assertEqual(response["count"], 1)
+        self.assertNotIn("count_estimated", response)
+
+
+class MarketChangesTest(TransactionTestCase):
+    """The change feed reads the transaction ids - the data must be committed."""
+    def setUp(self):
+        self.client = APIClient()
+        self.exchange = models.Exchange.objects.create(name="Bittrex", interval=300)
+        for i in range(3):
+            models.Market.objects.create(name=f"C{i}-BTC", base=f"C{i}", quote="BTC", exchange=self.exchange,
+                                         last=1, bid=1, ask=1)
+
+    def sync(self, cursor=""):
+        """Follow the next links from the cursor - returns the changed names and the last cursor."""
+        url = reverse("api:market_changes-list") + f"?page_size=2&cursor={cursor}"
+        names = []
+        while url:
+            response = self.client.get(url).json()
+            names += [x["name"] for x in response["results"]]
+            url = response["next"]
+        return names, response["cursor"]
+
+    def testChanges(self):
+        names, cursor = self.sync()
+        self.assertEqual(names, ["C0-BTC", "C1-BTC", "C2-BTC"])
+        self.assertEqual(self.sync(cursor), ([], cursor))
+        models.Market.objects.filter(name="C1-BTC").update(last=2)
+        models.Market.objects.filter(name="C0-BTC").update(active=False)
+        response = self.client.get(reverse("api:market_changes-list") + f"?cursor={cursor}").json()
+        self.assertEqual([(x["name"], x["active"]) for x in response["results"]],
+                         [("C1-BTC", True), ("C0-BTC", False)])
+
+    def testStaleMarkets(self):
+        """Stale markets must be reported as deactivated before they are deleted"""
+        names, cursor = self.sync()
+        since = timezone.now()
+        stale = since - timedelta(days=settings.MARKET_STALE_DAYS + 1)
+        models.Market.objects.filter(name="C2-BTC").update(updated=stale)
+        tasks.clear_stale_markets()
+        response = self.client.get(reverse("api:market_changes-list") + f"?cursor={cursor}").json()
+        self.assertEqual([(x["name"], x["active"]) for x in response["results"]], [("C2-BTC", False)])
+        # The clients syncing from a timestamp must get the deactivation too
+        response = self.client.get(reverse("api:market_changes-list"), {"since": since.isoformat()}).json()
+        self.assertEqual([(x["name"], x["active"]) for x in response["results"]], [("C2-BTC", False)])
+        models.Market.objects.filter(name="C2-BTC").update(updated=stale)
+        tasks.clear_stale_markets()
+        self.assertFalse(models.Market.objects.filter(name="C2-BTC").exists())
+
+    def testRunningTransaction(self):
+        """The changes of running transactions must wait for their commit"""
+        names, cursor = self.sync()
+        with transaction.atomic():
+            models.Market.objects.filter(name="C1-BTC").update(last=2)
+            self.assertEqual(self.sync(cursor)[0], [])
+        self.assertEqual(self.sync(cursor)[0], ["C1-BTC"])
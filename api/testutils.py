@@ -23,6 +23,12 @@ class TestParseMarket(unittest.TestCase):
             for key, value in self.symbol_data.items():
                 self.assertEqual(value, data[key])
 
+    def testConsume(self):
+        """Parsing with consume must drop the raw entries"""
+        parsed_data = utils.parse_market_data(self.data, self.exchange_id, consume=True)
+        self.assertEqual(len(parsed_data), 1)
+        self.assertFalse(self.data)
+
     def testSymbolOnly(self):
         """If we have a symbol and empty data - assert we don't throw it out """
         parsed_data = utils.parse_market_data({self.symbol: {}}, self.exchange_id)
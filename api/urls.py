@@ -1,6 +1,8 @@
 """URL configuration for the Scheduler API."""
+from django.conf import settings
 from django.urls import path
 from rest_framework import routers
+from marketmanager.historical import historical_view
 from . import views
 
 app_name = "api"
@@ -9,8 +11,10 @@ router = routers.DefaultRouter()
 router.register(r"exchanges", views.ExchangeViewSet)
 router.register(r"exchange_statuses", views.ExchangeStatusViewSet)
 router.register(r"markets", views.MarketViewSet)
+router.register(r"market_changes", views.MarketChanges, basename="market_changes")
 router.register(r"historical/markets", views.MarketHistoricalData, basename="historical_markets")
 router.register(r"historical/fiat", views.AggregatedFiatHistoricalData, basename="historical_fiat")
+router.register(r"historical/candles", views.MarketCandles, basename="historical_candles")
 router.register(r"daemon_status", views.DaemonStatus, basename="daemonstatus")
 router.register(r"task_results", views.TaskResults, basename="task_results")
 router.register(r"run_exchange", views.ExchangeRun, basename="run_exchange")
@@ -18,9 +22,21 @@ router.register(r"run_exchange", views.ExchangeRun, basename="run_exchange")
 # Internal routes
 router.register(r"internal/exchanges", views.ExchangeViewSet)
 router.register(r"internal/markets", views.MarketViewSet)
+router.register(r"internal/query_profile", views.QueryProfile, basename="query_profile")
+router.register(r"internal/cache_stats", views.CacheStats, basename="cache_stats")
 urlpatterns = router.urls
 
 urlpatterns += [
+    path("markets/snapshot/<int:exchange_id>/", views.market_snapshot, name="market-snapshot"),
     path("historical/fiat/exchange/<int:exchange_id>/",
          views.ExchangeFiatHistoricalData.as_view({"get": "list"}))
 ]
+
+if settings.HISTORICAL_ASYNC:
+    # ASGI mode - the async views take precedence over the historical viewsets
+    urlpatterns = [
+        path("historical/markets/", historical_view(views.MarketHistoricalData)),
+        path("historical/fiat/", historical_view(views.AggregatedFiatHistoricalData)),
+        path("historical/fiat/exchange/<int:exchange_id>/",
+             historical_view(views.ExchangeFiatHistoricalData)),
+    ] + urlpatterns
@@ -106,52 +106,72 @@ def get_base_and_quote(market_info: dict):
     return base, quote
 
 
-def parse_market_data(data: dict, exchange_id: int):
-    """Build a dict of symbol->values from the exchange data for DB insertion"""
-    update_data = {}
+def iter_market_data(data: dict, exchange_id: int, consume: bool = False):
+    """Yield (name, values) tuples from the exchange data for DB insertion.
+    If consume is True the raw entries are removed from data while parsing, so the raw and the
+    parsed data aren't kept in memory at the same time.
+    """
+    if consume:
+        while data:
+            symbol, values = data.popitem()
+            parsed = _parse_market(symbol, values, exchange_id)
+            if parsed:
+                yield parsed
+        return
     for symbol, values in data.items():
-        base = quote = None
-        if values.get('base'):
-            base = values.get('base')
-        if values.get('quote'):
-            quote = values.get('quote')
-        if values.get('symbol') and (not base or not quote):
-            try:
-                get_base_and_quote(values)
-            except ValueError:
-                logger.debug(f'Couldn\'t find base and quote from values symbol: {values["symbol"]}')
-        if values.get('info') and (not base or not quote):
-            try:
-                get_base_and_quote(values['info'])
-            except ValueError:
-                logger.debug(f'Couldn\'t find base and quote from values info: {values["info"]}')
-        if not base or not quote:
-            try:
-                base, quote = symbol.split(get_split_symbol(symbol))
-            except ValueError:
-                logger.debug(f"Couldn't find base and quote from symbol name: {symbol}")
+        parsed = _parse_market(symbol, values, exchange_id)
+        if parsed:
+            yield parsed
+
+
+def _parse_market(symbol: str, values: dict, exchange_id: int):
+    """Parse a single ticker to a (name, values) tuple. Returns None if the base/quote are unknown."""
+    base = quote = None
+    if values.get('base'):
+        base = values.get('base')
+    if values.get('quote'):
+        quote = values.get('quote')
+    if values.get('symbol') and (not base or not quote):
+        try:
+            get_base_and_quote(values)
+        except ValueError:
+            logger.debug(f'Couldn\'t find base and quote from values symbol: {values["symbol"]}')
+    if values.get('info') and (not base or not quote):
+        try:
+            get_base_and_quote(values['info'])
+        except ValueError:
+            logger.debug(f'Couldn\'t find base and quote from values info: {values["info"]}')
+    if not base or not quote:
+        try:
+            base, quote = symbol.split(get_split_symbol(symbol))
+        except ValueError:
+            logger.debug(f"Couldn't find base and quote from symbol name: {symbol}")
+            return None
+    # Normalize the name
+    name = "{}-{}".format(base, quote)
+    # Set them to 0 as there might be nulls
+    temp = {"last": 0, "bid": 0, "ask": 0, "high": 0, "low": 0, "open": 0, "close": 0,
+            "baseVolume": 0}
+    for key in temp.keys():
+        if values.get(key):
+            # Filter out those who don't have valid last values
+            if key == "last" and values[key] <= 0:
                 continue
-        # Normalize the name
-        name = "{}-{}".format(base, quote)
-        # Set them to 0 as there might be nulls
-        temp = {"last": 0, "bid": 0, "ask": 0, "high": 0, "low": 0, "open": 0, "close": 0,
-                "baseVolume": 0}
-        for key in temp.keys():
-            if values.get(key):
-                # Filter out those who don't have valid last values
-                if key == "last" and values[key] <= 0:
-                    continue
-                temp[key] = values[key]
-        update_data[name] = {"base": base,
-                             "quote": quote,
-                             "last": temp["last"],
-                             "bid": temp["bid"],
-                             "ask": temp["ask"],
-                             "high": temp["high"],
-                             "low": temp["low"],
-                             "open": temp["open"],
-                             "close": temp["close"],
-                             "volume": temp["baseVolume"],
-                             "exchange_id": exchange_id
-                             }
-    return update_data
+            temp[key] = values[key]
+    return name, {"base": base,
+                  "quote": quote,
+                  "last": temp["last"],
+                  "bid": temp["bid"],
+                  "ask": temp["ask"],
+                  "high": temp["high"],
+                  "low": temp["low"],
+                  "open": temp["open"],
+                  "close": temp["close"],
+                  "volume": temp["baseVolume"],
+                  "exchange_id": exchange_id
+                  }
+
+
+def parse_market_data(data: dict, exchange_id: int, consume: bool = False):
+    """Build a dict of symbol->values from the exchange data for DB insertion"""
+    return dict(iter_market_data(data, exchange_id, consume))
@@ -1,14 +1,19 @@
 """API views."""
+import gzip
 import hashlib
 import time
-from rest_framework.viewsets import (ViewSet, ReadOnlyModelViewSet)
+from rest_framework.viewsets import (ViewSet, GenericViewSet, ReadOnlyModelViewSet)
 from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.filters import OrderingFilter, SearchFilter
 from django_filters.rest_framework import DjangoFilterBackend
 from django.conf import settings
+from django.http import HttpResponse, JsonResponse
+from django.utils import timezone
+from django.utils.cache import patch_vary_headers
 from django.utils.decorators import method_decorator
-from django.views.decorators.cache import cache_page
+from django.utils.http import parse_etags
+from django.views.decorators.http import require_safe
 from django_celery_results.models import TaskResult
 from django.urls import reverse
 
@@ -17,10 +22,19 @@ from api import models
 from api import serializers
 from api import filters
 from api.tasks import fetch_exchange_data
+from marketmanager.cache import cache_response, get_cache_stats, get_exchange_scope, get_market_scope
+from marketmanager.candles import get_candles, parse_interval
+from marketmanager.conditional import (conditional_response, get_exchange_list_validators,
+                                       get_market_validators)
+from marketmanager.encoders import (FastListMixin, EXCHANGE_ENCODER, EXCHANGE_STATUS_ENCODER,
+                                    MARKET_CHANGE_ENCODER, MARKET_ENCODER)
+from marketmanager.exports import ExportMixin
+from marketmanager.pagination import ChangeFeedPagination, KeysetPagination
+from marketmanager.querylog import get_recent_profiles
+from marketmanager.rollups import RollupMixin, parse_time
+from marketmanager.snapshots import get_market_snapshot
 from django_influxdb.views import ListViewSet as InfluxListViewSet
 
-CACHE_TTL = getattr(settings, 'CACHE_TTL', 120)
-
 
 def get_request_id(base_name):
     """Create a request ID a base name and current time."""
@@ -48,6 +62,23 @@ class DaemonStatus(ViewSet):
             return Response(output, status=status.HTTP_503_SERVICE_UNAVAILABLE)
 
 
+class QueryProfile(ViewSet):
+    """Get the recent query profiles(SQL count and time per operation)."""
+
+    def list(self, request):
+        if not settings.QUERY_PROFILING:
+            output = {"error": "Query profiling is disabled."}
+            return Response(output, status=status.HTTP_404_NOT_FOUND)
+        return Response(get_recent_profiles(), status=status.HTTP_200_OK)
+
+
+class CacheStats(ViewSet):
+    """Get the hit ratio of the cached API views."""
+
+    def list(self, request):
+        return Response(get_cache_stats(["exchanges", "markets"]), status=status.HTTP_200_OK)
+
+
 class ExchangeRun(ViewSet):
     def create(self, request):
         host = request.META['HTTP_HOST']
@@ -65,34 +96,109 @@ class ExchangeRun(ViewSet):
         return Response(msg, status=status.HTTP_503_SERVICE_UNAVAILABLE)
 
 
-class ExchangeViewSet(ReadOnlyModelViewSet):
+class ExchangeViewSet(FastListMixin, ReadOnlyModelViewSet):
     """Handle exchange creation, listing and deletion."""
 
     queryset = models.Exchange.objects.all()
     serializer_class = serializers.ExchangeSerializer
+    row_encoder = EXCHANGE_ENCODER
+    fields_query_param = "fields"
     filter_class = filters.ExchangeFilter
     filter_backends = (DjangoFilterBackend, OrderingFilter)
     ordering_fields = ('name', 'volume', 'top_pair', 'top_pair_volume')
 
-    @method_decorator(cache_page(CACHE_TTL))
+    @method_decorator(conditional_response(get_exchange_list_validators))
+    @method_decorator(cache_response("exchanges", get_exchange_scope))
     def dispatch(self, *args, **kwargs):
         return super(ExchangeViewSet, self).dispatch(*args, **kwargs)
 
 
-class MarketViewSet(ReadOnlyModelViewSet):
-    queryset = models.Market.objects.all()
+class MarketViewSet(FastListMixin, ReadOnlyModelViewSet):
+    # Delisted markets are served through the partial index of the active ones
+    queryset = models.Market.objects.filter(active=True)
     serializer_class = serializers.MarketSerializer
+    row_encoder = MARKET_ENCODER
+    fields_query_param = "fields"
+    pagination_class = KeysetPagination
     filter_class = filters.MarketFilter
     filter_backends = (DjangoFilterBackend, OrderingFilter, SearchFilter)
     search_fields = ['base', 'quote']
     ordering_fields = ('name', 'source', 'volume', 'bid', 'ask', 'base')
 
-    @method_decorator(cache_page(CACHE_TTL))
+    @method_decorator(conditional_response(get_market_validators))
+    @method_decorator(cache_response("markets", get_market_scope))
     def dispatch(self, *args, **kwargs):
         return super(MarketViewSet, self).dispatch(*args, **kwargs)
 
 
-class MarketHistoricalData(InfluxListViewSet):
+class MarketChanges(FastListMixin, GenericViewSet):
+    """Markets changed(or deactivated) since the cursor of the previous page - follow the next links
+    and resume from the returned cursor to mirror the markets."""
+    queryset = models.Market.objects.all()
+    row_encoder = MARKET_CHANGE_ENCODER
+    pagination_class = ChangeFeedPagination
+    filter_class = filters.MarketChangeFilter
+    filter_backends = (DjangoFilterBackend, )
+
+
+MSGPACK_TYPES = ("application/msgpack", "application/x-msgpack")
+
+
+def accepts_gzip(accept_encoding: str) -> bool:
+    """Check if the Accept-Encoding header allows gzip - a q-value of 0 refuses the coding."""
+    qvalues = {}
+    for item in accept_encoding.split(","):
+        coding, *params = [x.strip() for x in item.split(";")]
+        qvalue = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    qvalue = float(value)
+                except ValueError:
+                    qvalue = 0.0
+        if coding:
+            qvalues[coding.lower()] = qvalue
+    qvalue = qvalues.get("gzip", qvalues.get("x-gzip", qvalues.get("*", 0.0)))
+    return qvalue > 0
+
+
+@require_safe
+def market_snapshot(request, exchange_id):
+    """Serve the pre-serialized active markets of the exchange straight from the cache.
+    JSON(gzipped if the client accepts it) or msgpack with ?format=msgpack or the Accept header."""
+    snapshot = get_market_snapshot(exchange_id)
+    if snapshot is None:
+        return JsonResponse({"detail": "Not found."}, status=status.HTTP_404_NOT_FOUND)
+    accept = request.META.get("HTTP_ACCEPT", "")
+    if request.GET.get("format") == "msgpack" or any(x in accept for x in MSGPACK_TYPES):
+        if snapshot["msgpack"] is None:
+            msg = {"detail": "msgpack isn't installed."}
+            return JsonResponse(msg, status=status.HTTP_406_NOT_ACCEPTABLE)
+        content, content_type = snapshot["msgpack"], "application/msgpack"
+        etag = 'W/"{}-msgpack"'.format(snapshot["etag"])
+    else:
+        content, content_type = snapshot["json"], "application/json"
+        # Weak as the gzipped and the plain JSON share it
+        etag = 'W/"{}"'.format(snapshot["etag"])
+    if_none_match = [x[2:] if x.startswith("W/") else x
+                     for x in parse_etags(request.META.get("HTTP_IF_NONE_MATCH", ""))]
+    if "*" in if_none_match or etag[2:] in if_none_match:
+        response = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+    elif content_type == "application/json":
+        if accepts_gzip(request.META.get("HTTP_ACCEPT_ENCODING", "")):
+            response = HttpResponse(content, content_type=content_type)
+            response["Content-Encoding"] = "gzip"
+        else:
+            response = HttpResponse(gzip.decompress(content), content_type=content_type)
+    else:
+        response = HttpResponse(content, content_type=content_type)
+    response["ETag"] = etag
+    patch_vary_headers(response, ("Accept", "Accept-Encoding"))
+    return response
+
+
+class MarketHistoricalData(ExportMixin, RollupMixin, InfluxListViewSet):
     """Endpoint for market historical data from InfluxDB"""
     additional_filter_params = ["exchange_id", "time_end"]
     required_filter_params = ["base", "quote", "time_start"]
@@ -100,7 +206,7 @@ class MarketHistoricalData(InfluxListViewSet):
     influx_model = models.PairsMarketModel
 
 
-class AggregatedFiatHistoricalData(InfluxListViewSet):
+class AggregatedFiatHistoricalData(ExportMixin, InfluxListViewSet):
     """Endpoint for fiat historical data from InfluxDB"""
     additional_filter_params = ["time_end"]
     required_filter_params = ["currency", "time_start"]
@@ -108,7 +214,7 @@ class AggregatedFiatHistoricalData(InfluxListViewSet):
     influx_model = models.AggregatedFiatMarketModel
 
 
-class ExchangeFiatHistoricalData(InfluxListViewSet):
+class ExchangeFiatHistoricalData(ExportMixin, RollupMixin, InfluxListViewSet):
     """Endpoint for fiat historical data from InfluxDB"""
     additional_filter_params = ["time_end", "exchange_id"]
     required_filter_params = ["currency", "time_start"]
@@ -116,11 +222,44 @@ class ExchangeFiatHistoricalData(InfluxListViewSet):
     influx_model = models.FiatMarketModel
 
 
-class ExchangeStatusViewSet(ReadOnlyModelViewSet):
+class MarketCandles(ViewSet):
+    """OHLCV candles of a market pair as columns - t(candle start, unix seconds), o, h, l, c and v."""
+
+    def list(self, request):
+        params = request.query_params
+        missing = [x for x in ("base", "quote", "time_start", "interval") if not params.get(x)]
+        if missing:
+            output = {"error": f"Missing required parameters: {', '.join(missing)}"}
+            return Response(output, status=status.HTTP_400_BAD_REQUEST)
+        interval = parse_interval(params["interval"])
+        if interval is None:
+            output = {"error": "Invalid interval - e.g. 1m, 15m, 4h or 1d(1m to 1w)."}
+            return Response(output, status=status.HTTP_400_BAD_REQUEST)
+        exchange_id = params.get("exchange_id")
+        if exchange_id is not None and not exchange_id.isdigit():
+            output = {"error": "Invalid exchange_id."}
+            return Response(output, status=status.HTTP_400_BAD_REQUEST)
+        now = timezone.now()
+        start = parse_time(params["time_start"], now)
+        end = parse_time(params["time_end"], now) if params.get("time_end") else now
+        if start is None or end is None or start >= end:
+            output = {"error": "Invalid time range."}
+            return Response(output, status=status.HTTP_400_BAD_REQUEST)
+        start = int(start.timestamp()) // interval * interval
+        end = -(-int(end.timestamp()) // interval) * interval
+        if (end - start) // interval > settings.HISTORICAL_MAX_CANDLES:
+            output = {"error": f"More than {settings.HISTORICAL_MAX_CANDLES} candles requested."}
+            return Response(output, status=status.HTTP_400_BAD_REQUEST)
+        candles = get_candles(params["base"], params["quote"], exchange_id, start, end, interval)
+        return Response(dict(interval=params["interval"], **candles))
+
+
+class ExchangeStatusViewSet(FastListMixin, ReadOnlyModelViewSet):
     """Handle exchange creation, listing and deletion."""
 
     queryset = models.ExchangeStatus.objects.all()
     serializer_class = serializers.ExchangeStatusSerializer
+    row_encoder = EXCHANGE_STATUS_ENCODER
     filter_class = filters.ExchangeStatusFilter
     filter_backends = (DjangoFilterBackend, OrderingFilter)
     ordering_fields = ('name', 'volume', 'top_pair_volume', 'top_pair')
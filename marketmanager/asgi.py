@@ -0,0 +1,33 @@
+"""
+ASGI config for marketmanager project.
+
+The market stream(Server-Sent Events) is served by its own ASGI app so the idle connections don't
+hold a worker - every other request is passed to Django. The historical endpoints are served by
+async views querying InfluxDB with the async client(HISTORICAL_ASYNC) and their NDJSON/CSV exports
+are streamed by an ASGI app. Run with:
+uvicorn marketmanager.asgi:application --lifespan off
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "marketmanager.settings")
+os.environ.setdefault("HISTORICAL_ASYNC", "True")
+
+django_application = get_asgi_application()
+
+# Need the configured settings
+from marketmanager.exports import get_export_view, historical_export  # noqa: E402
+from marketmanager.stream import market_stream  # noqa: E402
+
+STREAM_PATH = "/stream/markets/"
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "http" and scope["path"] == STREAM_PATH:
+        return await market_stream(scope, receive, send)
+    export = get_export_view(scope)
+    if export is not None:
+        return await historical_export(scope, receive, send, *export)
+    return await django_application(scope, receive, send)
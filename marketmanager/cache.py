@@ -0,0 +1,238 @@
+"""Versioned two-tier response cache for the API viewsets.
+The responses are cached in a bounded in-process LRU in front of the shared cache(Redis). Each entry
+keeps the version of the data scope it was built from - the versions are bumped when the data is
+written so the entries are invalidated only by actual changes:
+* markets - any market changed
+* markets:<exchange id> - a market of the exchange changed
+* exchanges - any exchange changed
+Outdated entries are served stale while a single request(holding a short lock in Redis) rebuilds
+them, so popular entries don't get rebuilt by every worker at once. If Redis is unavailable the
+entries of the local tier are served stale instead of hitting the DB on each request.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from functools import wraps
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+
+VERSION_KEY = "cache_version:{}"
+STATS_KEY = "cache_stats:{}:{}"
+TIERS = ("local", "redis", "stale", "miss")
+# Params whose comma separated values don't depend on the order(sparse fieldsets)
+SET_PARAMS = ("fields",)
+
+
+def get_version(scope: str):
+    """Get the current version of the data scope - None if the cache is unavailable."""
+    version = cache.get(VERSION_KEY.format(scope))
+    if version is None:
+        if cache.add(VERSION_KEY.format(scope), 1, None):
+            return 1
+        version = cache.get(VERSION_KEY.format(scope))
+    return version
+
+
+def incr(key: str, delta: int = 1):
+    """Increment a counter - missing counters are created."""
+    try:
+        cache.incr(key, delta)
+    except ValueError:
+        cache.set(key, delta, None)
+
+
+def bump_versions(*scopes: str):
+    """Invalidate the cached responses of the data scopes."""
+    for scope in scopes:
+        incr(VERSION_KEY.format(scope))
+
+
+def bump_market_versions(exchange_id: int):
+    bump_versions("markets", f"markets:{exchange_id}")
+
+
+class LocalCache:
+    """Bounded in-process LRU of the cache entries."""
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: str):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key: str, entry: dict):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > settings.RESPONSE_CACHE_LOCAL_SIZE:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class CacheStats:
+    """Per tier request counts and latencies - counted in-process and added to the shared counters
+    every RESPONSE_CACHE_STATS_INTERVAL seconds so the requests don't pay for them."""
+    def __init__(self):
+        self.counters = defaultdict(int)
+        self.lock = threading.Lock()
+        self.flushed = time.monotonic()
+
+    def record(self, name: str, tier: str, elapsed: float):
+        with self.lock:
+            self.counters[(name, tier, "count")] += 1
+            self.counters[(name, tier, "time_us")] += int(elapsed * 1000000)
+            if time.monotonic() - self.flushed < settings.RESPONSE_CACHE_STATS_INTERVAL:
+                return
+            counters, self.counters = self.counters, defaultdict(int)
+            self.flushed = time.monotonic()
+        for (name, tier, stat), value in counters.items():
+            incr(STATS_KEY.format(name, f"{tier}:{stat}"), value)
+
+
+local_cache = LocalCache()
+stats = CacheStats()
+
+
+def get_cache_stats(names: list) -> dict:
+    """Get the hit ratio of the cached views and the request count and latency of each tier."""
+    output = {}
+    for name in names:
+        tiers = {}
+        for tier in TIERS:
+            count = cache.get(STATS_KEY.format(name, f"{tier}:count"), 0)
+            time_us = cache.get(STATS_KEY.format(name, f"{tier}:time_us"), 0)
+            tiers[tier] = {"count": count, "avg_ms": time_us / count / 1000 if count else None}
+        hits = sum(tiers[x]["count"] for x in ("local", "redis", "stale"))
+        misses = tiers["miss"]["count"]
+        total = hits + misses
+        output[name] = {"hits": hits, "misses": misses, "hit_ratio": hits / total if total else None,
+                        "tiers": tiers}
+    return output
+
+
+def get_request_hash(request) -> str:
+    """Hash the path and the params of the request - requests differing only in the order of their
+    params or of the selected fields get the same hash."""
+    params = []
+    for param, values in sorted(request.GET.lists()):
+        if param in SET_PARAMS:
+            values = [",".join(sorted({y.strip() for x in values for y in x.split(",")} - {""}))]
+        params.append((param, values))
+    return hashlib.md5(f"{request.path}?{params}".encode()).hexdigest()
+
+
+def get_response_key(name: str, scope: str, request) -> str:
+    return f"response:{name}:{scope}:{get_request_hash(request)}"
+
+
+def is_fresh(entry: dict, version) -> bool:
+    return (version is not None and entry["version"] == version
+            and time.time() - entry["created"] < settings.RESPONSE_CACHE_TTL)
+
+
+def is_servable(entry: dict) -> bool:
+    """Outdated entries are served stale for up to RESPONSE_CACHE_STALE_TTL."""
+    return time.time() - entry["created"] < settings.RESPONSE_CACHE_TTL + settings.RESPONSE_CACHE_STALE_TTL
+
+
+def build_response(entry: dict) -> HttpResponse:
+    """Build a new response from the entry - the middlewares may change it."""
+    response = HttpResponse(entry["content"], status=entry["status"])
+    for header, value in entry["headers"].items():
+        response[header] = value
+    return response
+
+
+def cache_response(name: str, get_scope):
+    """Cache the GET responses of the view under the version of the data scope returned by
+    get_scope(request). The requests served by each tier are counted per name."""
+    def decorator(view_func):
+        def build(request, args, kwargs, key, version, start, lock_key=None):
+            """Run the view and store its response in both tiers."""
+            def store(response):
+                try:
+                    if response.status_code == 200:
+                        entry = {"version": version, "created": time.time(), "status": response.status_code,
+                                 "content": response.content, "headers": dict(response.items())}
+                        timeout = settings.RESPONSE_CACHE_TTL + settings.RESPONSE_CACHE_STALE_TTL
+                        cache.set(key, entry, timeout)
+                        local_cache.set(key, entry)
+                finally:
+                    if lock_key:
+                        cache.delete(lock_key)
+                    stats.record(name, "miss", time.perf_counter() - start)
+            try:
+                response = view_func(request, *args, **kwargs)
+            except Exception:
+                if lock_key:
+                    cache.delete(lock_key)
+                raise
+            if hasattr(response, "render") and callable(response.render) and not response.is_rendered:
+                response.add_post_render_callback(store)
+            else:
+                store(response)
+            return response
+
+        def serve(entry, tier, start):
+            stats.record(name, tier, time.perf_counter() - start)
+            response = build_response(entry)
+            # Stale responses must not get the conditional GET validators of the current data
+            response.stale = tier == "stale"
+            return response
+
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            if request.method not in ("GET", "HEAD") or not settings.RESPONSE_CACHE_TTL:
+                return view_func(request, *args, **kwargs)
+            start = time.perf_counter()
+            scope = get_scope(request)
+            key = get_response_key(name, scope, request)
+            version = get_version(scope)
+            local = local_cache.get(key)
+            if local and is_fresh(local, version):
+                return serve(local, "local", start)
+            shared = cache.get(key)
+            if shared and is_fresh(shared, version):
+                local_cache.set(key, shared)
+                return serve(shared, "redis", start)
+            # Single flight - only the lock holder rebuilds the entry
+            lock_key = f"{key}:lock"
+            if cache.add(lock_key, 1, settings.RESPONSE_CACHE_LOCK_TTL):
+                return build(request, args, kwargs, key, version, start, lock_key)
+            stale = max([x for x in (local, shared) if x and is_servable(x)], key=lambda x: x["created"],
+                        default=None)
+            if stale:
+                return serve(stale, "stale", start)
+            if version is not None:
+                # Another worker builds the entry - wait for it
+                deadline = time.monotonic() + settings.RESPONSE_CACHE_LOCK_WAIT
+                while time.monotonic() < deadline:
+                    time.sleep(0.05)
+                    shared = cache.get(key)
+                    if shared and is_fresh(shared, version):
+                        local_cache.set(key, shared)
+                        return serve(shared, "redis", start)
+            return build(request, args, kwargs, key, version, start)
+        return wrapper
+    return decorator
+
+
+def get_market_scope(request) -> str:
+    """Markets filtered on an exchange depend only on the markets of that exchange."""
+    exchange = request.GET.get("exchange")
+    if exchange and exchange.isdigit():
+        return f"markets:{exchange}"
+    return "markets"
+
+
+def get_exchange_scope(request) -> str:
+    return "exchanges"
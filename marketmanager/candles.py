@@ -0,0 +1,122 @@
+"""OHLCV candles of the market pairs computed by InfluxDB. The range is split into chunks of
+CANDLE_CHUNK_SIZE candles aligned to the epoch - the closed chunks(ended CANDLE_SETTLE seconds ago)
+can't change anymore and are cached without expiry, only the rest is queried. The settled chunks
+are read from the coarsest rollup the interval is a multiple of(from INFLUX_ROLLUPS_SINCE on), the
+others from the raw points.
+Without an exchange the candles combine the prices of all exchanges and sum their volumes."""
+import re
+from datetime import datetime, timezone as dt_timezone
+from django.conf import settings
+from django.core.cache import cache
+
+from api.models import PairsMarketModel
+from marketmanager.historical import flux_string
+from marketmanager.rollups import RAW, RESOLUTIONS, get_rollup_model
+
+INTERVAL = re.compile(r"^(\d+)(m|h|d|w)$")
+UNITS = {"m": 60, "h": 3600, "d": 86400, "w": 604800}
+CACHE_KEY = "candles:{}:{}:{}:{}:{}"
+# The columns of the candles and the fields of the raw points/rollups they are computed from
+COLUMNS = ("t", "o", "h", "l", "c", "v")
+FIELDS = {RAW: {"open": "last", "high": "last", "low": "last", "close": "last"},
+          "rollup": {"open": "open", "high": "high", "low": "low", "close": "close"}}
+
+
+def parse_interval(value: str):
+    """Get the seconds of the interval(e.g. 15m, 4h, 1d) - None if invalid."""
+    match = INTERVAL.match(value or "")
+    if not match:
+        return None
+    seconds = int(match.group(1)) * UNITS[match.group(2)]
+    return seconds if 60 <= seconds <= UNITS["w"] else None
+
+
+def get_source(interval: int, chunk_start: int, chunk_end: int, now: float) -> str:
+    """Get the coarsest rollup resolution dividing the interval which covers the chunk - raw if none."""
+    if settings.INFLUX_ROLLUPS_SINCE is None or chunk_start < settings.INFLUX_ROLLUPS_SINCE:
+        return RAW
+    for resolution, seconds in sorted(RESOLUTIONS.items(), key=lambda x: -x[1]):
+        # The rollup tasks write the windows of a resolution after they closed
+        if interval % seconds == 0 and chunk_end + 2 * seconds <= now:
+            return resolution
+    return RAW
+
+
+def flux_timestamp(timestamp: int) -> str:
+    return f'time(v: "{datetime.fromtimestamp(timestamp, dt_timezone.utc).isoformat()}")'
+
+
+def build_candle_flux(base: str, quote: str, exchange_id, start: int, stop: int, interval: int,
+                      source: str) -> str:
+    model = get_rollup_model(PairsMarketModel, source)
+    fields = FIELDS[RAW if source == RAW else "rollup"]
+    tags = [f'r["base"] == {flux_string(base)}', f'r["quote"] == {flux_string(quote)}']
+    if exchange_id:
+        tags.append(f'r["exchange_id"] == {flux_string(str(exchange_id))}')
+    prices = ",\n    ".join(
+        f'price(field: "{fields[name]}", fn: {fn}, name: "{name}")'
+        for name, fn in (("open", "first"), ("high", "max"), ("low", "min"), ("close", "last")))
+    return f'''data = from(bucket: {flux_string(model.bucket)})
+    |> range(start: {flux_timestamp(start)}, stop: {flux_timestamp(stop)})
+    |> filter(fn: (r) => r._measurement == {flux_string(model.measurement)})
+    |> filter(fn: (r) => {" and ".join(tags)})
+price = (field, fn, name) => data
+    |> filter(fn: (r) => r._field == field)
+    |> group()
+    |> sort(columns: ["_time"])
+    |> aggregateWindow(every: {interval}s, fn: fn, createEmpty: false, timeSrc: "_start")
+    |> set(key: "_field", value: name)
+volume = data
+    |> filter(fn: (r) => r._field == "volume")
+    |> group(columns: ["exchange_id"])
+    |> aggregateWindow(every: {interval}s, fn: last, createEmpty: false, timeSrc: "_start")
+    |> group(columns: ["_time"])
+    |> sum()
+    |> group()
+    |> set(key: "_field", value: "volume")
+union(tables: [
+    {prices},
+    volume
+])
+    |> pivot(rowKey: ["_time"], columnKey: ["_field"], valueColumn: "_value")
+    |> group()
+    |> sort(columns: ["_time"])'''
+
+
+def query_candles(flux: str) -> list:
+    """Run the candle query - the (time, open, high, low, close, volume) rows."""
+    from django_influxdb.influxdb import Client
+    tables = Client(measurement=PairsMarketModel.measurement).client.query_api().query(flux)
+    return [(int(x.values["_time"].timestamp()), x.values.get("open"), x.values.get("high"),
+             x.values.get("low"), x.values.get("close"), x.values.get("volume"))
+            for table in tables for x in table.records]
+
+
+def get_candles(base: str, quote: str, exchange_id, start: int, end: int, interval: int) -> dict:
+    """Get the candles of the range as columns(t, o, h, l, c, v) - t is the start of the candle."""
+    now = datetime.now(dt_timezone.utc).timestamp()
+    chunk = interval * settings.CANDLE_CHUNK_SIZE
+    chunk_starts = range(start - start % chunk, end, chunk)
+    keys = {x: CACHE_KEY.format(base, quote, exchange_id or "", interval, x) for x in chunk_starts}
+    chunks = cache.get_many(list(keys.values()))
+    missing = [x for x in chunk_starts if keys[x] not in chunks]
+    # The consecutive missing chunks with the same source are queried at once
+    runs = []
+    for chunk_start in missing:
+        source = get_source(interval, chunk_start, chunk_start + chunk, now)
+        if runs and runs[-1][1] == chunk_start and runs[-1][2] == source:
+            runs[-1][1] = chunk_start + chunk
+        else:
+            runs.append([chunk_start, chunk_start + chunk, source])
+    for run_start, run_end, source in runs:
+        flux = build_candle_flux(base, quote, exchange_id, run_start, run_end, interval, source)
+        rows = query_candles(flux)
+        settled = {}
+        for chunk_start in range(run_start, run_end, chunk):
+            chunks[keys[chunk_start]] = [x for x in rows if chunk_start <= x[0] < chunk_start + chunk]
+            if chunk_start + chunk + settings.CANDLE_SETTLE <= now:
+                settled[keys[chunk_start]] = chunks[keys[chunk_start]]
+        if settled:
+            cache.set_many(settled, None)
+    rows = [x for chunk_start in chunk_starts for x in chunks[keys[chunk_start]] if start <= x[0] < end]
+    return {name: [x[i] for x in rows] for i, name in enumerate(COLUMNS)}
@@ -17,7 +17,7 @@ app.autodiscover_tasks()
 app.conf.beat_schedule = {
     'clear_task_results': {
         'task': 'api.tasks.clear_task_results',
-        'schedule': crontab(minute=0, hour=10, day_of_week=0),
+        'schedule': crontab(minute=30, hour=10),
     },
     'clear_stale_markets': {
         'task': 'api.tasks.clear_stale_markets',
@@ -0,0 +1,75 @@
+"""Conditional GETs of the exchanges and markets lists. The validators(ETag and Last-Modified) are
+derived from the exchanges the response depends on - their last data fetch(set by every exchange
+run) and last update - and the params of the request, with a single aggregate query on the
+exchanges. The markets ETags also include the cache version of the markets, so market changes made
+outside the exchange runs(the stale market cleanup) change them too. The polling clients get a 304
+without any work on the markets."""
+import hashlib
+from functools import wraps
+from django.db.models import Count, Max
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+
+from api.filters import ExchangeFilter
+from api.models import Exchange
+from marketmanager.cache import get_market_scope, get_request_hash, get_version
+
+
+def get_exchange_validators(request, exchanges, version=None) -> tuple:
+    """Get the ETag and the Last-Modified timestamp of a response built from the exchanges(and the
+    data of the cache version)."""
+    values = exchanges.order_by().aggregate(updated=Max("updated"), fetched=Max("last_data_fetch"),
+                                            count=Count("id"))
+    etag = f"{get_request_hash(request)}:{values['updated']}:{values['fetched']}:{values['count']}"
+    if version is not None:
+        etag += f":{version}"
+    etag = quote_etag(hashlib.md5(etag.encode()).hexdigest())
+    modified = max([x for x in (values["updated"], values["fetched"]) if x], default=None)
+    return etag, int(modified.timestamp()) if modified else None
+
+
+def get_market_validators(request):
+    """Markets filtered on an exchange depend only on that exchange(and its markets version)."""
+    version = get_version(get_market_scope(request))
+    if version is None:
+        # The markets could have changed without their exchanges
+        return None
+    exchange = request.GET.get("exchange")
+    exchanges = Exchange.objects.all()
+    if exchange and exchange.isdigit():
+        exchanges = exchanges.filter(id=exchange)
+    return get_exchange_validators(request, exchanges, version)
+
+
+def get_exchange_list_validators(request):
+    """The exchanges lists depend only on the exchanges they are filtered to."""
+    filterset = ExchangeFilter(request.GET, queryset=Exchange.objects.all())
+    if not filterset.is_valid():
+        return None
+    return get_exchange_validators(request, filterset.qs)
+
+
+def conditional_response(get_validators):
+    """Answer the conditional GETs(If-None-Match, If-Modified-Since) of the view with a 304 when
+    the validators returned by get_validators(request) match - None skips the conditional GET."""
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            if request.method not in ("GET", "HEAD"):
+                return view_func(request, *args, **kwargs)
+            validators = get_validators(request)
+            if validators is None:
+                return view_func(request, *args, **kwargs)
+            etag, last_modified = validators
+            response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+            if response is None:
+                response = view_func(request, *args, **kwargs)
+                # Stale cached responses keep the validators they were built with
+                if response.status_code != 200 or getattr(response, "stale", False):
+                    return response
+            response["ETag"] = etag
+            if last_modified:
+                response["Last-Modified"] = http_date(last_modified)
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,163 @@
+"""Serialization of the model rows straight from values_list() - the output is byte-identical to the
+DRF serializers and the JSONRenderer of the API, without instantiating the models. The encoders
+must follow the fields of their serializers(asserted by the tests)."""
+import json
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+
+
+def to_float(value):
+    return None if value is None else float(value)
+
+
+def to_datetime(value):
+    """Same as the DRF DateTimeField - ISO 8601 in the current timezone with a Z for UTC."""
+    if not value:
+        return None
+    value = value.astimezone(timezone.get_current_timezone())
+    value = value.isoformat()
+    if value.endswith("+00:00"):
+        value = value[:-6] + "Z"
+    return value
+
+
+def render_json(data) -> bytes:
+    """Render the data the way the DRF JSONRenderer of the API does(compact, unicode, strict)."""
+    ret = json.dumps(data, cls=JSONEncoder, ensure_ascii=False, allow_nan=False, separators=(",", ":"))
+    ret = ret.replace("\u2028", "\\u2028").replace("\u2029", "\\u2029")
+    return ret.encode()
+
+
+class RowEncoder:
+    """Encode the values_list() rows of a queryset into the dicts of a serializer.
+    fields is a sequence of (output name, values_list column, converter or None) - the function
+    encoding a row is compiled once from them. extra_columns are selected but not encoded."""
+    def __init__(self, fields: tuple, extra_columns: tuple = ()):
+        self.fields = fields
+        self.columns = [x[1] for x in fields]
+        self.columns += [x for x in extra_columns if x not in self.columns]
+        self.subsets = {}
+        namespace = {}
+        items = []
+        for i, (name, column, converter) in enumerate(fields):
+            value = f"row[{i}]"
+            if converter:
+                namespace[f"convert_{i}"] = converter
+                value = f"convert_{i}({value})"
+            items.append(f"{name!r}: {value}")
+        exec("def encode_row(row):\n    return {" + ", ".join(items) + "}", namespace)
+        self.encode_row = namespace["encode_row"]
+
+    @property
+    def names(self) -> list:
+        return [x[0] for x in self.fields]
+
+    def subset(self, names: set, extra_columns: tuple = ()):
+        """Get the encoder of only the named fields(in the order of the full encoder)."""
+        key = (frozenset(names), tuple(extra_columns))
+        if key not in self.subsets:
+            self.subsets[key] = RowEncoder(tuple(x for x in self.fields if x[0] in names), extra_columns)
+        return self.subsets[key]
+
+    def get_rows(self, queryset, named: bool = False):
+        """Get the rows of the queryset - named rows also have the columns as attributes."""
+        return queryset.values_list(*self.columns, named=named)
+
+    def encode(self, rows) -> list:
+        return list(map(self.encode_row, rows))
+
+
+class FastListMixin:
+    """List the rows of the queryset through the row_encoder instead of the serializer - the same
+    output without instantiating the models and running the serializer fields on each of them.
+    With fields_query_param set the lists can be limited to some of the fields(sparse fieldsets) -
+    only their columns are selected."""
+    row_encoder = None
+    fields_query_param = None
+
+    def get_field_names(self):
+        """Get the fields selected by the request - None for all of them."""
+        if not self.fields_query_param or not self.request.query_params.get(self.fields_query_param):
+            return None
+        names = {x.strip() for x in self.request.query_params[self.fields_query_param].split(",")} - {""}
+        if not names:
+            return None
+        unknown = names - set(self.row_encoder.names)
+        if unknown:
+            msg = "Unknown fields: {}".format(", ".join(sorted(unknown)))
+            raise ValidationError({self.fields_query_param: [msg]})
+        return names
+
+    def get_row_encoder(self):
+        names = self.get_field_names()
+        if names is None:
+            return self.row_encoder
+        # The cursor pagination reads the position from the rows
+        get_cursor_columns = getattr(self.paginator, "get_cursor_columns", None)
+        extra_columns = get_cursor_columns(self.request) if get_cursor_columns else ()
+        return self.row_encoder.subset(names, tuple(extra_columns))
+
+    def list(self, request, *args, **kwargs):
+        encoder = self.get_row_encoder()
+        queryset = self.filter_queryset(self.get_queryset())
+        # The paginators read the cursor positions from the named rows
+        rows = encoder.get_rows(queryset, named=True)
+        page = self.paginate_queryset(rows)
+        if page is not None:
+            return self.get_paginated_response(encoder.encode(page))
+        return Response(encoder.encode(rows))
+
+
+# The fields of the MarketSerializer
+MARKET_ENCODER = RowEncoder((
+    ("id", "id", None),
+    ("name", "name", None),
+    ("exchange", "exchange_id", None),
+    ("volume", "volume", to_float),
+    ("last", "last", to_float),
+    ("bid", "bid", to_float),
+    ("ask", "ask", to_float),
+    ("base", "base", None),
+    ("quote", "quote", None),
+    ("updated", "updated", to_datetime),
+))
+
+# The markets of the change feed - the deactivated ones are included
+MARKET_CHANGE_ENCODER = RowEncoder(MARKET_ENCODER.fields + (
+    ("active", "active", None),
+    ("version", "version", None),
+))
+
+# The fields of the ExchangeSerializer
+EXCHANGE_ENCODER = RowEncoder((
+    ("id", "id", None),
+    ("name", "name", None),
+    ("created", "created", to_datetime),
+    ("updated", "updated", to_datetime),
+    ("url", "url", None),
+    ("api_url", "api_url", None),
+    ("volume", "volume", to_float),
+    ("top_pair", "top_pair", None),
+    ("top_pair_volume", "top_pair_volume", to_float),
+    ("interval", "interval", None),
+    ("enabled", "enabled", None),
+    ("last_data_fetch", "last_data_fetch", to_datetime),
+    ("logo", "logo", None),
+    ("priority_tier", "priority_tier", None),
+))
+
+# The fields of the ExchangeStatusSerializer
+EXCHANGE_STATUS_ENCODER = RowEncoder((
+    ("id", "id", None),
+    ("exchange", "exchange_id", None),
+    ("last_run", "last_run", to_datetime),
+    ("last_run_id", "last_run_id", None),
+    ("last_run_status", "last_run_status", None),
+    ("time_started", "time_started", to_datetime),
+    ("running", "running", None),
+    ("consecutive_failures", "consecutive_failures", None),
+    ("circuit_state", "circuit_state", None),
+    ("retry_after", "retry_after", to_datetime),
+))
@@ -0,0 +1,164 @@
+"""Streaming NDJSON/CSV exports of the historical endpoints(?stream=ndjson or ?stream=csv). The
+records are written as the InfluxDB CSV result is parsed(query_stream) and sent in chunks of
+EXPORT_CHUNK_SIZE records, so the memory stays constant whatever the range. Served by the
+historical viewsets under WSGI and by the ASGI app(with the async client) in the ASGI mode."""
+import asyncio
+import csv
+import io
+import json
+import re
+from urllib.parse import parse_qs
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from rest_framework import status
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
+
+from marketmanager.historical import (HistoricalBusy, HistoricalQueryError, build_flux, get_record,
+                                      get_view_model, queries)
+from marketmanager.stream import send_response, wait_disconnect
+
+FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+# The historical paths of the ASGI app - the names of their viewsets(api.views)
+EXPORT_ROUTES = (
+    (re.compile(r"^/historical/markets/$"), "MarketHistoricalData"),
+    (re.compile(r"^/historical/fiat/$"), "AggregatedFiatHistoricalData"),
+    (re.compile(r"^/historical/fiat/exchange/(?P<exchange_id>\d+)/$"), "ExchangeFiatHistoricalData"),
+)
+
+
+class ExportWriter:
+    """Encode the records of the format - the CSV header is taken from the first record."""
+    def __init__(self, export_format: str):
+        self.format = export_format
+        self.columns = None
+
+    def write(self, records: list) -> bytes:
+        if self.format == "ndjson":
+            return "".join(json.dumps(x, separators=(",", ":")) + "\n" for x in records).encode()
+        output = io.StringIO()
+        header = self.columns is None
+        if header:
+            self.columns = list(records[0])
+        writer = csv.DictWriter(output, self.columns, restval="", extrasaction="ignore")
+        if header:
+            writer.writeheader()
+        writer.writerows(records)
+        return output.getvalue().encode()
+
+
+def iter_export(records, writer: ExportWriter):
+    """Encode the FluxRecords in chunks."""
+    chunk = []
+    for record in records:
+        chunk.append(get_record(record))
+        if len(chunk) >= settings.EXPORT_CHUNK_SIZE:
+            yield writer.write(chunk)
+            chunk = []
+    if chunk:
+        yield writer.write(chunk)
+
+
+class ExportMixin:
+    """Stream the list as NDJSON or CSV with ?stream= instead of building the JSON document."""
+    def list(self, request, *args, **kwargs):
+        export_format = request.query_params.get("stream")
+        if not export_format:
+            return super().list(request, *args, **kwargs)
+        if export_format not in FORMATS:
+            output = {"error": f"Invalid stream format - one of: {', '.join(FORMATS)}."}
+            return Response(output, status=status.HTTP_400_BAD_REQUEST)
+        params = dict(request.query_params.items(), **{k: str(v) for k, v in kwargs.items()})
+        model, resolution = get_view_model(type(self), params)
+        try:
+            flux = build_flux(type(self), params, model)
+        except HistoricalQueryError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        from django_influxdb.influxdb import Client
+        records = Client(measurement=model.measurement).client.query_api().query_stream(flux)
+        response = StreamingHttpResponse(iter_export(records, ExportWriter(export_format)),
+                                         content_type=FORMATS[export_format])
+        if resolution:
+            response["X-Resolution"] = resolution
+        return response
+
+
+def get_export_view(scope):
+    """Get the viewset and path kwargs of an export request of the ASGI app - None if it isn't one."""
+    if scope["type"] != "http" or "stream" not in parse_qs(scope["query_string"].decode()):
+        return None
+    for pattern, name in EXPORT_ROUTES:
+        match = pattern.match(scope["path"])
+        if match:
+            from api import views
+            return getattr(views, name), match.groupdict()
+    return None
+
+
+async def stream_export(send, flux: str, export_format: str, resolution: str = None):
+    """Run the query in one of the slots of the process and send its records in chunks."""
+    started = False
+    try:
+        async with queries.slot():
+            records = await asyncio.wait_for(queries.client.query_api().query_stream(flux),
+                                             settings.HISTORICAL_QUERY_TIMEOUT)
+            try:
+                headers = [(b"content-type", FORMATS[export_format].encode())]
+                if resolution:
+                    headers.append((b"x-resolution", resolution.encode()))
+                await send({"type": "http.response.start", "status": 200, "headers": headers})
+                started = True
+                writer = ExportWriter(export_format)
+                chunk = []
+                while True:
+                    try:
+                        record = await asyncio.wait_for(records.__anext__(),
+                                                        settings.HISTORICAL_QUERY_TIMEOUT)
+                    except StopAsyncIteration:
+                        break
+                    chunk.append(get_record(record))
+                    if len(chunk) >= settings.EXPORT_CHUNK_SIZE:
+                        await send({"type": "http.response.body", "body": writer.write(chunk),
+                                    "more_body": True})
+                        chunk = []
+                await send({"type": "http.response.body", "body": writer.write(chunk) if chunk else b""})
+            finally:
+                # Closes the response of the query
+                await records.aclose()
+    except HistoricalBusy:
+        return await send_response(send, 503, b'{"error":"Too many historical queries."}')
+    except asyncio.TimeoutError:
+        if started:
+            # Cut the stream - a complete body would pass the truncated export as a whole one
+            raise
+        await send_response(send, 504, b'{"error":"The historical query timed out."}')
+
+
+async def historical_export(scope, receive, send, view_class, kwargs: dict):
+    """ASGI app streaming the export with the async client - the query holds one of the slots of the
+    process and fails if no record arrives for HISTORICAL_QUERY_TIMEOUT. The query is cancelled(and
+    its slot released) as soon as the client disconnects."""
+    if scope["method"] != "GET":
+        return await send_response(send, 405, b'{"detail":"Method not allowed."}')
+    params = dict({k: v[-1] for k, v in parse_qs(scope["query_string"].decode()).items()}, **kwargs)
+    export_format = params["stream"]
+    try:
+        if export_format not in FORMATS:
+            raise HistoricalQueryError(f"Invalid stream format - one of: {', '.join(FORMATS)}.")
+        model, resolution = get_view_model(view_class, params)
+        flux = build_flux(view_class, params, model)
+    except HistoricalQueryError as e:
+        return await send_response(send, 400, json.dumps({"error": str(e)}).encode())
+    except ValidationError as e:
+        return await send_response(send, 400, json.dumps(e.detail).encode())
+    export = asyncio.ensure_future(stream_export(send, flux, export_format, resolution))
+    disconnect = asyncio.ensure_future(wait_disconnect(receive))
+    try:
+        await asyncio.wait({export, disconnect}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        disconnect.cancel()
+        if not export.done():
+            export.cancel()
+            await asyncio.wait({export})
+    if not export.cancelled():
+        export.result()
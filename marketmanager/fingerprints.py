@@ -0,0 +1,52 @@
+"""Change detection for the market data of the exchanges."""
+import hashlib
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+FINGERPRINT_FIELDS = ("last", "bid", "ask", "volume", "high", "low", "open", "close")
+
+
+class MarketFingerprints:
+    """Fingerprints of the market numeric fields of an exchange, kept in the cache(Redis).
+    The updaters use them to write only the markets which changed since the last run. Markets which
+    haven't been written for CHANGE_DETECTION_HEARTBEAT seconds are treated as changed.
+    """
+    def __init__(self, exchange_id: int):
+        self.key = "fingerprints:{}".format(exchange_id)
+        self.enabled = settings.CHANGE_DETECTION_ENABLED
+        self.previous = cache.get(self.key) or {} if self.enabled else {}
+        self.current = {}
+        self.changed = set()
+
+    @staticmethod
+    def fingerprint(values: dict) -> str:
+        """Hash the numeric fields of the market values."""
+        data = repr(tuple(values.get(x) for x in FINGERPRINT_FIELDS)).encode()
+        return hashlib.blake2b(data, digest_size=8).hexdigest()
+
+    def detect(self, market_data: dict) -> set:
+        """Get the names of the markets which changed since the last saved run."""
+        now = timezone.now().timestamp()
+        heartbeat = settings.CHANGE_DETECTION_HEARTBEAT
+        for name, values in market_data.items():
+            fingerprint = self.fingerprint(values)
+            previous = self.previous.get(name)
+            if previous and previous[0] == fingerprint and now - previous[1] < heartbeat:
+                self.current[name] = previous
+                continue
+            self.current[name] = (fingerprint, now)
+            self.changed.add(name)
+        return self.changed
+
+    @property
+    def reduction(self) -> float:
+        """Ratio of the markets which were skipped."""
+        if not self.current:
+            return 0.0
+        return 1 - len(self.changed) / len(self.current)
+
+    def save(self):
+        """Save the fingerprints of the current run - call only after the writes succeeded."""
+        if self.enabled:
+            cache.set(self.key, self.current, timeout=None)
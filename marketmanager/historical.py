@@ -0,0 +1,161 @@
+"""Async serving path of the historical(InfluxDB) endpoints for the ASGI mode. The Flux queries are
+built from the declarations of the historical viewsets and their models and run with the async
+InfluxDB client, so the in-flight queries of a process share its event loop instead of holding a
+worker each. The queries of a process are limited to HISTORICAL_MAX_CONCURRENCY - the requests
+waiting for a slot longer than HISTORICAL_QUEUE_TIMEOUT get a 503, the queries running longer
+than HISTORICAL_QUERY_TIMEOUT a 504."""
+import asyncio
+import re
+from contextlib import asynccontextmanager
+from datetime import timezone as dt_timezone
+from django.conf import settings
+from django.http import JsonResponse
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import ValidationError
+
+from marketmanager.rollups import RollupMixin, get_resolution, get_rollup_model
+
+RELATIVE_TIME = re.compile(r"^-\d+(ns|us|ms|s|m|h|d|w|mo|y)$")
+# The columns of the Flux tables which aren't part of the records
+DROPPED_COLUMNS = ("result", "table", "_start", "_stop", "_measurement")
+
+
+class HistoricalQueryError(ValueError):
+    pass
+
+
+class HistoricalBusy(Exception):
+    """No query slot freed up in time."""
+
+
+def flux_string(value: str) -> str:
+    if any(ord(x) < 32 for x in value):
+        raise HistoricalQueryError(f"Invalid value: {value!r}")
+    value = value.replace("\\", "\\\\").replace('"', '\\"').replace("${", "\\${")
+    return f'"{value}"'
+
+
+def flux_time(value: str) -> str:
+    """Flux time of a relative duration(-1h) or an ISO 8601 timestamp."""
+    if RELATIVE_TIME.match(value):
+        return value
+    parsed = parse_datetime(value)
+    if parsed is None:
+        raise HistoricalQueryError(f"Invalid time: {value!r}")
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=dt_timezone.utc)
+    return f'time(v: "{parsed.astimezone(dt_timezone.utc).isoformat()}")'
+
+
+def build_flux(view_class, params: dict, model=None) -> str:
+    """Build the Flux query of the historical viewset(or of another model of it) for the request params."""
+    missing = [x for x in view_class.required_filter_params if not params.get(x)]
+    if missing:
+        raise HistoricalQueryError(f"Missing required parameters: {', '.join(missing)}")
+    model = model or view_class.influx_model
+    tags = set(model.required_influx_tags) | set(getattr(model, "optional_influx_tags", []))
+    time_range = f"start: {flux_time(params['time_start'])}"
+    if params.get("time_end"):
+        time_range += f", stop: {flux_time(params['time_end'])}"
+    lines = [
+        f"from(bucket: {flux_string(model.bucket)})",
+        f"|> range({time_range})",
+        f"|> filter(fn: (r) => r._measurement == {flux_string(model.measurement)})",
+    ]
+    filters = [f"r[{flux_string(x)}] == {flux_string(params[x])}"
+               for x in view_class.required_filter_params + view_class.additional_filter_params
+               if x in tags and params.get(x)]
+    if filters:
+        lines.append(f"|> filter(fn: (r) => {' and '.join(filters)})")
+    fields = " or ".join(f"r._field == {flux_string(x['name'])}" for x in model.fields)
+    lines.append(f"|> filter(fn: (r) => {fields})")
+    if getattr(model, "pivot_tables", False):
+        lines.append('|> pivot(rowKey: ["_time"], columnKey: ["_field"], valueColumn: "_value")')
+    lines.append('|> group()')
+    lines.append(f"|> sort(columns: [{', '.join(flux_string(x) for x in model.sorting_tags)}])")
+    return "\n    ".join(lines)
+
+
+def get_view_model(view_class, params: dict) -> tuple:
+    """Get the model serving the request params of the historical viewset and its resolution(None
+    without rollups)."""
+    if issubclass(view_class, RollupMixin):
+        resolution = get_resolution(params)
+        return get_rollup_model(view_class.influx_model, resolution), resolution
+    return view_class.influx_model, None
+
+
+def get_record(record) -> dict:
+    values = {k: v for k, v in record.values.items() if k not in DROPPED_COLUMNS}
+    values["_time"] = values["_time"].isoformat().replace("+00:00", "Z")
+    return values
+
+
+class HistoricalQueries:
+    """The async InfluxDB client and the admission limit of the process - bound to its event loop."""
+    def __init__(self):
+        self.loop = None
+        self.client = None
+        self.semaphore = None
+
+    def setup(self):
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            from influxdb_client.client.influxdb_client_async import InfluxDBClientAsync
+            self.loop = loop
+            self.client = InfluxDBClientAsync(url=settings.INFLUXDB_URL, token=settings.INFLUXDB_TOKEN,
+                                              org=settings.INFLUXDB_ORG,
+                                              timeout=int(settings.INFLUXDB_TIMEOUT))
+            self.semaphore = asyncio.Semaphore(settings.HISTORICAL_MAX_CONCURRENCY)
+
+    @asynccontextmanager
+    async def slot(self):
+        """Hold a query slot - raises HistoricalBusy if none frees up in time."""
+        self.setup()
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), settings.HISTORICAL_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise HistoricalBusy
+        try:
+            yield
+        finally:
+            self.semaphore.release()
+
+    async def query(self, flux: str) -> list:
+        """Run the query once a slot is free - raises TimeoutError if it doesn't finish in time."""
+        async with self.slot():
+            tables = await asyncio.wait_for(self.client.query_api().query(flux),
+                                            settings.HISTORICAL_QUERY_TIMEOUT)
+        return [get_record(record) for table in tables for record in table.records]
+
+
+queries = HistoricalQueries()
+
+
+def historical_view(view_class):
+    """Async view serving the historical viewset - the path kwargs are used as params."""
+    async def view(request, **kwargs):
+        if request.method not in ("GET", "HEAD"):
+            return JsonResponse({"detail": f'Method "{request.method}" not allowed.'}, status=405)
+        params = dict(request.GET.items(), **{k: str(v) for k, v in kwargs.items()})
+        try:
+            model, resolution = get_view_model(view_class, params)
+            flux = build_flux(view_class, params, model)
+        except HistoricalQueryError as e:
+            return JsonResponse({"error": str(e)}, status=400)
+        except ValidationError as e:
+            return JsonResponse(e.detail, status=400)
+        try:
+            records = await queries.query(flux)
+        except HistoricalBusy:
+            response = JsonResponse({"error": "Too many historical queries."}, status=503)
+            response["Retry-After"] = str(settings.HISTORICAL_QUEUE_TIMEOUT)
+            return response
+        except asyncio.TimeoutError:
+            return JsonResponse({"error": "The historical query timed out."}, status=504)
+        response = JsonResponse(records, safe=False)
+        if resolution:
+            response["X-Resolution"] = resolution
+        return response
+    view.__name__ = view.__qualname__ = f"{view_class.__name__}Async"
+    return view
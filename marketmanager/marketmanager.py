@@ -5,10 +5,12 @@ from django.utils import timezone
 from django.conf import settings
 from time import sleep
 
-from api.tasks import fetch_exchange_data
+from api.tasks import fetch_exchange_data, fetch_exchanges_batch
 from api.models import Exchange, ExchangeStatus
 from marketmanager.celery import app
-from marketmanager.utils import get_exchange_details
+from marketmanager.querylog import profile_queries
+from marketmanager.utils import (get_exchange_details, get_exchange_queue, sort_by_priority, update_circuit,
+                                 pack_exchange_batches)
 
 
 class MarketManager(object):
@@ -55,6 +57,9 @@ class MarketManager(object):
             status.running = False
             status.save()
             return
+        if status.batch_size:
+            self.checkBatchMember(status)
+            return
         time_now = timezone.now().timestamp()
         time_started = status.time_started.timestamp()
         timeout = status.timeout
@@ -68,10 +73,50 @@ class MarketManager(object):
                                                                run_id)
         self.logger.error(msg)
         app.control.revoke(run_id, terminate=True, timeout=3)
+        update_circuit(status, success=False)
         status.running = False
         status.last_run_status = "Timeout reached"
         status.save()
 
+    def checkBatchMember(self, status: ExchangeStatus):
+        """Check the status of an exchange running in a batch task.
+
+        Each member gets its own start time once the batch reaches it and times out on its own
+        without the shared task being revoked. The members are finished only after the shared write,
+        so once a later member started a member is just waiting for it and isn't timed out on its own.
+        The batch task is revoked only once it exceeds the timeout of all its members - the members
+        which hadn't started by then aren't failed.
+        """
+        time_now = timezone.now().timestamp()
+        batch_started = status.batch_started.timestamp()
+        started = status.time_started.timestamp() > batch_started
+        later_members = ExchangeStatus.objects.filter(last_run_id=status.last_run_id,
+                                                      time_started__gt=status.time_started)
+        later_members = later_members.exclude(pk=status.pk)
+        if started and time_now > status.time_started.timestamp() + status.timeout and \
+                not later_members.exists():
+            msg = "Timeout reached for {} in batch {}.".format(status.exchange, status.last_run_id)
+            self.logger.error(msg)
+            update_circuit(status, success=False)
+            status.running = False
+            status.last_run_status = "Timeout reached"
+            status.save()
+            return
+        if time_now <= batch_started + status.timeout * status.batch_size:
+            msg = "Exchange {} is within timeout!".format(status.exchange)
+            self.logger.info(msg)
+            return
+        msg = "Batch timeout reached for {}.Revoking task {}".format(status.exchange, status.last_run_id)
+        self.logger.error(msg)
+        app.control.revoke(status.last_run_id, terminate=True, timeout=3)
+        if started:
+            update_circuit(status, success=False)
+            status.last_run_status = "Timeout reached"
+        else:
+            status.last_run_status = "Batch timed out before the run"
+        status.running = False
+        status.save()
+
     def checkExchange(self, exchange: Exchange, status: ExchangeStatus) -> bool:
         """Check if the exchange data is meant to be fetched."""
         if not exchange.enabled:
@@ -82,6 +127,15 @@ class MarketManager(object):
             msg = "Exchange fetch running: {}. Skipping.".format(exchange.name)
             self.logger.info(msg)
             return False
+        if status.circuit_state == "open":
+            if status.retry_after and status.retry_after > timezone.now():
+                msg = f"Circuit open for {exchange.name} until {status.retry_after}. Skipping."
+                self.logger.info(msg)
+                return False
+            # The backoff has passed - let a single probe run through
+            self.logger.info(f"Circuit half-open for {exchange.name}. Sending a probe.")
+            status.circuit_state = "half-open"
+            return True
         if exchange.last_data_fetch:
             current_time = timezone.now().timestamp()
             last_run = exchange.last_data_fetch.timestamp()
@@ -98,11 +152,13 @@ class MarketManager(object):
 
     def getExchanges(self, exchange_id: int = None):
         """Get the exchange(s) from the db. Wrap around the DB Errors."""
+        # The statuses are joined so the scheduler doesn't query them per exchange
         if not exchange_id:
-            exchanges = Exchange.objects.filter(enabled=True)
+            exchanges = Exchange.objects.filter(enabled=True).select_related("exchangestatus")
         else:
-            exchanges = Exchange.objects.filter(pk=exchange_id)
-        self.logger.info("Got exchanges: {}".format(exchanges))
+            exchanges = Exchange.objects.filter(pk=exchange_id).select_related("exchangestatus")
+        # len() fetches the exchanges so the log and the scheduler share the results of a single query
+        self.logger.info("Got {} exchanges: {}".format(len(exchanges), exchanges))
         return exchanges
 
     def getExchangeStatus(self, exc_id: int = None):
@@ -141,13 +197,62 @@ class MarketManager(object):
             self.logger.info(msg)
             sleep(10)
 
+    def setRunning(self, status: ExchangeStatus, task_id, batch_size: int = None) -> None:
+        """Mark the exchange status as running with the celery task(of a batch of batch_size)."""
+        status.time_started = timezone.now()
+        status.last_run_id = task_id
+        status.running = True
+        status.batch_size = batch_size
+        status.batch_started = status.time_started if batch_size else None
+        status.save()
+
+    def isBatchable(self, status: ExchangeStatus) -> bool:
+        """Check if the exchange is small enough to be batched with others."""
+        if not settings.EXCHANGE_BATCHING or status.last_run_pairs is None:
+            return False
+        # Half-open circuit probes are sent on their own
+        return status.circuit_state == "closed" and status.last_run_pairs <= settings.EXCHANGE_BATCH_MAX_PAIRS
+
+    def scheduleBatches(self, batchable: list) -> None:
+        """Bin-pack the small exchanges and send each batch to celery as a single task."""
+        statuses = {exchange.id: status for exchange, status in batchable}
+        pairs = {exchange.id: status.last_run_pairs for exchange, status in batchable}
+        for batch in pack_exchange_batches([x[0] for x in batchable], pairs):
+            # The batch goes to the queue of its highest priority exchange
+            queue = get_exchange_queue(sort_by_priority(batch)[0])
+            ids = [x.id for x in batch]
+            task_id = fetch_exchanges_batch.apply_async(args=[ids], queue=queue)
+            if task_id:
+                self.logger.info(f"Sent batch of exchanges {ids} to queue {queue}")
+                for exchange_id in ids:
+                    self.setRunning(statuses[exchange_id], task_id, len(ids))
+
+    def scheduleExchanges(self, exchanges) -> None:
+        """Submit the exchanges which must run to celery - highest priority tiers first."""
+        batchable = []
+        for exchange in sort_by_priority(exchanges):
+            status = getattr(exchange, "exchangestatus", None) or self.getExchangeStatus(exchange.id)
+            should_run = self.checkExchange(exchange, status)
+            if not should_run:
+                continue
+            if self.isBatchable(status):
+                batchable.append((exchange, status))
+                continue
+            queue = get_exchange_queue(exchange)
+            task_id = fetch_exchange_data.apply_async(args=[exchange.id], queue=queue)
+            if task_id:
+                self.logger.info(f"Sent exchange {exchange.name} to queue {queue}")
+                self.setRunning(status, task_id)
+        if batchable:
+            self.scheduleBatches(batchable)
+
     def scheduler(self) -> None:
         """Event loop which can be called as a separate Process.
 
         Workflow:
         1) Get the exchanges
         2) Run checks if the exchange should be run(enabled, time)
-        3) Submit a task to celery
+        3) Submit a task to celery in the queue of the exchange priority tier
         """
         self._checkEnabledExchanges()
         self.logger.info("Starting main event loop.")
@@ -156,17 +261,8 @@ class MarketManager(object):
             if not exchanges:
                 sleep(5)
                 continue
-            for exchange in exchanges:
-                status = self.getExchangeStatus(exchange.id)
-                should_run = self.checkExchange(exchange, status)
-                if not should_run:
-                    continue
-                task_id = fetch_exchange_data.delay(exchange.id)
-                if task_id:
-                    status.time_started = timezone.now()
-                    status.last_run_id = task_id
-                    status.running = True
-                    status.save()
+            with profile_queries("scheduler"):
+                self.scheduleExchanges(exchanges)
             msg = "Finished running through all exchanges."
             self.logger.info(msg)
             sleep(10)
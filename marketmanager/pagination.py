@@ -1,7 +1,205 @@
-from rest_framework.pagination import PageNumberPagination
+import base64
+import json
+from django.conf import settings
+from django.core.paginator import Paginator, InvalidPage, PageNotAnInteger
+from django.db import connection
+from django.utils.functional import cached_property
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+def get_estimated_count(queryset) -> int:
+    """Get the row count of the queryset estimated by the PostgreSQL planner."""
+    sql, params = queryset.order_by().query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}", params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+def encode_cursor(position: list) -> str:
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+
+def decode_cursor(cursor: str, value_types: tuple = (int, )):
+    """Decode a [value, id] cursor - None for an empty one. The value must be of one of value_types."""
+    if not cursor:
+        return None
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        position = None
+    # Booleans are ints in python but never a valid position
+    if (not isinstance(position, list) or len(position) != 2 or
+            any(isinstance(x, bool) for x in position) or
+            not isinstance(position[0], value_types) or not isinstance(position[1], int)):
+        raise ValidationError({"cursor": ["Invalid cursor"]})
+    return position
+
+
+class EstimatedCountPaginator(Paginator):
+    """Paginator which takes the count from the planner estimate instead of a COUNT(*).
+    Small results(under ESTIMATED_COUNT_THRESHOLD) are still counted exactly."""
+    estimated = False
+
+    @cached_property
+    def count(self):
+        estimate = get_estimated_count(self.object_list)
+        if estimate < settings.ESTIMATED_COUNT_THRESHOLD:
+            return super().count
+        self.estimated = True
+        return estimate
+
+    def validate_number(self, number):
+        """Allow pages past the estimated count - they are just empty."""
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger("That page number is not an integer")
+        if number < 1:
+            raise InvalidPage("That page number is less than 1")
+        return number
 
 
 class ResultsPagination(PageNumberPagination):
     page_size = 100
     page_size_query_param = 'page_size'
     max_page_size = 250
+
+
+class EstimatedCountPagination(ResultsPagination):
+    """Page number pagination with an estimated count - ?count=exact forces a COUNT(*)."""
+    count_query_param = "count"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if request.query_params.get(self.count_query_param) == "exact":
+            self.django_paginator_class = Paginator
+        else:
+            self.django_paginator_class = EstimatedCountPaginator
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        response = super().get_paginated_response(data)
+        response.data["count_estimated"] = getattr(self.page.paginator, "estimated", False)
+        return response
+
+
+class KeysetPagination(EstimatedCountPagination):
+    """Opt-in keyset(cursor) pagination on top of the page number one - enabled by the cursor param
+    (empty for the first page). The pages are ordered on (ordering field, id) and each page starts
+    right after the last row of the previous one, so deep pages cost the same as the first one.
+    Rows with a NULL ordering field aren't part of the keyset pages."""
+    cursor_query_param = "cursor"
+    ordering_query_param = "ordering"
+    # The ordering fields and the types of their cursor values
+    keyset_fields = {"volume": (int, float), "name": (str, )}
+    default_ordering = "-volume"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.cursor_query_param not in request.query_params:
+            self.keyset = False
+            return super().paginate_queryset(queryset, request, view)
+        self.keyset = True
+        self.request = request
+        self.ordering = request.query_params.get(self.ordering_query_param, self.default_ordering)
+        field = self.ordering.lstrip("-")
+        if field not in self.keyset_fields:
+            msg = f"Cursor pagination is ordered on one of: {', '.join(self.keyset_fields)}"
+            raise ValidationError({self.ordering_query_param: [msg]})
+        descending = self.ordering.startswith("-")
+        queryset = queryset.filter(**{f"{field}__isnull": False})
+        cursor = decode_cursor(request.query_params[self.cursor_query_param], self.keyset_fields[field])
+        if cursor:
+            table = queryset.model._meta.db_table
+            column = queryset.model._meta.get_field(field).column
+            operator = "<" if descending else ">"
+            # A row value comparison so the (field, id) index range starts at the cursor
+            queryset = queryset.extra(where=[f'("{table}"."{column}", "{table}"."id") {operator} (%s, %s)'],
+                                      params=cursor)
+        order = [f"-{field}", "-id"] if descending else [field, "id"]
+        page_size = self.get_page_size(request)
+        # One extra row tells if there is a next page
+        rows = list(queryset.order_by(*order)[:page_size + 1])
+        self.has_next = len(rows) > page_size
+        self.page_rows = rows[:page_size]
+        return self.page_rows
+
+    def get_cursor_columns(self, request) -> list:
+        """Get the columns the cursor of the request is read from."""
+        if self.cursor_query_param not in request.query_params:
+            return []
+        field = request.query_params.get(self.ordering_query_param, self.default_ordering).lstrip("-")
+        return [field, "id"] if field in self.keyset_fields else []
+
+    def encode_cursor(self, row) -> str:
+        return encode_cursor([getattr(row, self.ordering.lstrip("-")), row.id])
+
+    def get_next_link(self):
+        if not self.keyset:
+            return super().get_next_link()
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.page_rows[-1]))
+
+    def get_paginated_response(self, data):
+        if not self.keyset:
+            return super().get_paginated_response(data)
+        return Response({"next": self.get_next_link(), "results": data})
+
+
+class ChangeFeedPagination(BasePagination):
+    """Keyset pagination of the rows changed since the cursor, ordered on (version, id) - the version
+    is the id of the transaction which wrote the row. Only the rows written by transactions older
+    than every running one are returned, so a transaction committing later always sorts after the
+    cursors handed out before. The response always has the cursor to resume from(null before the
+    first change) - ?since= starts from the rows updated since the timestamp instead of the start."""
+    page_size = 500
+    page_size_query_param = "page_size"
+    max_page_size = 5000
+    cursor_query_param = "cursor"
+    since_query_param = "since"
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(size, 1), self.max_page_size)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        table = queryset.model._meta.db_table
+        horizon = "txid_snapshot_xmin(txid_current_snapshot())"
+        queryset = queryset.extra(where=[f'"{table}"."version" < {horizon}'])
+        self.cursor = request.query_params.get(self.cursor_query_param) or None
+        position = decode_cursor(self.cursor)
+        if position:
+            queryset = queryset.extra(where=[f'("{table}"."version", "{table}"."id") > (%s, %s)'],
+                                      params=position)
+        elif request.query_params.get(self.since_query_param):
+            since = parse_datetime(request.query_params[self.since_query_param])
+            if since is None:
+                raise ValidationError({self.since_query_param: ["Invalid timestamp"]})
+            queryset = queryset.filter(updated__gte=since)
+        page_size = self.get_page_size(request)
+        rows = list(queryset.order_by("version", "id")[:page_size + 1])
+        self.has_next = len(rows) > page_size
+        self.page_rows = rows[:page_size]
+        if self.page_rows:
+            self.cursor = encode_cursor([self.page_rows[-1].version, self.page_rows[-1].id])
+        return self.page_rows
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.cursor)
+
+    def get_paginated_response(self, data):
+        return Response({"next": self.get_next_link(), "cursor": self.cursor, "results": data})
@@ -0,0 +1,111 @@
+"""Query profiling - record the SQL count and time of logical operations(exchange runs, scheduler
+passes, API requests). Enabled with the QUERY_PROFILING setting, the recent profiles are kept in a
+ring buffer in the cache so the API, daemon and celery processes share it."""
+import asyncio
+import logging
+import time
+from contextlib import contextmanager
+from asgiref.sync import markcoroutinefunction
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.urls import resolve, Resolver404
+from django.utils import timezone
+
+PROFILE_KEY = "query_profile"
+logger = logging.getLogger("marketmanager")
+
+
+class QueryProfile:
+    """DB execute wrapper collecting the count and time of the queries of an operation."""
+    def __init__(self, operation: str, budget: int = None):
+        self.operation = operation
+        self.budget = budget
+        self.count = 0
+        self.duration = 0.0
+        self.slowest = None
+        self.slowest_duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.count += 1
+            self.duration += elapsed
+            if elapsed >= self.slowest_duration:
+                self.slowest = sql
+                self.slowest_duration = elapsed
+
+    @property
+    def over_budget(self) -> bool:
+        return self.budget is not None and self.count > self.budget
+
+    def as_dict(self) -> dict:
+        return {"operation": self.operation, "queries": self.count, "time": round(self.duration, 6),
+                "budget": self.budget, "over_budget": self.over_budget, "slowest": self.slowest,
+                "slowest_time": round(self.slowest_duration, 6), "timestamp": timezone.now().isoformat()}
+
+
+def record_profile(profile: QueryProfile):
+    """Add the profile to the ring buffer of recent profiles."""
+    profiles = cache.get(PROFILE_KEY) or []
+    profiles.append(profile.as_dict())
+    cache.set(PROFILE_KEY, profiles[-settings.QUERY_PROFILE_SIZE:], None)
+
+
+def get_recent_profiles() -> list:
+    """Get the recent query profiles - newest first."""
+    return list(reversed(cache.get(PROFILE_KEY) or []))
+
+
+@contextmanager
+def profile_queries(operation: str, budget_name: str = None):
+    """Profile the queries executed within the block as the given operation.
+    The budget is looked up in QUERY_BUDGETS by budget_name(or the operation) and exceeding it is logged."""
+    if not settings.QUERY_PROFILING:
+        yield None
+        return
+    budget = settings.QUERY_BUDGETS.get(budget_name or operation)
+    profile = QueryProfile(operation, budget)
+    try:
+        with connection.execute_wrapper(profile):
+            yield profile
+    finally:
+        if profile.over_budget:
+            logger.warning(f"Query budget exceeded for {operation}: {profile.count} queries, budget {budget}")
+        record_profile(profile)
+
+
+class QueryProfileMiddleware:
+    """Profile the queries of every API request - the view name is used as the budget name.
+    Async capable so the async(historical) views aren't run through a worker thread under ASGI."""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not settings.QUERY_PROFILING:
+            return self.get_response(request)
+        with profile_queries(f"{request.method} {request.path_info}", self.get_view_name(request)):
+            return self.get_response(request)
+
+    async def __acall__(self, request):
+        if not settings.QUERY_PROFILING:
+            return await self.get_response(request)
+        with profile_queries(f"{request.method} {request.path_info}", self.get_view_name(request)):
+            return await self.get_response(request)
+
+    @staticmethod
+    def get_view_name(request):
+        try:
+            return resolve(request.path_info).view_name
+        except Resolver404:
+            return None
@@ -0,0 +1,113 @@
+"""Record and replay raw ccxt payloads to run the ingestion pipeline offline."""
+import gzip
+import json
+import logging
+import os
+import time
+import ccxt
+from django.conf import settings
+
+logger = logging.getLogger("marketmanager")
+
+# ccxt methods used by the pipeline(camelCase and snake_case) mapped to the fixture keys
+RECORDED_METHODS = {
+    "fetchTickers": "fetch_tickers", "fetch_tickers": "fetch_tickers",
+    "fetchMarkets": "fetch_markets", "fetch_markets": "fetch_markets",
+    "fetchCurrencies": "fetch_currencies", "fetch_currencies": "fetch_currencies",
+    "fetchTicker": "fetch_ticker", "fetch_ticker": "fetch_ticker",
+}
+
+
+def get_fixture_path(directory: str, name: str) -> str:
+    return os.path.join(directory, "{}.json.gz".format(name.lower()))
+
+
+def get_record_key(method: str, args: tuple) -> str:
+    """Get the fixture key of a call - per symbol calls are recorded separately."""
+    key = RECORDED_METHODS[method]
+    if key == "fetch_ticker":
+        return "{}:{}".format(key, args[0])
+    return key
+
+
+class RecordingExchange:
+    """Wrap a ccxt exchange and save the raw responses of the pipeline calls to a fixture file."""
+    def __init__(self, exchange, directory: str):
+        self._exchange = exchange
+        self._path = get_fixture_path(directory, exchange.id)
+        self._records = {}
+
+    def __getattr__(self, attr):
+        value = getattr(self._exchange, attr)
+        if attr not in RECORDED_METHODS:
+            return value
+
+        def record(*args, **kwargs):
+            key = get_record_key(attr, args)
+            start = time.time()
+            try:
+                result = value(*args, **kwargs)
+            except ccxt.BaseError as e:
+                self._records[key] = {"error": type(e).__name__, "message": str(e),
+                                      "elapsed": time.time() - start}
+                self.save()
+                raise
+            self._records[key] = {"result": result, "elapsed": time.time() - start}
+            self.save()
+            return result
+        return record
+
+    def save(self):
+        """Save the recorded calls - the fixture is rewritten after every call."""
+        fixture = {"name": self._exchange.name, "has": self._exchange.has,
+                   "symbols": self._exchange.symbols, "records": self._records}
+        os.makedirs(os.path.dirname(self._path) or ".", exist_ok=True)
+        with gzip.open(self._path, "wt") as f:
+            json.dump(fixture, f)
+        logger.info(f"Saved ccxt fixture {self._path}")
+
+
+class ReplayExchange:
+    """Fake ccxt exchange which serves the responses of a fixture file.
+    Each call sleeps for its recorded duration multiplied by the latency factor. Only the recorded
+    methods exist on the object, so hasattr checks behave like with the recorded exchange.
+    """
+    def __init__(self, fixture: dict, latency_factor: float = 1.0):
+        self.name = fixture["name"]
+        self.has = fixture["has"]
+        self.symbols = fixture["symbols"]
+        self._records = fixture["records"]
+        self._latency_factor = latency_factor
+
+    @classmethod
+    def from_file(cls, path: str, latency_factor: float = 1.0):
+        with gzip.open(path, "rt") as f:
+            return cls(json.load(f), latency_factor)
+
+    def __getattr__(self, attr):
+        if attr not in RECORDED_METHODS:
+            raise AttributeError(attr)
+        key = RECORDED_METHODS[attr]
+        if key != "fetch_ticker" and key not in self._records:
+            raise AttributeError(attr)
+
+        def replay(*args, **kwargs):
+            record = self._records.get(get_record_key(attr, args))
+            if record is None:
+                raise ccxt.ExchangeError("No recorded response for {} {}".format(attr, args))
+            time.sleep(record.get("elapsed", 0) * self._latency_factor)
+            if "error" in record:
+                raise getattr(ccxt, record["error"], ccxt.ExchangeError)(record["message"])
+            return record["result"]
+        return replay
+
+
+def get_ccxt_exchange(name: str):
+    """Init the ccxt exchange. If configured its responses are replayed from or recorded to fixtures."""
+    if settings.CCXT_REPLAY_DIR:
+        path = get_fixture_path(settings.CCXT_REPLAY_DIR, name)
+        return ReplayExchange.from_file(path, settings.CCXT_REPLAY_LATENCY_FACTOR)
+    exchange = getattr(ccxt, name.lower())()
+    if settings.CCXT_CAPTURE_DIR:
+        return RecordingExchange(exchange, settings.CCXT_CAPTURE_DIR)
+    return exchange
@@ -0,0 +1,88 @@
+"""Resolution selection of the historical endpoints. The rollup tasks(flux/rollups_*.flux) write
+OHLC aggregates of the pairs and the fiat prices of each exchange to the aggregation bucket as
+<measurement>_<resolution>. A request is served from the finest resolution which keeps its range
+within HISTORICAL_POINT_BUDGET points - or the one passed in ?resolution=. Ranges starting before
+INFLUX_ROLLUPS_SINCE(all of them if it isn't set) are served from the raw points, the rollups don't
+cover them."""
+import re
+from datetime import datetime, timedelta, timezone as dt_timezone
+from django.conf import settings
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import ValidationError
+
+RAW = "raw"
+# Seconds per point of the rollups - the selectable ones in ascending order
+RESOLUTIONS = {"15m": 900, "1h": 3600, "1d": 86400}
+SELECTABLE = ("15m", "1h", "1d")
+RELATIVE_TIME = re.compile(r"^-(\d+)(ns|us|ms|s|m|h|d|w|mo|y)$")
+UNITS = {"ns": 1e-9, "us": 1e-6, "ms": 1e-3, "s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800,
+         "mo": 2592000, "y": 31536000}
+_models = {}
+
+
+def parse_time(value: str, now: datetime):
+    """Parse a relative duration(-30d), an ISO 8601 timestamp or a unix timestamp - None if invalid."""
+    match = RELATIVE_TIME.match(value)
+    if match:
+        return now - timedelta(seconds=int(match.group(1)) * UNITS[match.group(2)])
+    if value.isdigit():
+        return datetime.fromtimestamp(int(value), dt_timezone.utc)
+    parsed = parse_datetime(value)
+    if parsed is not None and parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=dt_timezone.utc)
+    return parsed
+
+
+def select_resolution(time_start: str, time_end: str = None, now: datetime = None) -> str:
+    """Get the finest resolution within the point budget of the range - raw if it can't be parsed or
+    starts before the rollups."""
+    now = now or datetime.now(dt_timezone.utc)
+    start = parse_time(time_start, now)
+    end = parse_time(time_end, now) if time_end else now
+    if start is None or end is None:
+        return RAW
+    if settings.INFLUX_ROLLUPS_SINCE is None or start.timestamp() < settings.INFLUX_ROLLUPS_SINCE:
+        return RAW
+    span = (end - start).total_seconds()
+    budget = settings.HISTORICAL_POINT_BUDGET
+    if span / settings.HISTORICAL_RAW_INTERVAL <= budget:
+        return RAW
+    for resolution in SELECTABLE:
+        if span / RESOLUTIONS[resolution] <= budget:
+            return resolution
+    return SELECTABLE[-1]
+
+
+def get_resolution(params) -> str:
+    """Get the resolution of the request params."""
+    resolution = params.get("resolution")
+    if resolution:
+        if resolution != RAW and resolution not in RESOLUTIONS:
+            choices = ", ".join((RAW, ) + tuple(RESOLUTIONS))
+            raise ValidationError({"resolution": [f"Must be one of: {choices}."]})
+        return resolution
+    if not params.get("time_start"):
+        return RAW
+    return select_resolution(params["time_start"], params.get("time_end"))
+
+
+def get_rollup_model(model, resolution: str):
+    """Get the model reading the rollups of the model at the resolution - with the same fields."""
+    if resolution == RAW:
+        return model
+    key = (model, resolution)
+    if key not in _models:
+        _models[key] = type(f"{model.__name__}{resolution}", (model, ), {
+            "__module__": model.__module__, "measurement": f"{model.measurement}_{resolution}",
+            "bucket": settings.INFLUX_AGGREGATION_BUCKET})
+    return _models[key]
+
+
+class RollupMixin:
+    """Serve the list from the rollups of the resolution of the request."""
+    def list(self, request, *args, **kwargs):
+        resolution = get_resolution(request.query_params)
+        self.influx_model = get_rollup_model(type(self).influx_model, resolution)
+        response = super().list(request, *args, **kwargs)
+        response["X-Resolution"] = resolution
+        return response
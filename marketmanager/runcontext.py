@@ -0,0 +1,69 @@
+"""Exchange run context - the Exchange and ExchangeStatus rows of a run loaded in a single query.
+The code of the run changes the model instances in place and the changes are written with a
+single update() per table of only the changed columns when the context is flushed."""
+from functools import partial
+from django.db import transaction
+from django.utils import timezone
+
+from api.models import Exchange, ExchangeStatus
+from marketmanager.cache import bump_versions
+
+
+def get_field_values(obj) -> dict:
+    """Get the values of the concrete fields of the model instance."""
+    return {x.attname: getattr(obj, x.attname) for x in obj._meta.concrete_fields if not x.primary_key}
+
+
+class ExchangeRunContext:
+    """Exchange and ExchangeStatus of a single exchange run."""
+    def __init__(self, exchange: Exchange, status: ExchangeStatus):
+        self.exchange = exchange
+        self.status = status
+        self.snapshot()
+
+    @classmethod
+    def from_exchange(cls, exchange: Exchange):
+        """Create the context of an exchange loaded with its status(select_related)."""
+        try:
+            status = exchange.exchangestatus
+        except ExchangeStatus.DoesNotExist:
+            status = ExchangeStatus.objects.create(exchange=exchange)
+        return cls(exchange, status)
+
+    @classmethod
+    def load(cls, exchange_id: int):
+        """Load the context of the exchange."""
+        exchange = Exchange.objects.select_related("exchangestatus").get(id=exchange_id)
+        return cls.from_exchange(exchange)
+
+    @classmethod
+    def load_many(cls, exchange_ids: list) -> list:
+        """Load the contexts of several exchanges."""
+        exchanges = Exchange.objects.select_related("exchangestatus").filter(id__in=exchange_ids)
+        return [cls.from_exchange(x) for x in exchanges]
+
+    def snapshot(self):
+        """Mark the current values as the ones stored in the DB."""
+        self._exchange_values = get_field_values(self.exchange)
+        self._status_values = get_field_values(self.status)
+
+    def get_changes(self) -> tuple:
+        """Get the changed exchange and status columns since the last flush."""
+        exchange = {k: v for k, v in get_field_values(self.exchange).items() if self._exchange_values[k] != v}
+        status = {k: v for k, v in get_field_values(self.status).items() if self._status_values[k] != v}
+        return exchange, status
+
+    def flush(self):
+        """Write the changed columns of the exchange and its status."""
+        exchange, status = self.get_changes()
+        if not exchange and not status:
+            return
+        with transaction.atomic():
+            if exchange:
+                # update() doesn't handle auto_now fields
+                self.exchange.updated = exchange["updated"] = timezone.now()
+                Exchange.objects.filter(id=self.exchange.id).update(**exchange)
+                transaction.on_commit(partial(bump_versions, "exchanges"))
+            if status:
+                ExchangeStatus.objects.filter(id=self.status.id).update(**status)
+        self.snapshot()
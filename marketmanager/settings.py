@@ -2,6 +2,7 @@
 import os
 import sys
 from django.core.exceptions import ImproperlyConfigured
+from kombu import Queue
 
 from applib.tools import get_db_details_postgres, bool_eval
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
@@ -11,12 +12,28 @@ BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 CELERYD_CONCURRENCY = 4
 CELERY_RESULT_BACKEND = 'django-db'
 CELERY_TRACK_STARTED = True
+# Task results older than the retention are pruned daily. The results of the successful fetch runs
+# can be skipped entirely(the last run outcome is kept in the ExchangeStatus)
+TASK_RESULT_RETENTION_DAYS = int(os.environ.get("TASK_RESULT_RETENTION_DAYS", 7))
+TASK_RESULT_DELETE_BATCH_SIZE = int(os.environ.get("TASK_RESULT_DELETE_BATCH_SIZE", 1000))
+TASK_RESULT_STORE_SUCCESS = bool_eval(os.environ.get("TASK_RESULT_STORE_SUCCESS", True))
 CELERYD_LOG_FORMAT = '{"timestamp":"%(asctime)s","severity":"%(levelname)s",'
 CELERYD_LOG_FORMAT += '"worker":"%(processName)s","task":"%(task_name)s",'
 CELERYD_LOG_FORMAT += ',"task_id":"%(task_id)s","message":"%(message)s"}'
 BROKER_CONNECTION_TIMEOUT = 3
 BROKER_CONNECTION_MAX_RETRIES = 5
 BROKER_POOL_LIMIT = None
+# Exchange fetch tasks are routed to a queue per priority tier. Workers started without -Q
+# consume the queues in the listed order, so higher tiers are drained first - the housekeeping
+# tasks of the default queue come last.
+CELERY_DEFAULT_QUEUE = "celery"
+CELERY_QUEUES = (
+    Queue("exchanges.high"),
+    Queue("exchanges.default"),
+    Queue("exchanges.low"),
+    Queue("celery"),
+)
+BROKER_TRANSPORT_OPTIONS = {"queue_order_strategy": "priority"}
 
 # Get the configuration for Marketmanager from environment vars or populate defaults
 ALLOWED_HOSTS = SECRET_KEY = MARKET_MANAGER_DAEMON_HOST = STORAGE_EXCHANGE_URL = CORS_ORIGIN_WHITELIST \
@@ -25,11 +42,61 @@ ALLOWED_HOSTS = SECRET_KEY = MARKET_MANAGER_DAEMON_HOST = STORAGE_EXCHANGE_URL =
 DATABASES = get_db_details_postgres()
 DEBUG = bool_eval(os.environ.get("DEBUG", False))
 
-MARKET_STALE_DAYS = os.environ.get("MARKET_STALE_DAYS", 7)
+MARKET_STALE_DAYS = int(os.environ.get("MARKET_STALE_DAYS", 7))
+MARKET_DELETE_BATCH_SIZE = int(os.environ.get("MARKET_DELETE_BATCH_SIZE", 1000))
 EXCHANGE_TIMEOUT = os.environ.get("EXCHANGE_TIMEOUT", 120)
 EXCHANGE_DEFAULT_FETCH_INTERVAL = os.environ.get("EXCHANGE_DEFAULT_FETCH_INTERVAL", 300)
 ENABLED_EXCHANGES = os.environ.get("ENABLED_EXCHANGES", "")
 FIAT_SYMBOLS = os.environ.get("FIAT_SYMBOLS", ["USD", "USDT", "USDC", "BUSD"])
+# Priority tiers (highest first) with the minimum exchange volume(USD) required for each tier.
+# Exchanges without a volume yet are placed in the default tier.
+EXCHANGE_PRIORITY_TIERS = [
+    ("high", float(os.environ.get("EXCHANGE_HIGH_TIER_VOLUME", 100000000))),
+    ("default", float(os.environ.get("EXCHANGE_DEFAULT_TIER_VOLUME", 1000000))),
+    ("low", 0),
+]
+EXCHANGE_DEFAULT_PRIORITY_TIER = "default"
+# Circuit breaker - stop dispatching exchanges after consecutive failed runs and retry them
+# after an exponential backoff(seconds)
+CIRCUIT_BREAKER_FAILURES = int(os.environ.get("CIRCUIT_BREAKER_FAILURES", 3))
+CIRCUIT_BREAKER_BACKOFF = int(os.environ.get("CIRCUIT_BREAKER_BACKOFF", 600))
+CIRCUIT_BREAKER_MAX_BACKOFF = int(os.environ.get("CIRCUIT_BREAKER_MAX_BACKOFF", 86400))
+# Batching - exchanges with up to EXCHANGE_BATCH_MAX_PAIRS pairs in their last run are packed
+# together in a single fetch task of up to EXCHANGE_BATCH_CAPACITY pairs
+EXCHANGE_BATCHING = bool_eval(os.environ.get("EXCHANGE_BATCHING", False))
+EXCHANGE_BATCH_MAX_PAIRS = int(os.environ.get("EXCHANGE_BATCH_MAX_PAIRS", 200))
+EXCHANGE_BATCH_CAPACITY = int(os.environ.get("EXCHANGE_BATCH_CAPACITY", 2000))
+EXCHANGE_BATCH_MAX_SIZE = int(os.environ.get("EXCHANGE_BATCH_MAX_SIZE", 10))
+MARKET_BULK_BATCH_SIZE = int(os.environ.get("MARKET_BULK_BATCH_SIZE", 1000))
+INFLUX_WRITE_CHUNK_SIZE = int(os.environ.get("INFLUX_WRITE_CHUNK_SIZE", 5000))
+# Record the raw ccxt responses to fixtures in CCXT_CAPTURE_DIR or replay them from CCXT_REPLAY_DIR
+# instead of calling the exchanges. Replayed calls take their recorded time times the latency factor.
+CCXT_CAPTURE_DIR = os.environ.get("CCXT_CAPTURE_DIR")
+CCXT_REPLAY_DIR = os.environ.get("CCXT_REPLAY_DIR")
+CCXT_REPLAY_LATENCY_FACTOR = float(os.environ.get("CCXT_REPLAY_LATENCY_FACTOR", 1.0))
+# Change detection - write only the markets which changed since the last run. Unchanged markets
+# are still written every CHANGE_DETECTION_HEARTBEAT seconds - it must be shorter than MARKET_STALE_DAYS
+# so the unchanged markets aren't cleaned up as stale
+CHANGE_DETECTION_ENABLED = bool_eval(os.environ.get("CHANGE_DETECTION_ENABLED", True))
+CHANGE_DETECTION_HEARTBEAT = int(os.environ.get("CHANGE_DETECTION_HEARTBEAT", 3600))
+if CHANGE_DETECTION_ENABLED and not 0 < CHANGE_DETECTION_HEARTBEAT < MARKET_STALE_DAYS * 86400:
+    raise ImproperlyConfigured("CHANGE_DETECTION_HEARTBEAT must be positive and shorter than "
+                               "MARKET_STALE_DAYS")
+# Query profiling - record the SQL count and time of exchange runs, scheduler passes and API requests.
+# The recent profiles are served by the internal/query_profile endpoint. Exceeding a budget is logged.
+QUERY_PROFILING = bool_eval(os.environ.get("QUERY_PROFILING", False))
+QUERY_PROFILE_SIZE = int(os.environ.get("QUERY_PROFILE_SIZE", 200))
+QUERY_BUDGETS = {
+    # An exchange run with up to MARKET_BULK_BATCH_SIZE pairs
+    "exchange_run": 25,
+    # Including the aggregate of the conditional GET validators
+    "api:market-list": 4,
+    "api:exchange-list": 4,
+    "api:exchangestatus-list": 3,
+    "api:market_changes-list": 1,
+    # Served from Redis - the queries are only made to rebuild an outdated snapshot
+    "api:market-snapshot": 2,
+}
 
 if ENABLED_EXCHANGES:
     ENABLED_EXCHANGES = ENABLED_EXCHANGES.split(",")
@@ -62,18 +129,57 @@ CACHES = {
         "KEY_PREFIX": "marketmanager"
     }
 }
-CACHE_TTL = 60
+# The cached API responses are invalidated by data version bumps - the TTL only bounds their lifetime
+RESPONSE_CACHE_TTL = int(os.environ.get("RESPONSE_CACHE_TTL", 3600))
+# Outdated responses are served for up to RESPONSE_CACHE_STALE_TTL while a single request rebuilds them
+RESPONSE_CACHE_STALE_TTL = int(os.environ.get("RESPONSE_CACHE_STALE_TTL", 300))
+RESPONSE_CACHE_LOCAL_SIZE = int(os.environ.get("RESPONSE_CACHE_LOCAL_SIZE", 256))
+RESPONSE_CACHE_LOCK_TTL = 10
+RESPONSE_CACHE_LOCK_WAIT = 2
+RESPONSE_CACHE_STATS_INTERVAL = 10
+# Real-time market updates(Redis pub/sub and the SSE stream of the ASGI app)
+MARKET_STREAM_ENABLED = bool_eval(os.environ.get("MARKET_STREAM_ENABLED", True))
+MARKET_STREAM_REDIS_URL = "redis://{}/1".format(REDIS_HOST)
+# Seconds between the keep-alive comments of idle streams
+MARKET_STREAM_HEARTBEAT = 15
+# Events queued per client - slower clients are disconnected
+MARKET_STREAM_QUEUE_SIZE = 100
+MARKET_STREAM_MAX_CLIENTS = int(os.environ.get("MARKET_STREAM_MAX_CLIENTS", 10000))
+# gzip level of the pre-serialized market snapshots of the exchanges
+MARKET_SNAPSHOT_COMPRESS_LEVEL = int(os.environ.get("MARKET_SNAPSHOT_COMPRESS_LEVEL", 6))
 
 INFLUX_MEASUREMENT_FIAT_MARKETS = "currencies_fiat"
 INFLUX_MEASUREMENT_PAIRS = "currency_pairs"
 INFLUX_AGGREGATION_BUCKET = "marketmanager_aggregated"
 INFLUXDB_TIMEOUT = os.environ.get("INFLUXDB_TIMEOUT", 5000)
+# Points per series a historical request may read - longer ranges are served from coarser rollups
+HISTORICAL_POINT_BUDGET = int(os.environ.get("HISTORICAL_POINT_BUDGET", 1000))
+# Seconds between the raw points of the markets(the usual exchange interval)
+HISTORICAL_RAW_INTERVAL = 300
+# Unix timestamp since which the rollup tasks run - the historical data and the candles before it are
+# read from the raw points(all of them if it isn't set)
+INFLUX_ROLLUPS_SINCE = os.environ.get("INFLUX_ROLLUPS_SINCE")
+INFLUX_ROLLUPS_SINCE = int(INFLUX_ROLLUPS_SINCE) if INFLUX_ROLLUPS_SINCE else None
+# Candles per cached chunk and seconds after which the closed chunks are cached(late points)
+CANDLE_CHUNK_SIZE = 500
+CANDLE_SETTLE = 600
+HISTORICAL_MAX_CANDLES = int(os.environ.get("HISTORICAL_MAX_CANDLES", 5000))
+# Records per chunk of the streamed(NDJSON/CSV) historical exports
+EXPORT_CHUNK_SIZE = 1000
+# The historical endpoints are served by async views with the async InfluxDB client - set by the ASGI app
+HISTORICAL_ASYNC = bool_eval(os.environ.get("HISTORICAL_ASYNC", False))
+# In-flight InfluxDB queries per ASGI process - the other requests wait for a slot
+HISTORICAL_MAX_CONCURRENCY = int(os.environ.get("HISTORICAL_MAX_CONCURRENCY", 50))
+# Seconds a request waits for a slot(503 after) and a query may run(504 after)
+HISTORICAL_QUEUE_TIMEOUT = int(os.environ.get("HISTORICAL_QUEUE_TIMEOUT", 5))
+HISTORICAL_QUERY_TIMEOUT = int(os.environ.get("HISTORICAL_QUERY_TIMEOUT", 10))
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 if "test" in sys.argv:
     # Don't cache while testing
-    CACHE_TTL = 0
+    RESPONSE_CACHE_TTL = 0
+    MARKET_STREAM_ENABLED = False
     del CACHES
     SECURE_SSL_REDIRECT = False
 
@@ -97,6 +203,8 @@ USE_X_FORWARDED_HOST = True
 USE_X_FORWARDED_PORT = True
 
 # REST framework configuration
+# Paginated results with a planner estimate above the threshold aren't counted exactly
+ESTIMATED_COUNT_THRESHOLD = int(os.environ.get("ESTIMATED_COUNT_THRESHOLD", 10000))
 REST_FRAMEWORK = {
     'DEFAULT_FILTER_BACKENDS':
         ('django_filters.rest_framework.DjangoFilterBackend',),
@@ -126,6 +234,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'corsheaders.middleware.CorsMiddleware',
+    'marketmanager.querylog.QueryProfileMiddleware',
     # 'django.contrib.auth.middleware.AuthenticationMiddleware',
     # 'django.contrib.messages.middleware.MessageMiddleware',
     # 'django.middleware.clickjacking.XFrameOptionsMiddleware',
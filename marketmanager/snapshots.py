@@ -0,0 +1,80 @@
+"""Pre-serialized snapshots of the active markets of each exchange kept in the shared cache(Redis).
+The snapshots are written by the exchange runs once their changes are committed and hold the
+gzipped JSON(and msgpack if installed) ready to be sent. Each snapshot keeps the version of the
+markets:<exchange id> scope it was built from - outdated or missing snapshots are rebuilt lazily by a
+single request(holding a short lock in Redis like the response cache) while the others serve the
+outdated snapshot or wait for the rebuilt one."""
+import gzip
+import hashlib
+import time
+from django.conf import settings
+from django.core.cache import cache
+
+from api.models import Exchange, Market
+from marketmanager.cache import VERSION_KEY, get_version
+from marketmanager.encoders import MARKET_ENCODER, render_json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+SNAPSHOT_KEY = "market_snapshot:{}"
+
+
+def build_market_snapshot(exchange_id: int) -> dict:
+    """Serialize the active markets of the exchange."""
+    # The version is read first so changes committed while building outdate the snapshot
+    version = get_version(f"markets:{exchange_id}")
+    markets = Market.objects.filter(exchange_id=exchange_id, active=True).order_by("id")
+    data = MARKET_ENCODER.encode(MARKET_ENCODER.get_rows(markets))
+    content = render_json(data)
+    return {
+        "version": version,
+        "etag": hashlib.blake2b(content, digest_size=16).hexdigest(),
+        "json": gzip.compress(content, settings.MARKET_SNAPSHOT_COMPRESS_LEVEL),
+        "msgpack": msgpack.packb(data) if msgpack else None,
+    }
+
+
+def write_market_snapshot(exchange_id: int) -> dict:
+    """Build the snapshot of the exchange and store it - until the next exchange run."""
+    snapshot = build_market_snapshot(exchange_id)
+    if snapshot["version"] is not None:
+        cache.set(SNAPSHOT_KEY.format(exchange_id), snapshot, None)
+    return snapshot
+
+
+def get_market_snapshot(exchange_id: int):
+    """Get the current snapshot of the exchange - None if the exchange doesn't exist."""
+    scope = f"markets:{exchange_id}"
+    # A single round trip for the snapshot and the version of its scope
+    values = cache.get_many([VERSION_KEY.format(scope), SNAPSHOT_KEY.format(exchange_id)])
+    version = values.get(VERSION_KEY.format(scope))
+    snapshot = values.get(SNAPSHOT_KEY.format(exchange_id))
+    if snapshot and version is not None and snapshot["version"] == version:
+        return snapshot
+    if not Exchange.objects.filter(id=exchange_id).exists():
+        return None
+    # Single flight - only the lock holder rebuilds the snapshot
+    lock_key = f"{SNAPSHOT_KEY.format(exchange_id)}:lock"
+    if cache.add(lock_key, 1, settings.RESPONSE_CACHE_LOCK_TTL):
+        try:
+            return write_market_snapshot(exchange_id)
+        finally:
+            cache.delete(lock_key)
+    if snapshot:
+        return snapshot
+    if version is not None:
+        # Another worker builds the snapshot - wait for it
+        deadline = time.monotonic() + settings.RESPONSE_CACHE_LOCK_WAIT
+        while time.monotonic() < deadline:
+            time.sleep(0.05)
+            snapshot = cache.get(SNAPSHOT_KEY.format(exchange_id))
+            if snapshot and snapshot["version"] == version:
+                return snapshot
+    return write_market_snapshot(exchange_id)
+
+
+def delete_market_snapshot(exchange_id: int):
+    cache.delete(SNAPSHOT_KEY.format(exchange_id))
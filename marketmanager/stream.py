@@ -0,0 +1,197 @@
+"""Real-time market updates over Server-Sent Events. The exchange runs publish the changed markets of
+the exchange to Redis pub/sub once their transaction commits. Each ASGI process keeps a single
+subscription(in a thread) and fans the updates out to its clients, which are plain coroutines -
+idle connections cost no worker."""
+import asyncio
+import json
+import logging
+import threading
+import time
+from urllib.parse import parse_qs
+import redis
+from django.conf import settings
+
+CHANNEL = "market_updates:{}"
+# Longest wait(in seconds) between the resubscriptions of a failing listener
+MAX_BACKOFF = 30
+# The columns of the markets of an update message
+FIELDS = ("name", "base", "quote", "last", "bid", "ask", "volume")
+
+logger = logging.getLogger("marketmanager")
+_redis = None
+
+
+def get_redis():
+    global _redis
+    if _redis is None:
+        _redis = redis.Redis.from_url(settings.MARKET_STREAM_REDIS_URL)
+    return _redis
+
+
+def build_update(exchange_id: int, markets: dict) -> bytes:
+    """Build the update message of the changed markets(name: data) of the exchange."""
+    rows = [[name] + [data.get(x) for x in FIELDS[1:]] for name, data in markets.items()]
+    return encode_update({"exchange": exchange_id, "fields": FIELDS, "markets": rows})
+
+
+def encode_update(update: dict) -> bytes:
+    return json.dumps(update, separators=(",", ":")).encode()
+
+
+def publish_update(exchange_id: int, message: bytes):
+    """Publish the update - the stream is best effort, the runs don't fail with it."""
+    try:
+        get_redis().publish(CHANNEL.format(exchange_id), message)
+    except redis.RedisError as e:
+        logger.warning(f"Couldn't publish the market update of exchange {exchange_id}: {e}")
+
+
+class Subscriber:
+    """A stream client with its filters - the markets of the exchange and/or with the base/quote."""
+    def __init__(self, exchange: int = None, base: str = None, quote: str = None):
+        self.exchange = exchange
+        self.base = base
+        self.quote = quote
+        self.queue = asyncio.Queue(settings.MARKET_STREAM_QUEUE_SIZE)
+
+    @property
+    def key(self) -> tuple:
+        return (self.base, self.quote)
+
+    def filter(self, update: dict):
+        """Get the update limited to the markets of the subscriber - None if there are none."""
+        if self.exchange is not None and update["exchange"] != self.exchange:
+            return None
+        if self.base is None and self.quote is None:
+            return update
+        markets = [x for x in update["markets"] if (self.base is None or x[1] == self.base)
+                   and (self.quote is None or x[2] == self.quote)]
+        return dict(update, markets=markets) if markets else None
+
+    def close(self):
+        """Stop the client - the queued events are dropped."""
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(None)
+
+    def put(self, event: bytes) -> bool:
+        """Queue the event - False if the client doesn't keep up."""
+        try:
+            self.queue.put_nowait(event)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+
+class MarketUpdateHub:
+    """The subscribed clients of the process and the Redis subscription feeding them."""
+    def __init__(self):
+        self.subscribers = set()
+        self.loop = None
+        self.thread = None
+
+    def subscribe(self, subscriber: Subscriber):
+        if self.thread is None or not self.thread.is_alive():
+            self.loop = asyncio.get_running_loop()
+            self.thread = threading.Thread(target=self.listen, name="market-stream", daemon=True)
+            self.thread.start()
+        self.subscribers.add(subscriber)
+
+    def unsubscribe(self, subscriber: Subscriber):
+        self.subscribers.discard(subscriber)
+
+    def listen(self):
+        """Pass the published updates to the event loop - resubscribes after any error with an
+        exponential backoff and stops with the event loop."""
+        delay = 1
+        while not self.loop.is_closed():
+            pubsub = None
+            try:
+                pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(CHANNEL.format("*"))
+                for message in pubsub.listen():
+                    self.loop.call_soon_threadsafe(self.dispatch, message["data"])
+                    delay = 1
+            except redis.RedisError as e:
+                logger.warning(f"Market stream subscription failed: {e}")
+            except Exception:
+                logger.exception("Market stream listener failed")
+            finally:
+                if pubsub is not None:
+                    try:
+                        pubsub.close()
+                    except Exception:
+                        pass
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_BACKOFF)
+
+    def dispatch(self, data: bytes):
+        """Send the update to the subscribers - encoded once per distinct filter."""
+        update = json.loads(data)
+        events = {}
+        for subscriber in list(self.subscribers):
+            key = (subscriber.exchange, subscriber.key)
+            if key not in events:
+                filtered = subscriber.filter(update)
+                if filtered is None:
+                    events[key] = None
+                else:
+                    # The unfiltered updates are sent as published
+                    body = data if filtered is update else encode_update(filtered)
+                    events[key] = b"event: markets\ndata: " + body + b"\n\n"
+            if events[key] and not subscriber.put(events[key]):
+                # Slow clients are disconnected - they resync from the change feed
+                self.unsubscribe(subscriber)
+                subscriber.close()
+
+
+hub = MarketUpdateHub()
+
+
+async def send_response(send, status: int, body: bytes):
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", b"application/json")]})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def wait_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+async def market_stream(scope, receive, send):
+    """ASGI app streaming the market updates - ?exchange=, ?base= and ?quote= filter them."""
+    if scope["method"] != "GET":
+        return await send_response(send, 405, b'{"detail":"Method not allowed."}')
+    params = {k: v[-1] for k, v in parse_qs(scope["query_string"].decode()).items()}
+    exchange = params.get("exchange")
+    if exchange is not None and not exchange.isdigit():
+        return await send_response(send, 400, b'{"exchange":["A valid integer is required."]}')
+    if len(hub.subscribers) >= settings.MARKET_STREAM_MAX_CLIENTS:
+        return await send_response(send, 503, b'{"detail":"Too many stream clients."}')
+    subscriber = Subscriber(int(exchange) if exchange else None, params.get("base"), params.get("quote"))
+    await send({"type": "http.response.start", "status": 200, "headers": [
+        (b"content-type", b"text/event-stream"), (b"cache-control", b"no-cache"),
+        (b"x-accel-buffering", b"no")]})
+    hub.subscribe(subscriber)
+    disconnect = asyncio.ensure_future(wait_disconnect(receive))
+    try:
+        await send({"type": "http.response.body", "body": b": connected\n\n", "more_body": True})
+        while not disconnect.done():
+            event = asyncio.ensure_future(subscriber.queue.get())
+            done, _ = await asyncio.wait({event, disconnect}, timeout=settings.MARKET_STREAM_HEARTBEAT,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if event not in done:
+                event.cancel()
+                if not disconnect.done():
+                    # Keeps the proxies from closing idle connections
+                    await send({"type": "http.response.body", "body": b": ping\n\n", "more_body": True})
+                continue
+            if event.result() is None:
+                break
+            await send({"type": "http.response.body", "body": event.result(), "more_body": True})
+        if not disconnect.done():
+            await send({"type": "http.response.body", "body": b""})
+    finally:
+        hub.unsubscribe(subscriber)
+        disconnect.cancel()
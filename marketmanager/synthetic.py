@@ -0,0 +1,65 @@
+"""Synthetic exchange payloads for profiling and benchmarks."""
+import random
+import time
+from django.db import connection
+
+from api.models import Exchange
+
+QUOTES = ["USDT", "BTC", "ETH", "BNB", "USD"]
+SEED_MARKETS_SQL = """
+INSERT INTO markets (name, base, quote, exchange_id, volume, last, bid, ask, open, close, high, low,
+                     updated, active)
+SELECT 'C' || i || '-' || quotes.quote, 'C' || i, quotes.quote, %(first_exchange)s + i %% %(exchanges)s,
+       random() * 1000000, random() * 100, random() * 100, random() * 100, 0, 0, 0, 0,
+       now() - random() * interval '14 days', random() > 0.05
+FROM generate_series(0, %(markets)s / 4 - 1) AS i,
+     (VALUES ('BTC'), ('ETH'), ('USDT'), ('BNB')) AS quotes(quote)
+"""
+
+
+def generate_ticker(symbol: str, last: float, timestamp: int, rng: random.Random) -> dict:
+    """Generate a ticker in the ccxt unified format(including the raw exchange info)."""
+    spread = last * 0.001
+    volume = rng.uniform(0, 100000)
+    ticker = {
+        "symbol": symbol, "timestamp": timestamp, "datetime": None,
+        "high": last * 1.05, "low": last * 0.95, "bid": last - spread, "bidVolume": None,
+        "ask": last + spread, "askVolume": None, "vwap": last, "open": last * 0.99, "close": last,
+        "last": last, "previousClose": None, "change": last * 0.01, "percentage": 1.0,
+        "average": last, "baseVolume": volume, "quoteVolume": volume * last,
+    }
+    # Exchanges send the raw ticker as strings - it's usually the bulk of the payload
+    ticker["info"] = {key: str(value) for key, value in ticker.items()}
+    return ticker
+
+
+def generate_tickers(pairs: int, seed: int = 0) -> dict:
+    """Generate a fetchTickers payload with the given number of pairs.
+    The crypto quotes have fiat pairs so the fiat prices can be resolved from the payload alone.
+    """
+    rng = random.Random(seed)
+    timestamp = int(time.time() * 1000)
+    tickers = {}
+    for quote in ("BTC", "ETH", "BNB"):
+        symbol = f"{quote}/USDT"
+        tickers[symbol] = generate_ticker(symbol, rng.uniform(100, 50000), timestamp, rng)
+    index = 0
+    while len(tickers) < pairs:
+        symbol = f"C{index:06d}/{QUOTES[index % len(QUOTES)]}"
+        tickers[symbol] = generate_ticker(symbol, rng.uniform(0.0001, 100), timestamp, rng)
+        index += 1
+    return tickers
+
+
+def seed_markets(markets: int, exchanges: int) -> list:
+    """Seed exchanges and markets for query benchmarks - the markets are generated in the DB.
+    Returns the ids of the seeded exchanges."""
+    objects = Exchange.objects.bulk_create([
+        Exchange(name=f"synthetic-{i}", interval=300, enabled=i % 10 != 0) for i in range(exchanges)])
+    ids = sorted(x.id for x in objects)
+    with connection.cursor() as cursor:
+        params = {"first_exchange": ids[0], "exchanges": exchanges, "markets": markets}
+        cursor.execute(SEED_MARKETS_SQL, params)
+        cursor.execute("ANALYZE markets")
+        cursor.execute("ANALYZE exchanges")
+    return ids
@@ -0,0 +1,104 @@
+from unittest.mock import patch
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from rest_framework.test import APIClient
+
+from api.models import Exchange, Market
+from marketmanager.cache import get_version, bump_market_versions, get_cache_stats, local_cache
+from marketmanager.updaters import ExchangeUpdater
+
+
+@override_settings(RESPONSE_CACHE_TTL=60, RESPONSE_CACHE_STATS_INTERVAL=0)
+class TestVersionedCache(TestCase):
+    def setUp(self):
+        cache.clear()
+        local_cache.clear()
+        self.client = APIClient()
+        self.exchanges = [Exchange.objects.create(name=name, interval=300) for name in ("Binance", "Bittrex")]
+        for exchange in self.exchanges:
+            Market.objects.create(name="ETH-BTC", base="ETH", quote="BTC", exchange=exchange,
+                                  volume=10, last=0.07, bid=0.07, ask=0.07)
+
+    def get_markets(self, query=""):
+        return self.client.get(reverse("api:market-list") + query).json()
+
+    def update_markets(self, exchange, last):
+        data = {"ETH-BTC": {"base": "ETH", "quote": "BTC", "last": last, "bid": last, "ask": last,
+                            "volume": 10, "exchange_id": exchange.id}}
+        with self.captureOnCommitCallbacks(execute=True):
+            ExchangeUpdater(exchange.id, data).update_existing_markets()
+
+    def test_bump(self):
+        version = get_version("markets")
+        bump_market_versions(1)
+        self.assertEqual(get_version("markets"), version + 1)
+
+    def test_hit_until_changed(self):
+        """The responses must be served from the cache until the markets change"""
+        self.get_markets()
+        Market.objects.update(last=1)
+        self.assertEqual(self.get_markets()["results"][0]["last"], 0.07)
+        self.update_markets(self.exchanges[0], 0.08)
+        lasts = {x["exchange"]: x["last"] for x in self.get_markets()["results"]}
+        self.assertEqual(lasts[self.exchanges[0].id], 0.08)
+        stats = get_cache_stats(["markets"])["markets"]
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 2))
+        self.assertAlmostEqual(stats["hit_ratio"], 1 / 3)
+
+    def test_exchange_scope(self):
+        """Markets filtered on an exchange aren't invalidated by the changes of other exchanges"""
+        query = f"?exchange={self.exchanges[1].id}"
+        self.get_markets(query)
+        self.update_markets(self.exchanges[0], 0.08)
+        self.get_markets(query)
+        self.assertEqual(get_cache_stats(["markets"])["markets"]["hits"], 1)
+
+    def test_fields_key(self):
+        """Sparse fieldsets share the entries regardless of the order of the fields"""
+        self.get_markets("?fields=name,last")
+        self.assertEqual(set(self.get_markets("?fields=last,%20name")["results"][0]), {"name", "last"})
+        self.assertEqual(set(self.get_markets("?fields=name")["results"][0]), {"name"})
+        stats = get_cache_stats(["markets"])["markets"]
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 2))
+
+    def test_unchanged_run(self):
+        """A run without market changes must not invalidate the cache"""
+        version = get_version("markets")
+        with self.captureOnCommitCallbacks(execute=True):
+            ExchangeUpdater(self.exchanges[0].id, {"ETH-BTC": {}}, changed=set()).update_existing_markets()
+        self.assertEqual(get_version("markets"), version)
+
+    def test_exchange_saved(self):
+        version = get_version("exchanges")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.exchanges[0].save()
+        self.assertEqual(get_version("exchanges"), version + 1)
+
+    def test_tiers(self):
+        self.get_markets()
+        self.get_markets()
+        local_cache.clear()
+        self.get_markets()
+        tiers = get_cache_stats(["markets"])["markets"]["tiers"]
+        self.assertEqual([tiers[x]["count"] for x in ("miss", "local", "redis")], [1, 1, 1])
+        self.assertIsNotNone(tiers["local"]["avg_ms"])
+
+    def test_stale_while_revalidate(self):
+        """While another worker rebuilds an outdated entry the stale one must be served"""
+        self.get_markets()
+        self.update_markets(self.exchanges[0], 0.08)
+        with patch.object(cache, "add", return_value=False):
+            lasts = [x["last"] for x in self.get_markets()["results"]]
+        self.assertEqual(lasts, [0.07, 0.07])
+        self.assertEqual(get_cache_stats(["markets"])["markets"]["tiers"]["stale"]["count"], 1)
+        # The lock holder rebuilds the entry
+        self.assertIn(0.08, [x["last"] for x in self.get_markets()["results"]])
+
+    def test_cache_unavailable(self):
+        """The local tier must be served if the shared cache is unavailable"""
+        self.get_markets()
+        Market.objects.update(last=1)
+        with patch.object(cache, "get", return_value=None), patch.object(cache, "add", return_value=False):
+            lasts = [x["last"] for x in self.get_markets()["results"]]
+        self.assertEqual(lasts, [0.07, 0.07])
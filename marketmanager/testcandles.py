@@ -0,0 +1,92 @@
+from datetime import datetime, timezone
+from unittest.mock import patch
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from rest_framework.test import APIClient
+
+from marketmanager import candles
+
+HOUR = 3600
+# 2022-01-01 00:00 UTC
+T0 = 1640995200
+
+
+def fake_rows(start: int, count: int) -> list:
+    return [(start + i * HOUR, 1.0, 2.0, 0.5, 1.5, 10.0) for i in range(count)]
+
+
+@override_settings(CANDLE_CHUNK_SIZE=2, INFLUX_ROLLUPS_SINCE=None)
+class TestCandles(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    @patch("marketmanager.candles.query_candles")
+    def test_closed_chunks_cached(self, mock_query):
+        """The closed chunks must be queried once - at once if consecutive"""
+        mock_query.return_value = fake_rows(T0, 4)
+        output = candles.get_candles("BTC", "USDT", None, T0 + HOUR, T0 + 4 * HOUR, HOUR)
+        self.assertEqual(output["t"], [T0 + HOUR, T0 + 2 * HOUR, T0 + 3 * HOUR])
+        self.assertEqual(output["v"], [10.0] * 3)
+        self.assertEqual(mock_query.call_count, 1)
+        self.assertEqual(candles.get_candles("BTC", "USDT", None, T0, T0 + 4 * HOUR, HOUR)["t"],
+                         [x[0] for x in fake_rows(T0, 4)])
+        self.assertEqual(mock_query.call_count, 1)
+        # Other exchanges don't share the candles
+        candles.get_candles("BTC", "USDT", "1", T0, T0 + 4 * HOUR, HOUR)
+        self.assertEqual(mock_query.call_count, 2)
+
+    @patch("marketmanager.candles.query_candles")
+    def test_open_chunk(self, mock_query):
+        now = int(datetime.now(timezone.utc).timestamp()) // HOUR * HOUR
+        mock_query.return_value = fake_rows(now - HOUR, 2)
+        candles.get_candles("BTC", "USDT", None, now - HOUR, now + HOUR, HOUR)
+        candles.get_candles("BTC", "USDT", None, now - HOUR, now + HOUR, HOUR)
+        self.assertEqual(mock_query.call_count, 2)
+
+    def test_source(self):
+        now = T0 + 365 * 86400
+        self.assertEqual(candles.get_source(4 * HOUR, T0, T0 + HOUR, now), "raw")
+        with self.settings(INFLUX_ROLLUPS_SINCE=T0):
+            self.assertEqual(candles.get_source(4 * HOUR, T0, T0 + HOUR, now), "1h")
+            self.assertEqual(candles.get_source(86400, T0, T0 + HOUR, now), "1d")
+            self.assertEqual(candles.get_source(300, T0, T0 + HOUR, now), "raw")
+            self.assertEqual(candles.get_source(4 * HOUR, T0 - 86400, T0 + HOUR, now), "raw")
+            # The last closed windows aren't rolled up yet
+            self.assertEqual(candles.get_source(4 * HOUR, now - 2 * HOUR, now - HOUR, now), "15m")
+
+    def test_flux(self):
+        flux = candles.build_candle_flux("BTC", "USDT", "1", T0, T0 + HOUR, 900, "raw")
+        self.assertIn('r._measurement == "currency_pairs"', flux)
+        self.assertIn('r["exchange_id"] == "1"', flux)
+        self.assertIn('price(field: "last", fn: max, name: "high")', flux)
+        self.assertIn("every: 900s", flux)
+        flux = candles.build_candle_flux("BTC", "USDT", None, T0, T0 + HOUR, 3600, "15m")
+        self.assertIn('r._measurement == "currency_pairs_15m"', flux)
+        self.assertIn('price(field: "high", fn: max, name: "high")', flux)
+
+
+class TestCandlesView(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.url = reverse("api:historical_candles-list")
+
+    @patch("marketmanager.candles.query_candles")
+    def test_columns(self, mock_query):
+        cache.clear()
+        mock_query.return_value = fake_rows(T0, 2)
+        response = self.client.get(self.url, {"base": "BTC", "quote": "USDT", "interval": "1h",
+                                              "time_start": "2022-01-01T00:00:00",
+                                              "time_end": "2022-01-01T02:00:00"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"interval": "1h", "t": [T0, T0 + HOUR], "o": [1.0, 1.0],
+                                           "h": [2.0, 2.0], "l": [0.5, 0.5], "c": [1.5, 1.5],
+                                           "v": [10.0, 10.0]})
+
+    @override_settings(HISTORICAL_MAX_CANDLES=100)
+    def test_invalid(self):
+        params = {"base": "BTC", "quote": "USDT", "interval": "1h", "time_start": "-1d"}
+        for invalid in ({"interval": "1s"}, {"interval": "2y"}, {"time_start": "x"}, {"exchange_id": "x"},
+                        {"time_start": "-1y"}, {"base": ""}):
+            response = self.client.get(self.url, dict(params, **invalid))
+            self.assertEqual(response.status_code, 400, invalid)
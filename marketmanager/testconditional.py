@@ -0,0 +1,79 @@
+from datetime import timedelta
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from api.models import Exchange, Market
+from api.tasks import clear_stale_markets
+
+
+class TestConditionalGet(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.exchanges = [Exchange.objects.create(name=name, interval=300, last_data_fetch=timezone.now())
+                          for name in ("Binance", "Bittrex")]
+        for exchange in self.exchanges:
+            Market.objects.create(name="ETH-BTC", base="ETH", quote="BTC", exchange=exchange,
+                                  volume=10, last=0.07, bid=0.07, ask=0.07)
+        self.url = reverse("api:market-list") + f"?exchange={self.exchanges[0].id}"
+
+    def fetch(self, exchange):
+        """Simulate a run of the exchange"""
+        Exchange.objects.filter(id=exchange.id).update(last_data_fetch=timezone.now() + timedelta(seconds=5))
+
+    def test_not_modified(self):
+        """The polls must get a 304 without any market query"""
+        response = self.client.get(self.url)
+        self.assertTrue(response.has_header("Last-Modified"))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('"markets"', queries[0]["sql"])
+
+    def test_exchange_fetched(self):
+        etag = self.client.get(self.url)["ETag"]
+        self.fetch(self.exchanges[1])
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.fetch(self.exchanges[0])
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_params(self):
+        """The validators must depend on the params of the request"""
+        etag = self.client.get(self.url)["ETag"]
+        response = self.client.get(self.url + "&fields=name", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_if_modified_since(self):
+        last_modified = self.client.get(self.url)["Last-Modified"]
+        response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+        self.fetch(self.exchanges[0])
+        response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 200)
+
+    def test_filtered_exchanges(self):
+        url = reverse("api:exchange-list") + f"?name={self.exchanges[0].name}"
+        etag = self.client.get(url)["ETag"]
+        self.fetch(self.exchanges[1])
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        Exchange.objects.filter(id=self.exchanges[0].id).update(enabled=False, updated=timezone.now())
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_stale_markets_deleted(self):
+        """Clearing the stale markets of the exchange must change the validators"""
+        stale = Market.objects.create(name="XRP-BTC", base="XRP", quote="BTC", exchange=self.exchanges[0],
+                                      volume=1, last=1, bid=1, ask=1)
+        etag = self.client.get(self.url)["ETag"]
+        Market.objects.filter(id=stale.id).update(updated=timezone.now() - timedelta(days=365))
+        clear_stale_markets()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([x["name"] for x in response.json()["results"]], ["ETH-BTC"])
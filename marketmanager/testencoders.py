@@ -0,0 +1,79 @@
+from unittest.mock import patch
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.mixins import ListModelMixin
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+from api import serializers, views
+from api.models import Exchange, ExchangeStatus, Market
+from marketmanager.encoders import EXCHANGE_ENCODER, EXCHANGE_STATUS_ENCODER, MARKET_ENCODER, render_json
+
+ENCODERS = (
+    (Market, serializers.MarketSerializer, MARKET_ENCODER),
+    (Exchange, serializers.ExchangeSerializer, EXCHANGE_ENCODER),
+    (ExchangeStatus, serializers.ExchangeStatusSerializer, EXCHANGE_STATUS_ENCODER),
+)
+
+
+class TestRowEncoders(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        binance = Exchange.objects.create(name="Binance", interval=300, volume=1e-08, top_pair="ETH-BTC",
+                                          url="https://binance.com", last_data_fetch=timezone.now(),
+                                          priority_tier="high")
+        bittrex = Exchange.objects.create(name="Bittrex ", interval=60)
+        ExchangeStatus.objects.create(exchange=binance, last_run=timezone.now(), last_run_status="Ünïcode")
+        ExchangeStatus.objects.create(exchange=bittrex, running=True, circuit_state="open")
+        for i, exchange in enumerate((binance, bittrex)):
+            Market.objects.create(name="ETH-BTC", base="ETH", quote="BTC", exchange=exchange,
+                                  volume=1234567.891 * i or None, last=0.1 + 0.2, bid=1e16, ask=3)
+
+    def test_fields(self):
+        """The encoders must follow the fields of their serializers"""
+        for model, serializer, encoder in ENCODERS:
+            self.assertEqual([x[0] for x in encoder.fields], list(serializer.Meta.fields))
+
+    def test_serializer_output(self):
+        for model, serializer, encoder in ENCODERS:
+            queryset = model.objects.order_by("id")
+            expected = JSONRenderer().render(serializer(queryset, many=True).data)
+            rows = encoder.encode(encoder.get_rows(queryset))
+            self.assertEqual(render_json(rows), expected)
+            self.assertEqual(JSONRenderer().render(rows), expected)
+
+    def test_list_responses(self):
+        """The list endpoints must return the same bytes as the serializers"""
+        urls = [reverse("api:market-list") + "?ordering=-volume", reverse("api:market-list") + "?cursor=",
+                reverse("api:exchange-list"), reverse("api:exchangestatus-list")]
+        for url in urls:
+            content = self.client.get(url).content
+            with patch.object(views.FastListMixin, "list", ListModelMixin.list):
+                self.assertEqual(content, self.client.get(url).content, url)
+
+    def test_sparse_fields(self):
+        """Only the selected fields must be serialized and selected"""
+        url = reverse("api:market-list") + "?fields=volume,name"
+        with CaptureQueriesContext(connection) as queries:
+            results = self.client.get(url).json()["results"]
+        self.assertEqual([list(x) for x in results], [["name", "volume"]] * 2)
+        select = queries[-1]["sql"].split(" FROM ")[0]
+        self.assertNotIn('"bid"', select)
+        self.assertNotIn('"exchange_id"', select)
+        response = self.client.get(reverse("api:exchange-list") + "?fields=name,foo")
+        self.assertEqual(response.status_code, 400)
+
+    def test_sparse_fields_cursor(self):
+        """The cursor pages must work without the ordering field in the output"""
+        Market.objects.create(name="XRP-BTC", base="XRP", quote="BTC", exchange=Exchange.objects.first(),
+                              volume=5, last=1, bid=1, ask=1)
+        url = reverse("api:market-list") + "?fields=name&ordering=-volume&page_size=1&cursor="
+        names = []
+        while url:
+            response = self.client.get(url).json()
+            names += [x["name"] for x in response["results"]]
+            url = response["next"]
+        self.assertEqual(names, ["ETH-BTC", "XRP-BTC"])
@@ -0,0 +1,161 @@
+import asyncio
+import json
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from rest_framework.test import APIClient
+
+from api import views
+from marketmanager import exports, historical
+
+T0 = datetime(2022, 1, 1, tzinfo=timezone.utc)
+
+
+class FakeRecord:
+    def __init__(self, i: int):
+        self.values = {"result": "_result", "table": 0, "_time": T0 + timedelta(minutes=5 * i),
+                       "base": "BTC", "quote": "USDT", "last": 47000.0 + i}
+
+
+def fake_records(count: int):
+    return (FakeRecord(i) for i in range(count))
+
+
+class FakeQueryApi:
+    async def query_stream(self, flux):
+        async def records():
+            for record in fake_records(3):
+                yield record
+        return records()
+
+
+class SlowQueryApi:
+    """Fake async query API sending a record every 50ms - tracks if the stream was closed."""
+    def __init__(self):
+        self.closed = False
+
+    async def query_stream(self, flux):
+        async def records():
+            try:
+                for record in fake_records(100):
+                    await asyncio.sleep(0.05)
+                    yield record
+            finally:
+                self.closed = True
+        return records()
+
+
+class FakeClient:
+    def __init__(self, query_api=None):
+        self.api = query_api or FakeQueryApi()
+
+    def query_api(self):
+        return self.api
+
+
+@override_settings(EXPORT_CHUNK_SIZE=2)
+class TestExportWriter(SimpleTestCase):
+    def test_ndjson(self):
+        chunks = list(exports.iter_export(fake_records(3), exports.ExportWriter("ndjson")))
+        self.assertEqual(len(chunks), 2)
+        lines = b"".join(chunks).decode().splitlines()
+        self.assertEqual(json.loads(lines[2]),
+                         {"_time": "2022-01-01T00:10:00Z", "base": "BTC", "quote": "USDT", "last": 47002.0})
+
+    def test_csv(self):
+        output = b"".join(exports.iter_export(fake_records(3), exports.ExportWriter("csv"))).decode()
+        self.assertEqual(output.splitlines(), [
+            "_time,base,quote,last", "2022-01-01T00:00:00Z,BTC,USDT,47000.0",
+            "2022-01-01T00:05:00Z,BTC,USDT,47001.0", "2022-01-01T00:10:00Z,BTC,USDT,47002.0"])
+
+    def test_lazy(self):
+        """The records must be consumed chunk by chunk"""
+        records = fake_records(5)
+        chunks = exports.iter_export(records, exports.ExportWriter("ndjson"))
+        next(chunks)
+        self.assertEqual(len(list(records)), 3)
+
+
+class TestExportView(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.url = reverse("api:historical_markets-list")
+        self.params = {"base": "BTC", "quote": "USDT", "time_start": "-1h"}
+
+    @patch("django_influxdb.influxdb.Client")
+    def test_stream(self, mock_client):
+        query_stream = mock_client.return_value.client.query_api.return_value.query_stream
+        query_stream.return_value = fake_records(3)
+        response = self.client.get(self.url, dict(self.params, stream="ndjson"))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        self.assertEqual(response["X-Resolution"], "raw")
+        self.assertEqual(len(b"".join(response.streaming_content).splitlines()), 3)
+        self.assertIn('r["base"] == "BTC"', query_stream.call_args[0][0])
+
+    def test_invalid(self):
+        self.assertEqual(self.client.get(self.url, dict(self.params, stream="xml")).status_code, 400)
+        self.assertEqual(self.client.get(self.url, {"base": "BTC", "stream": "csv"}).status_code, 400)
+
+
+class TestAsgiExport(SimpleTestCase):
+    def run_export(self, path: str, query: bytes, client: FakeClient = None, disconnect: bool = False):
+        """Run the export - the client disconnects after the first body chunk if disconnect is passed.
+        Returns the sent messages and the slots left free."""
+        async def run():
+            sent = []
+            body_sent = asyncio.Event()
+
+            async def send(message):
+                sent.append(message)
+                if message.get("body"):
+                    body_sent.set()
+
+            async def receive():
+                if not disconnect:
+                    await asyncio.Event().wait()
+                await body_sent.wait()
+                return {"type": "http.disconnect"}
+            queries = historical.HistoricalQueries()
+            queries.setup = lambda: None
+            queries.client = client or FakeClient()
+            queries.semaphore = asyncio.Semaphore(1)
+            with patch.object(exports, "queries", queries):
+                view = exports.get_export_view({"type": "http", "path": path, "query_string": query})
+                await exports.historical_export({"type": "http", "method": "GET", "query_string": query},
+                                                receive, send, *view)
+            return sent, queries.semaphore._value
+        return asyncio.run(run())
+
+    def test_routes(self):
+        view = exports.get_export_view({"type": "http", "path": "/historical/fiat/exchange/3/",
+                                        "query_string": b"stream=csv"})
+        self.assertEqual(view, (views.ExchangeFiatHistoricalData, {"exchange_id": "3"}))
+        self.assertIsNone(exports.get_export_view({"type": "http", "path": "/historical/markets/",
+                                                   "query_string": b"upstream=csv"}))
+
+    def test_stream(self):
+        sent, free = self.run_export("/historical/markets/", b"base=BTC&quote=USDT&time_start=-1h&stream=csv")
+        self.assertEqual(sent[0]["status"], 200)
+        self.assertIn((b"content-type", b"text/csv"), sent[0]["headers"])
+        self.assertEqual(len(b"".join(x.get("body", b"") for x in sent).splitlines()), 4)
+        self.assertFalse(sent[-1].get("more_body", False))
+        self.assertEqual(free, 1)
+
+    def test_invalid(self):
+        sent, _ = self.run_export("/historical/markets/", b"base=BTC&stream=csv")
+        self.assertEqual(sent[0]["status"], 400)
+
+    @override_settings(EXPORT_CHUNK_SIZE=2)
+    def test_disconnect(self):
+        """The query must be cancelled and its slot released once the client disconnects"""
+        query_api = SlowQueryApi()
+        sent, free = self.run_export("/historical/markets/", b"base=BTC&quote=USDT&time_start=-1h&stream=csv",
+                                     FakeClient(query_api), disconnect=True)
+        self.assertEqual(sent[0]["status"], 200)
+        self.assertTrue(sent[-1]["more_body"])
+        self.assertLess(len(b"".join(x.get("body", b"") for x in sent).splitlines()), 101)
+        self.assertTrue(query_api.closed)
+        self.assertEqual(free, 1)
@@ -0,0 +1,51 @@
+import unittest
+from django.core.cache import cache
+from django.test import override_settings
+
+from marketmanager.fingerprints import MarketFingerprints
+
+
+class TestMarketFingerprints(unittest.TestCase):
+    def setUp(self):
+        self.exchange_id = 1
+        self.data = {"ETH-BTC": {"base": "ETH", "quote": "BTC", "last": 0.07, "bid": 0.069, "ask": 0.071,
+                                 "volume": 50, "exchange_id": self.exchange_id},
+                     "LTC-BTC": {"base": "LTC", "quote": "BTC", "last": 0.003, "bid": 0.0029, "ask": 0.0031,
+                                 "volume": 10, "exchange_id": self.exchange_id}}
+
+    def tearDown(self):
+        cache.delete(MarketFingerprints(self.exchange_id).key)
+
+    def run_detection(self, data):
+        fingerprints = MarketFingerprints(self.exchange_id)
+        changed = fingerprints.detect(data)
+        fingerprints.save()
+        return fingerprints, changed
+
+    def test_first_run(self):
+        """Without previous fingerprints all markets are changed"""
+        fingerprints, changed = self.run_detection(self.data)
+        self.assertEqual(changed, set(self.data))
+        self.assertEqual(fingerprints.reduction, 0)
+
+    def test_unchanged(self):
+        """Only the changed markets must be detected"""
+        self.run_detection(self.data)
+        self.data["ETH-BTC"]["last"] = 0.08
+        fingerprints, changed = self.run_detection(self.data)
+        self.assertEqual(changed, {"ETH-BTC"})
+        self.assertEqual(fingerprints.reduction, 0.5)
+
+    def test_not_saved(self):
+        """Without saving the fingerprints the markets must be detected as changed again"""
+        fingerprints = MarketFingerprints(self.exchange_id)
+        fingerprints.detect(self.data)
+        _, changed = self.run_detection(self.data)
+        self.assertEqual(changed, set(self.data))
+
+    @override_settings(CHANGE_DETECTION_HEARTBEAT=-1)
+    def test_heartbeat(self):
+        """Markets which weren't written within the heartbeat must be treated as changed"""
+        self.run_detection(self.data)
+        _, changed = self.run_detection(self.data)
+        self.assertEqual(changed, set(self.data))
@@ -0,0 +1,97 @@
+import asyncio
+import json
+from datetime import datetime, timezone
+from unittest.mock import patch
+from django.test import RequestFactory, SimpleTestCase, override_settings
+
+from api import views
+from marketmanager import historical
+
+
+class FakeRecord:
+    def __init__(self, **values):
+        self.values = dict(values, result="_result", table=0, _measurement="currency_pairs")
+
+
+class FakeTable:
+    def __init__(self, records):
+        self.records = records
+
+
+class FakeQueryApi:
+    def __init__(self, delay: float):
+        self.delay = delay
+
+    async def query(self, flux):
+        await asyncio.sleep(self.delay)
+        return [FakeTable([FakeRecord(_time=datetime(2022, 1, 1, tzinfo=timezone.utc), base="BTC",
+                                      quote="USDT", last=47000.0)])]
+
+
+class FakeClient:
+    def __init__(self, delay: float = 0):
+        self.delay = delay
+
+    def query_api(self):
+        return FakeQueryApi(self.delay)
+
+
+class TestBuildFlux(SimpleTestCase):
+    def test_market_query(self):
+        flux = historical.build_flux(views.MarketHistoricalData, {
+            "base": "BTC", "quote": "USDT", "exchange_id": "1", "time_start": "-1h",
+            "time_end": "2022-01-01T00:00:00", "unknown": "x"})
+        self.assertIn("|> range(start: -1h, stop: time(v: \"2022-01-01T00:00:00+00:00\"))", flux)
+        self.assertIn('r["base"] == "BTC" and r["quote"] == "USDT" and r["exchange_id"] == "1"', flux)
+        self.assertIn("pivot(", flux)
+        self.assertNotIn("unknown", flux)
+
+    def test_escaping(self):
+        flux = historical.build_flux(views.AggregatedFiatHistoricalData,
+                                     {"currency": 'USD") |> drop(', "time_start": "-1d"})
+        self.assertIn('r["currency"] == "USD\\") |> drop("', flux)
+        self.assertNotIn("pivot(", flux)
+
+    def test_invalid(self):
+        for params in ({"currency": "USD"}, {"currency": "USD", "time_start": "yesterday"},
+                       {"currency": "USD\n", "time_start": "-1d"}):
+            with self.assertRaises(historical.HistoricalQueryError):
+                historical.build_flux(views.AggregatedFiatHistoricalData, params)
+
+
+class TestHistoricalView(SimpleTestCase):
+    def setUp(self):
+        self.view = historical.historical_view(views.MarketHistoricalData)
+        params = {"base": "BTC", "quote": "USDT", "time_start": "-1h"}
+        self.request = RequestFactory().get("/historical/markets/", params)
+
+    def run_requests(self, count: int, delay: float = 0) -> list:
+        async def run():
+            queries = historical.HistoricalQueries()
+            queries.setup = lambda: None
+            queries.client = FakeClient(delay)
+            queries.semaphore = asyncio.Semaphore(historical.settings.HISTORICAL_MAX_CONCURRENCY)
+            with patch.object(historical, "queries", queries):
+                return await asyncio.gather(*[self.view(self.request) for _ in range(count)])
+        return asyncio.run(run())
+
+    def test_records(self):
+        response = self.run_requests(1)[0]
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content),
+                         [{"_time": "2022-01-01T00:00:00Z", "base": "BTC", "quote": "USDT", "last": 47000.0}])
+
+    def test_missing_params(self):
+        request = RequestFactory().get("/historical/markets/", {"base": "BTC"})
+        response = asyncio.run(self.view(request))
+        self.assertEqual(response.status_code, 400)
+
+    @override_settings(HISTORICAL_MAX_CONCURRENCY=2, HISTORICAL_QUEUE_TIMEOUT=0.05)
+    def test_admission(self):
+        """The requests not getting a slot in time must be rejected"""
+        statuses = [x.status_code for x in self.run_requests(4, delay=0.2)]
+        self.assertEqual(sorted(statuses), [200, 200, 503, 503])
+
+    @override_settings(HISTORICAL_QUERY_TIMEOUT=0.05)
+    def test_timeout(self):
+        self.assertEqual(self.run_requests(1, delay=0.2)[0].status_code, 504)
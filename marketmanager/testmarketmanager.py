@@ -7,7 +7,8 @@ from unittest.mock import patch
 from django.db.models.query import QuerySet
 from django.utils import timezone
 from django.conf import settings
-from datetime import datetime
+from django.test import override_settings
+from datetime import datetime, timedelta
 from django_celery_results.models import TaskResult
 
 # Local imports
@@ -114,6 +115,64 @@ class TestMarketManager(unittest.TestCase):
         run = self.manager.checkExchange(self.exchange, self.status)
         self.assertTrue(run)
 
+    @patch("marketmanager.marketmanager.fetch_exchange_data.apply_async")
+    def testScheduleExchanges_Backlog(self, mock_apply):
+        """Simulate a backlog of small exchanges - the top tier exchange must be sent first
+        and to its own queue so it isn't stuck behind the backlog."""
+        mock_apply.return_value = "1234"
+        self.extra_exchanges = [f"TestBacklog{i}" for i in range(30)]
+        for name in self.extra_exchanges:
+            Exchange.objects.create(name=name, interval=300, volume=1000)
+        self.extra_exchanges.append("TestTopTier")
+        top = Exchange.objects.create(name="TestTopTier", interval=300, volume=10 ** 10)
+        self.manager.scheduleExchanges(self.manager.getExchanges())
+        first_call = mock_apply.call_args_list[0]
+        self.assertEqual(first_call.kwargs["args"], [top.id])
+        self.assertEqual(first_call.kwargs["queue"], "exchanges.high")
+        queues = [x.kwargs["queue"] for x in mock_apply.call_args_list[1:]]
+        self.assertNotIn("exchanges.high", queues)
+        self.assertTrue(ExchangeStatus.objects.get(exchange=top).running)
+
+    @override_settings(EXCHANGE_BATCHING=True, EXCHANGE_BATCH_MAX_PAIRS=100, EXCHANGE_BATCH_CAPACITY=1000)
+    @patch("marketmanager.marketmanager.fetch_exchanges_batch.apply_async")
+    @patch("marketmanager.marketmanager.fetch_exchange_data.apply_async")
+    def testScheduleExchanges_Batching(self, mock_single, mock_batch):
+        """Small exchanges must be sent in a single batch task, big ones on their own."""
+        mock_single.return_value = mock_batch.return_value = "1234"
+        self.extra_exchanges = ["TestSmall1", "TestSmall2", "TestBig"]
+        pairs = {"TestSmall1": 10, "TestSmall2": 20, "TestBig": 5000}
+        for name in self.extra_exchanges:
+            exchange = Exchange.objects.create(name=name, interval=300)
+            ExchangeStatus.objects.create(exchange=exchange, last_run_pairs=pairs[name])
+        self.manager.scheduleExchanges(self.manager.getExchanges())
+        small_ids = set(Exchange.objects.filter(name__startswith="TestSmall").values_list("id", flat=True))
+        self.assertEqual(mock_batch.call_count, 1)
+        self.assertEqual(set(mock_batch.call_args.kwargs["args"][0]), small_ids)
+        single_ids = [x.kwargs["args"][0] for x in mock_single.call_args_list]
+        self.assertIn(Exchange.objects.get(name="TestBig").id, single_ids)
+        # Exchanges without a last run pair count aren't batched
+        self.assertIn(self.exchange.id, single_ids)
+        for status in ExchangeStatus.objects.filter(exchange_id__in=small_ids):
+            self.assertTrue(status.running)
+
+    def testCheckExchange_CircuitOpen(self):
+        """An exchange with an open circuit must not run before the backoff has passed."""
+        self.status.circuit_state = "open"
+        self.status.retry_after = timezone.now() + timedelta(seconds=600)
+        run = self.manager.checkExchange(self.exchange, self.status)
+        self.assertFalse(run)
+
+    def testCheckExchange_CircuitHalfOpen(self):
+        """After the backoff a single probe must be let through."""
+        self.status.circuit_state = "open"
+        self.status.retry_after = timezone.now() - timedelta(seconds=1)
+        run = self.manager.checkExchange(self.exchange, self.status)
+        self.assertTrue(run)
+        self.assertEqual(self.status.circuit_state, "half-open")
+        # While the probe is running no other run must be sent
+        self.status.running = True
+        self.assertFalse(self.manager.checkExchange(self.exchange, self.status))
+
     def testGetExchange(self):
         """Test getting the exchange objects from the DB."""
         result = self.manager.getExchanges()
@@ -194,6 +253,66 @@ class TestMarketManager(unittest.TestCase):
         self.assertFalse(self.status.last_run)
         self.assertFalse(self.status.running)
 
+    @patch("marketmanager.marketmanager.app.control.revoke")
+    def testCheckTaskResult_Batch(self, mock_revoke):
+        """A batch running longer than the timeout of one exchange must not be revoked nor fail its
+        members which are still waiting for their turn."""
+        self.extra_exchanges = ["TestBatch1"]
+        exchange = Exchange.objects.create(name="TestBatch1", interval=300)
+        other = ExchangeStatus.objects.create(exchange=exchange)
+        for status in (self.status, other):
+            self.manager.setRunning(status, get_json()["id"], batch_size=2)
+        batch_started = timezone.now() - timedelta(seconds=self.status.timeout + 60)
+        ExchangeStatus.objects.filter(pk__in=[self.status.pk, other.pk]).update(batch_started=batch_started,
+                                                                                time_started=batch_started)
+        # The first exchange finished, the second one started right after it
+        ExchangeStatus.objects.filter(pk=self.status.pk).update(running=False)
+        ExchangeStatus.objects.filter(pk=other.pk).update(time_started=timezone.now() - timedelta(seconds=30))
+        other.refresh_from_db()
+        self.manager.checkTaskResult(other)
+        mock_revoke.assert_not_called()
+        self.assertTrue(other.running)
+        # A hanging exchange is timed out on its own
+        other.time_started = timezone.now() - timedelta(seconds=other.timeout + 1)
+        self.manager.checkTaskResult(other)
+        mock_revoke.assert_not_called()
+        self.assertFalse(other.running)
+        self.assertEqual(other.consecutive_failures, 1)
+
+    @patch("marketmanager.marketmanager.app.control.revoke")
+    def testCheckTaskResult_BatchWrite(self, mock_revoke):
+        """A member waiting for the batch write after the next member started must not be timed out
+        on its own."""
+        self.extra_exchanges = ["TestBatch1"]
+        exchange = Exchange.objects.create(name="TestBatch1", interval=300)
+        other = ExchangeStatus.objects.create(exchange=exchange)
+        for status in (self.status, other):
+            self.manager.setRunning(status, get_json()["id"], batch_size=2)
+        batch_started = timezone.now() - timedelta(seconds=self.status.timeout + 60)
+        ExchangeStatus.objects.filter(pk__in=[self.status.pk, other.pk]).update(batch_started=batch_started)
+        # The first exchange fetched its data, the second one started after it
+        ExchangeStatus.objects.filter(pk=self.status.pk).update(
+            time_started=batch_started + timedelta(seconds=1))
+        ExchangeStatus.objects.filter(pk=other.pk).update(time_started=timezone.now() - timedelta(seconds=30))
+        self.status.refresh_from_db()
+        self.manager.checkTaskResult(self.status)
+        mock_revoke.assert_not_called()
+        self.assertTrue(self.status.running)
+        self.assertEqual(self.status.consecutive_failures, 0)
+
+    @patch("marketmanager.marketmanager.app.control.revoke")
+    def testCheckTaskResult_BatchTimeout(self, mock_revoke):
+        """The batch task must be revoked once it exceeds the timeout of all its members - the
+        members which didn't start aren't failed."""
+        self.manager.setRunning(self.status, get_json()["id"], batch_size=2)
+        self.status.batch_started = self.status.time_started = timezone.now() - timedelta(
+            seconds=self.status.timeout * 2 + 1)
+        self.manager.checkTaskResult(self.status)
+        mock_revoke.assert_called_once_with(get_json()["id"], terminate=True, timeout=3)
+        self.assertFalse(self.status.running)
+        self.assertEqual(self.status.consecutive_failures, 0)
+        self.assertEqual(self.status.last_run_status, "Batch timed out before the run")
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,153 @@
+import asyncio
+import logging
+from unittest.mock import patch
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import path
+from django.utils import timezone
+
+from api import tasks, views
+from api.models import Exchange, ExchangeStatus
+from api.utils import parse_market_data
+from marketmanager import asgi, historical
+from marketmanager.marketmanager import MarketManager
+from marketmanager.runcontext import ExchangeRunContext
+from marketmanager.querylog import PROFILE_KEY, profile_queries, get_recent_profiles
+from marketmanager.synthetic import generate_tickers
+
+# The async historical view only - used by the ASGI tests
+urlpatterns = [path("historical/markets/", historical.historical_view(views.MarketHistoricalData))]
+
+
+@override_settings(QUERY_PROFILING=True)
+class TestProfileQueries(TestCase):
+    def tearDown(self):
+        cache.delete(PROFILE_KEY)
+
+    def test_profile(self):
+        """The queries of the block must be counted and stored in the recent profiles"""
+        with profile_queries("test_operation") as profile:
+            list(Exchange.objects.all())
+            list(ExchangeStatus.objects.all())
+        self.assertEqual(profile.count, 2)
+        recent = get_recent_profiles()[0]
+        self.assertEqual(recent["operation"], "test_operation")
+        self.assertEqual(recent["queries"], 2)
+
+    @override_settings(QUERY_BUDGETS={"test_operation": 1})
+    def test_over_budget(self):
+        with self.assertLogs("marketmanager", level="WARNING"):
+            with profile_queries("test_operation") as profile:
+                list(Exchange.objects.all())
+                list(ExchangeStatus.objects.all())
+        self.assertTrue(profile.over_budget)
+        self.assertTrue(get_recent_profiles()[0]["over_budget"])
+
+    @override_settings(QUERY_PROFILE_SIZE=3)
+    def test_ring_buffer(self):
+        """Only the most recent profiles must be kept - newest first"""
+        for i in range(5):
+            with profile_queries(f"operation_{i}"):
+                pass
+        self.assertEqual([x["operation"] for x in get_recent_profiles()],
+                         ["operation_4", "operation_3", "operation_2"])
+
+    @override_settings(QUERY_PROFILING=False)
+    def test_disabled(self):
+        with profile_queries("test_operation") as profile:
+            list(Exchange.objects.all())
+        self.assertIsNone(profile)
+        self.assertEqual(get_recent_profiles(), [])
+
+
+class TestQueryBudgets(TestCase):
+    """The query count of the operations must not grow with the number of pairs/exchanges"""
+    def run_exchange(self, name, pairs):
+        exchange = Exchange.objects.create(name=name, interval=300)
+        ExchangeStatus.objects.create(exchange=exchange)
+        market_data = parse_market_data(generate_tickers(pairs), exchange.id)
+        price_cache = {"base_prices": {"BTC": 50000, "ETH": 3000}, "fiat_symbol_rates": {}}
+        logger = logging.LoggerAdapter(logging.getLogger("marketmanager-celery"), {})
+        with CaptureQueriesContext(connection) as queries:
+            tasks.update_market_data(ExchangeRunContext.load(exchange.id), market_data, logger,
+                                     price_cache=price_cache)
+        return len(queries)
+
+    @patch("api.tasks.prepare_fiat_data")
+    @patch("api.tasks.InfluxUpdater.write")
+    def test_exchange_run(self, mock_write, mock_fiat):
+        mock_fiat.return_value = {"BTC": 50000, "ETH": 3000}
+        small = self.run_exchange("Small", 10)
+        big = self.run_exchange("Big", settings.MARKET_BULK_BATCH_SIZE)
+        self.assertEqual(small, big)
+        self.assertLessEqual(big, settings.QUERY_BUDGETS["exchange_run"])
+
+    def schedule(self, count):
+        """Schedule count exchanges which aren't due yet"""
+        manager = MarketManager(**settings.MARKET_MANAGER_DAEMON)
+        for i in range(count):
+            exchange = Exchange.objects.create(name=f"Idle{count}-{i}", interval=300,
+                                               last_data_fetch=timezone.now())
+            ExchangeStatus.objects.create(exchange=exchange)
+        with CaptureQueriesContext(connection) as queries:
+            manager.scheduleExchanges(manager.getExchanges())
+        Exchange.objects.all().delete()
+        return len(queries)
+
+    def test_scheduler(self):
+        self.assertEqual(self.schedule(5), 1)
+        self.assertEqual(self.schedule(30), 1)
+
+
+class SlowQueryApi:
+    """Fake async query API tracking how many queries run at once."""
+    def __init__(self):
+        self.active = 0
+        self.peak = 0
+
+    def query_api(self):
+        return self
+
+    async def query(self, flux):
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        await asyncio.sleep(0.1)
+        self.active -= 1
+        return []
+
+
+@override_settings(ROOT_URLCONF="marketmanager.testquerylog", QUERY_PROFILING=True)
+class TestAsgiMiddleware(SimpleTestCase):
+    def tearDown(self):
+        cache.delete(PROFILE_KEY)
+
+    async def request(self) -> int:
+        sent = []
+
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message):
+            sent.append(message)
+        scope = {"type": "http", "method": "GET", "path": "/historical/markets/",
+                 "query_string": b"base=BTC&quote=USDT&time_start=-1h", "headers": [(b"host", b"testserver")]}
+        await asgi.application(scope, receive, send)
+        return sent[0]["status"]
+
+    def test_concurrent(self):
+        """The async views must not be serialized by the middleware"""
+        client = SlowQueryApi()
+
+        async def run():
+            queries = historical.HistoricalQueries()
+            queries.setup = lambda: None
+            queries.client = client
+            queries.semaphore = asyncio.Semaphore(4)
+            with patch.object(historical, "queries", queries):
+                return await asyncio.gather(*[self.request() for _ in range(4)])
+        self.assertEqual(asyncio.run(run()), [200] * 4)
+        self.assertEqual(client.peak, 4)
+        self.assertEqual([x["operation"] for x in get_recent_profiles()], ["GET /historical/markets/"] * 4)
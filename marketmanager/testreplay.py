@@ -0,0 +1,66 @@
+import tempfile
+import unittest
+import ccxt
+from django.test import override_settings
+
+from marketmanager import replay
+
+TICKERS = {"ETH/BTC": {"symbol": "ETH/BTC", "last": 0.07, "bid": 0.069, "ask": 0.071, "baseVolume": 50,
+                       "info": {"symbol": "ETHBTC", "lastPrice": "0.07"}}}
+
+
+class FakeExchange:
+    id = "fakeexchange"
+    name = "FakeExchange"
+    has = {"fetchTickers": True}
+    symbols = ["ETH/BTC"]
+
+    def fetchTickers(self):
+        return TICKERS
+
+    def fetch_currencies(self):
+        raise ccxt.DDoSProtection("Rate limited")
+
+
+class TestReplay(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.recorder = replay.RecordingExchange(FakeExchange(), self.directory.name)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def get_replay(self):
+        path = replay.get_fixture_path(self.directory.name, FakeExchange.name)
+        return replay.ReplayExchange.from_file(path, latency_factor=0)
+
+    def test_record_replay(self):
+        """The replayed responses must match the recorded ones"""
+        self.assertEqual(self.recorder.fetchTickers(), TICKERS)
+        exchange = self.get_replay()
+        self.assertEqual(exchange.fetchTickers(), TICKERS)
+        self.assertEqual(exchange.fetch_tickers(), TICKERS)
+        self.assertEqual(exchange.has, FakeExchange.has)
+        self.assertEqual(exchange.symbols, FakeExchange.symbols)
+
+    def test_replay_errors(self):
+        """Recorded ccxt errors must be raised again on replay"""
+        with self.assertRaises(ccxt.DDoSProtection):
+            self.recorder.fetch_currencies()
+        with self.assertRaises(ccxt.DDoSProtection):
+            self.get_replay().fetch_currencies()
+
+    def test_not_recorded_methods(self):
+        """Methods which weren't recorded must not exist on the replay exchange"""
+        self.recorder.fetchTickers()
+        exchange = self.get_replay()
+        self.assertFalse(hasattr(exchange, "fetch_markets"))
+        with self.assertRaises(ccxt.ExchangeError):
+            exchange.fetchTicker("LTC/BTC")
+
+    def test_get_ccxt_exchange_replay(self):
+        self.recorder.fetchTickers()
+        with override_settings(CCXT_REPLAY_DIR=self.directory.name, CCXT_REPLAY_LATENCY_FACTOR=0):
+            exchange = replay.get_ccxt_exchange(FakeExchange.name)
+        self.assertIsInstance(exchange, replay.ReplayExchange)
+        self.assertEqual(exchange.fetchTickers(), TICKERS)
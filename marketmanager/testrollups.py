@@ -0,0 +1,52 @@
+from datetime import datetime, timezone
+from django.test import SimpleTestCase, override_settings
+from rest_framework.exceptions import ValidationError
+
+from api import models, views
+from marketmanager import historical, rollups
+
+NOW = datetime(2022, 1, 1, tzinfo=timezone.utc)
+
+
+@override_settings(HISTORICAL_POINT_BUDGET=1000, HISTORICAL_RAW_INTERVAL=300, INFLUX_ROLLUPS_SINCE=0)
+class TestRollups(SimpleTestCase):
+    def test_select_resolution(self):
+        """The finest resolution keeping the range within the point budget must be picked"""
+        cases = {"-1d": "raw", "-3d": "raw", "-7d": "15m", "-30d": "1h", "-1y": "1d", "-10y": "1d"}
+        for time_start, resolution in cases.items():
+            self.assertEqual(rollups.select_resolution(time_start, now=NOW), resolution, time_start)
+        resolution = rollups.select_resolution("2021-06-01T00:00:00", "2021-06-20T00:00:00", now=NOW)
+        self.assertEqual(resolution, "1h")
+        self.assertEqual(rollups.select_resolution(str(int(NOW.timestamp()) - 86400), now=NOW), "raw")
+        self.assertEqual(rollups.select_resolution("yesterday", now=NOW), "raw")
+
+    def test_rollups_since(self):
+        """Ranges starting before the rollups must be served from the raw points"""
+        since = int(NOW.timestamp()) - 30 * 86400
+        with self.settings(INFLUX_ROLLUPS_SINCE=since):
+            self.assertEqual(rollups.select_resolution("-30d", now=NOW), "1h")
+            self.assertEqual(rollups.select_resolution(str(since - 1), now=NOW), "raw")
+            self.assertEqual(rollups.select_resolution("-1y", now=NOW), "raw")
+        with self.settings(INFLUX_ROLLUPS_SINCE=None):
+            self.assertEqual(rollups.select_resolution("-30d", now=NOW), "raw")
+
+    def test_get_resolution(self):
+        self.assertEqual(rollups.get_resolution({"time_start": "-1y", "resolution": "15m"}), "15m")
+        self.assertEqual(rollups.get_resolution({"time_start": "-1y"}), "1d")
+        with self.assertRaises(ValidationError):
+            rollups.get_resolution({"time_start": "-1y", "resolution": "1m"})
+
+    def test_rollup_model(self):
+        model = rollups.get_rollup_model(models.PairsMarketModel, "1h")
+        self.assertEqual(model.measurement, "currency_pairs_1h")
+        self.assertEqual(model.bucket, "marketmanager_aggregated")
+        self.assertEqual(model.fields, models.PairsMarketModel.fields)
+        self.assertIs(rollups.get_rollup_model(models.PairsMarketModel, "1h"), model)
+        self.assertIs(rollups.get_rollup_model(models.PairsMarketModel, "raw"), models.PairsMarketModel)
+
+    def test_flux(self):
+        model = rollups.get_rollup_model(models.PairsMarketModel, "1d")
+        flux = historical.build_flux(views.MarketHistoricalData,
+                                     {"base": "BTC", "quote": "USDT", "time_start": "-1y"}, model)
+        self.assertIn('from(bucket: "marketmanager_aggregated")', flux)
+        self.assertIn('r._measurement == "currency_pairs_1d"', flux)
@@ -0,0 +1,47 @@
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from api.models import Exchange, ExchangeStatus
+from marketmanager.runcontext import ExchangeRunContext
+
+
+class TestExchangeRunContext(TestCase):
+    def setUp(self):
+        self.exchange = Exchange.objects.create(name="Test", interval=300)
+        ExchangeStatus.objects.create(exchange=self.exchange)
+
+    def test_load(self):
+        """The exchange and its status must be loaded in a single query"""
+        with self.assertNumQueries(1):
+            run = ExchangeRunContext.load(self.exchange.id)
+            self.assertEqual(run.status.exchange_id, self.exchange.id)
+
+    def test_load_missing_status(self):
+        exchange = Exchange.objects.create(name="NoStatus", interval=300)
+        run = ExchangeRunContext.load(exchange.id)
+        self.assertTrue(ExchangeStatus.objects.filter(id=run.status.id).exists())
+
+    def test_flush(self):
+        """Only the changed columns must be written - a single update per table"""
+        run = ExchangeRunContext.load(self.exchange.id)
+        run.exchange.volume = 1000
+        run.exchange.top_pair = "ETH-BTC"
+        run.status.running = True
+        with CaptureQueriesContext(connection) as queries:
+            run.flush()
+        updates = [x["sql"] for x in queries if x["sql"].startswith("UPDATE")]
+        self.assertEqual(len(updates), 2)
+        self.assertNotIn('"interval"', updates[0])
+        self.assertNotIn('"timeout"', updates[1])
+        exchange = Exchange.objects.select_related("exchangestatus").get(id=self.exchange.id)
+        self.assertEqual(exchange.volume, 1000)
+        self.assertEqual(exchange.top_pair, "ETH-BTC")
+        self.assertTrue(exchange.exchangestatus.running)
+
+    def test_flush_unchanged(self):
+        run = ExchangeRunContext.load(self.exchange.id)
+        run.exchange.volume = 1000
+        run.flush()
+        with self.assertNumQueries(0):
+            run.flush()
@@ -0,0 +1,120 @@
+import gzip
+from datetime import timedelta
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+from api.models import Exchange, Market
+from api.tasks import clear_stale_markets
+from api.serializers import MarketSerializer
+from marketmanager.cache import bump_market_versions, get_version
+from marketmanager.snapshots import SNAPSHOT_KEY, get_market_snapshot
+from marketmanager.updaters import ExchangeUpdater
+
+
+class TestMarketSnapshots(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.exchange = Exchange.objects.create(name="Binance", interval=300)
+        Market.objects.create(name="ETH-BTC", base="ETH", quote="BTC", exchange=self.exchange,
+                              volume=10, last=0.07, bid=0.07, ask=0.07)
+        Market.objects.create(name="XRP-BTC", base="XRP", quote="BTC", exchange=self.exchange,
+                              volume=None, last=1, bid=1, ask=1)
+        Market.objects.create(name="LTC-BTC", base="LTC", quote="BTC", exchange=self.exchange,
+                              volume=5, last=0.003, bid=0.003, ask=0.003, active=False)
+        self.url = reverse("api:market-snapshot", args=[self.exchange.id])
+
+    def update_markets(self, last):
+        data = {"ETH-BTC": {"base": "ETH", "quote": "BTC", "last": last, "bid": last, "ask": last,
+                            "volume": 10, "exchange_id": self.exchange.id}}
+        with self.captureOnCommitCallbacks(execute=True):
+            ExchangeUpdater(self.exchange.id, data, changed={"ETH-BTC"}).update_existing_markets()
+
+    def test_serializer_output(self):
+        """The snapshot must hold the same bytes as the serializer and the renderer of the API"""
+        markets = Market.objects.filter(exchange=self.exchange, active=True).order_by("id")
+        expected = JSONRenderer().render(MarketSerializer(markets, many=True).data)
+        snapshot = get_market_snapshot(self.exchange.id)
+        self.assertEqual(gzip.decompress(snapshot["json"]), expected)
+
+    def test_gzip(self):
+        response = self.client.get(self.url, HTTP_ACCEPT_ENCODING="gzip, deflate")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        names = [x["name"] for x in self.client.get(self.url).json()]
+        self.assertEqual(names, ["ETH-BTC", "XRP-BTC"])
+
+    def test_accept_encoding(self):
+        """gzip must only be sent when the q-value of gzip(or of *) allows it"""
+        cases = {"gzip;q=0": False, "gzip; q=0.0, deflate": False, "deflate, *;q=0.5": True,
+                 "br;q=1.0, GZIP;q=0.3": True, "*, gzip;q=0": False, "x-gzip": True, "identity": False,
+                 "gzipx": False}
+        for accept_encoding, gzipped in cases.items():
+            response = self.client.get(self.url, HTTP_ACCEPT_ENCODING=accept_encoding)
+            self.assertEqual(response.get("Content-Encoding") == "gzip", gzipped, accept_encoding)
+            self.assertIn("Accept-Encoding", response["Vary"])
+
+    def test_no_queries_when_current(self):
+        self.client.get(self.url)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(queries), 0)
+
+    def test_etag(self):
+        """The ETag must match until the markets of the exchange change"""
+        etag = self.client.get(self.url)["ETag"]
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b"")
+        self.update_markets(0.08)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertEqual(response.json()[0]["last"], 0.08)
+
+    def test_written_by_run(self):
+        """The exchange runs must write the snapshot - no rebuild on the request"""
+        self.update_markets(0.09)
+        with CaptureQueriesContext(connection) as queries:
+            markets = self.client.get(self.url).json()
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(markets[0]["last"], 0.09)
+
+    def test_missing_exchange(self):
+        response = self.client.get(reverse("api:market-snapshot", args=[self.exchange.id + 1]))
+        self.assertEqual(response.status_code, 404)
+
+    def test_stale_markets_cleared(self):
+        self.client.get(self.url)
+        stale = timezone.now() - timedelta(days=settings.MARKET_STALE_DAYS + 1)
+        Market.objects.filter(name="XRP-BTC").update(updated=stale)
+        clear_stale_markets()
+        names = [x["name"] for x in self.client.get(self.url).json()]
+        self.assertEqual(names, ["ETH-BTC"])
+
+    def test_single_flight(self):
+        """While another worker rebuilds the snapshot the outdated one must be served"""
+        self.client.get(self.url)
+        Market.objects.filter(name="ETH-BTC").update(last=0.08)
+        bump_market_versions(self.exchange.id)
+        cache.add(f"{SNAPSHOT_KEY.format(self.exchange.id)}:lock", 1)
+        with CaptureQueriesContext(connection) as queries:
+            markets = self.client.get(self.url).json()
+        self.assertEqual(markets[0]["last"], 0.07)
+        # Only the check of the exchange
+        self.assertEqual(len(queries), 1)
+
+    @override_settings(RESPONSE_CACHE_LOCK_WAIT=0.1)
+    def test_single_flight_missing(self):
+        """Without a snapshot to serve the rebuild must be waited for - and done after the wait"""
+        get_version(f"markets:{self.exchange.id}")
+        cache.add(f"{SNAPSHOT_KEY.format(self.exchange.id)}:lock", 1)
+        markets = self.client.get(self.url).json()
+        self.assertEqual([x["name"] for x in markets], ["ETH-BTC", "XRP-BTC"])
@@ -0,0 +1,137 @@
+import asyncio
+import json
+from unittest.mock import MagicMock, patch
+from django.test import TestCase, SimpleTestCase, override_settings
+
+from api.models import Exchange, Market
+from marketmanager import stream
+from marketmanager.updaters import ExchangeUpdater
+
+
+def get_data(name, last):
+    base, quote = name.split("-")
+    return {"base": base, "quote": quote, "last": last, "bid": last, "ask": last, "volume": 10}
+
+
+class TestPublish(TestCase):
+    @override_settings(MARKET_STREAM_ENABLED=True)
+    @patch("marketmanager.updaters.publish_update")
+    def test_changed_markets(self, mock_publish):
+        """Only the written markets must be published - once the run commits"""
+        exchange = Exchange.objects.create(name="Binance", interval=300)
+        Market.objects.create(name="ETH-BTC", exchange=exchange, **get_data("ETH-BTC", 0.07))
+        data = {x: dict(get_data(x, 0.08), exchange_id=exchange.id) for x in ("ETH-BTC", "XRP-BTC")}
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            ExchangeUpdater(exchange.id, data, changed={"XRP-BTC"}).update_existing_markets()
+        mock_publish.assert_not_called()
+        for callback in callbacks:
+            callback()
+        exchange_id, message = mock_publish.call_args[0]
+        self.assertEqual(exchange_id, exchange.id)
+        self.assertEqual(json.loads(message)["markets"], [["XRP-BTC", "XRP", "BTC", 0.08, 0.08, 0.08, 10]])
+
+
+class TestListen(SimpleTestCase):
+    @patch("marketmanager.stream.time.sleep")
+    @patch("marketmanager.stream.get_redis")
+    def test_errors(self, mock_redis, mock_sleep):
+        """The listener must survive any error - with a growing backoff - until the loop closes"""
+        pubsub = MagicMock()
+        pubsub.listen.side_effect = [ValueError("Bad message"), iter([{"data": b"update"}])]
+        mock_redis.side_effect = [stream.redis.ConnectionError("Down"), MagicMock(pubsub=lambda **kw: pubsub),
+                                  MagicMock(pubsub=lambda **kw: pubsub)]
+        hub = stream.MarketUpdateHub()
+        hub.loop = MagicMock()
+        hub.loop.is_closed.side_effect = [False, False, False, True]
+        with self.assertLogs("marketmanager", level="WARNING"):
+            hub.listen()
+        hub.loop.call_soon_threadsafe.assert_called_once_with(hub.dispatch, b"update")
+        self.assertEqual([x[0][0] for x in mock_sleep.call_args_list], [1, 2, 1])
+        self.assertEqual(pubsub.close.call_count, 2)
+
+    @patch.object(stream.MarketUpdateHub, "listen", lambda self: None)
+    def test_restart(self):
+        """A dead listener thread must be started again by the next subscriber"""
+        async def run():
+            hub = stream.MarketUpdateHub()
+            hub.subscribe(stream.Subscriber())
+            first = hub.thread
+            first.join()
+            hub.subscribe(stream.Subscriber())
+            return first, hub.thread
+        first, second = asyncio.run(run())
+        self.assertIsNot(first, second)
+
+
+@patch.object(stream.MarketUpdateHub, "listen", lambda self: None)
+class TestStream(SimpleTestCase):
+    def setUp(self):
+        self.update = stream.build_update(1, {x: get_data(x, 1) for x in ("ETH-BTC", "ETH-USDT", "XRP-BTC")})
+
+    def test_filters(self):
+        async def run():
+            subscribers = [stream.Subscriber(), stream.Subscriber(exchange=2), stream.Subscriber(quote="BTC"),
+                           stream.Subscriber(exchange=1, base="ETH", quote="USDT")]
+            hub = stream.MarketUpdateHub()
+            hub.subscribers.update(subscribers)
+            hub.dispatch(self.update)
+            output = []
+            for subscriber in subscribers:
+                event = subscriber.queue.get_nowait() if not subscriber.queue.empty() else None
+                output.append(event and [x[0] for x in json.loads(event.split(b"data: ")[1])["markets"]])
+            return output
+        self.assertEqual(asyncio.run(run()),
+                         [["ETH-BTC", "ETH-USDT", "XRP-BTC"], None, ["ETH-BTC", "XRP-BTC"], ["ETH-USDT"]])
+
+    @override_settings(MARKET_STREAM_QUEUE_SIZE=1)
+    def test_slow_client(self):
+        """Clients which don't keep up must be disconnected"""
+        async def run():
+            subscriber = stream.Subscriber()
+            hub = stream.MarketUpdateHub()
+            hub.subscribers.add(subscriber)
+            hub.dispatch(self.update)
+            hub.dispatch(self.update)
+            return hub.subscribers, subscriber.queue.get_nowait()
+        self.assertEqual(asyncio.run(run()), (set(), None))
+
+    def test_stream(self):
+        """The updates must be sent as events until the client disconnects"""
+        async def run():
+            sent = []
+            disconnected = asyncio.Event()
+
+            async def receive():
+                await disconnected.wait()
+                return {"type": "http.disconnect"}
+
+            async def send(message):
+                sent.append(message)
+                if message.get("body", b"").startswith(b"event:"):
+                    disconnected.set()
+
+            task = asyncio.ensure_future(stream.market_stream(
+                {"type": "http", "method": "GET", "query_string": b"base=XRP"}, receive, send))
+            while not stream.hub.subscribers:
+                await asyncio.sleep(0)
+            stream.hub.dispatch(self.update)
+            await asyncio.wait_for(task, 1)
+            return sent
+        sent = asyncio.run(run())
+        self.assertEqual(sent[0]["status"], 200)
+        self.assertIn((b"content-type", b"text/event-stream"), sent[0]["headers"])
+        event = sent[-1]["body"]
+        self.assertTrue(event.endswith(b"\n\n"))
+        self.assertEqual(json.loads(event.split(b"data: ")[1])["markets"][0][0], "XRP-BTC")
+        self.assertEqual(stream.hub.subscribers, set())
+
+    def test_invalid_exchange(self):
+        async def run():
+            sent = []
+
+            async def send(message):
+                sent.append(message)
+            await stream.market_stream({"type": "http", "method": "GET", "query_string": b"exchange=x"},
+                                       None, send)
+            return sent
+        self.assertEqual(asyncio.run(run())[0]["status"], 400)
@@ -1,6 +1,7 @@
 import unittest
 from unittest.mock import patch
 from django.conf import settings
+from django.test import override_settings
 from influxdb_client import InfluxDBClient
 
 from marketmanager.updaters import ExchangeUpdater, InfluxUpdater, FiatMarketModel, PairsMarketModel
@@ -69,9 +70,51 @@ class TestExchangeUpdater(unittest.TestCase):
         self.assertEqual(after_update[0].last, last)
         self.assertEqual(after_update[0].volume, volume)
 
+    @override_settings(MARKET_BULK_BATCH_SIZE=2)
+    def testupdate_existing_markets_chunks(self):
+        """Existing markets must be updated and new ones created across several chunks."""
+        market = Market(name="ICX-BNB", **self.data["ICX-BNB"])
+        market.save()
+        new_data = {"ICX-BNB": {**self.data["ICX-BNB"], "volume": 1000}}
+        for i in range(4):
+            new_data[f"C{i}-BNB"] = {**self.data["ICX-BNB"], "base": f"C{i}"}
+        updater = ExchangeUpdater(self.exchange.id, new_data)
+        updater.update_existing_markets()
+        market.refresh_from_db()
+        self.assertEqual(market.volume, 1000)
+        self.assertEqual(Market.objects.filter(exchange=self.exchange).count(), 5)
+
+    def testupdate_existing_markets_unchanged(self):
+        """Markets which aren't in the changed set must not be written."""
+        market = Market(name="ICX-BNB", **self.data["ICX-BNB"])
+        market.save()
+        new_data = {"ICX-BNB": {**self.data["ICX-BNB"], "volume": 1000}}
+        updater = ExchangeUpdater(self.exchange.id, new_data, changed=set())
+        updater.update_existing_markets()
+        market.refresh_from_db()
+        self.assertEqual(market.volume, self.data["ICX-BNB"]["volume"])
+        self.assertEqual(Market.objects.count(), 1)
+
+    def testupdate_existing_markets_missing(self):
+        """Markets missing from the data must be deactivated and activated again when listed."""
+        delisted = Market(name="OLD-BNB", **{**self.data["ICX-BNB"], "base": "OLD"})
+        delisted.save()
+        Market(name="ICX-BNB", **self.data["ICX-BNB"]).save()
+        updater = ExchangeUpdater(self.exchange.id, self.data, changed=set())
+        updater.update_existing_markets()
+        delisted.refresh_from_db()
+        self.assertFalse(delisted.active)
+        self.assertTrue(Market.objects.get(name="ICX-BNB").active)
+        new_data = {**self.data, "OLD-BNB": {**self.data["ICX-BNB"], "base": "OLD"}}
+        updater = ExchangeUpdater(self.exchange.id, new_data)
+        updater.update_existing_markets()
+        delisted.refresh_from_db()
+        self.assertTrue(delisted.active)
+
     def testUpdateExchange(self):
         """Test the updateExchange method."""
         self.updater.updateExchange()
+        self.updater.run_context.flush()
         exchange = Exchange.objects.get(name="Test")
         self.assertTrue(exchange.last_data_fetch)
 
@@ -93,12 +136,26 @@ class TestExchangeUpdater(unittest.TestCase):
         data_map = {"ICX": 6, "BNB": 10}
         mock_result.return_value = data_map
         self.updater.summarize_data()
+        self.updater.run_context.flush()
         base = self.data["ICX-BNB"]["base"]
         exchange_volume = self.data["ICX-BNB"]["volume"] * data_map[base]
         exchange = Exchange.objects.get(name="Test")
         self.assertEqual(exchange.volume, exchange_volume)
         self.assertEqual(exchange.top_pair, "ICX-BNB")
 
+    @patch("marketmanager.updaters.ExchangeUpdater.get_fiat_symbol_rates")
+    @patch("marketmanager.updaters.ExchangeUpdater.get_base_prices")
+    def testsummarize_data_SharedPrices(self, mock_result, mock_rates):
+        """Updaters sharing a price cache must look the prices up only once"""
+        mock_result.return_value = {"ICX": 6, "BNB": 10}
+        mock_rates.return_value = {}
+        price_cache = {}
+        for _ in range(3):
+            updater = ExchangeUpdater(self.exchange.id, self.data, price_cache=price_cache)
+            updater.summarize_data()
+        self.assertEqual(mock_result.call_count, 1)
+        self.assertEqual(mock_rates.call_count, 1)
+
     @patch("marketmanager.updaters.ExchangeUpdater.get_base_prices")
     def testsummarize_data_NoBasePrices(self, mock_result):
         """There shouldn't be any summaries if there are no base results"""
@@ -223,6 +280,18 @@ class TestInfluxUpdater(unittest.TestCase):
             for key in self.data[self.pair]:
                 self.assertEqual(record[key], self.data[self.pair][key])
 
+    def test_get_points(self):
+        """Test collecting the points without writing them"""
+        points = self.updater.get_points()
+        self.assertEqual(len(points["pairs"]), 1)
+        self.assertEqual(points["pairs"][0]["symbol"], self.pair)
+        self.assertEqual(len(points["fiat"]), len(self.fiat_data))
+
+    def test_get_points_changed(self):
+        """Only the changed pairs must be written"""
+        updater = InfluxUpdater(self.exchange.id, self.data, self.fiat_data, changed=set())
+        self.assertEqual(updater.get_points()["pairs"], [])
+
     def test_write_fiat(self):
         """Test inserting fiat timeseries into Influx"""
         FiatMarketModel.measurement = self.fiat_measurement
@@ -1,6 +1,15 @@
 
+import tracemalloc
 import unittest
+from unittest.mock import patch
+from django.conf import settings
+from django.test import override_settings
+from django.utils import timezone
+
 from marketmanager import utils
+from marketmanager.synthetic import generate_tickers
+from api.models import Exchange, ExchangeStatus
+from api.utils import parse_market_data
 
 
 class TestUtils(unittest.TestCase):
@@ -37,8 +46,127 @@ class TestUtils(unittest.TestCase):
         price = self.fiat_data[self.fiatpair]['last'] * self.fiat_data[symbol]["last"]
         self.assertEqual(price, fiat_data[base])
 
+    def test_prepare_fiat_data_unordered(self):
+        """A pair before its quote's fiat pair must be resolved without fetching the quote"""
+        data = {"SOL-BNBTEST": {'base': 'SOL', 'quote': 'BNBTEST', 'last': 0.015,
+                                'bid': 0, 'ask': 0, 'volume': 140, 'exchange_id': 1},
+                **self.fiat_data}
+        with patch("marketmanager.utils.FiatMarketModel") as mock_model:
+            fiat_data = utils.prepare_fiat_data(data)
+            mock_model.assert_not_called()
+        self.assertEqual(fiat_data["SOL"], 0.015 * self.fiat_data[self.fiatpair]["last"])
+
     def test_prepare_fiat_data_not_valid_last(self):
         """Test when there are the last trade value is 0"""
         self.fiat_data[self.fiatpair]['last'] = 0
         fiat_data = utils.prepare_fiat_data(self.fiat_data)
         self.assertEqual(len(fiat_data), 0)
+
+    @patch("marketmanager.utils.FiatMarketModel")
+    def test_prepare_fiat_data_memory(self, mock_model):
+        """The pairs must be scanned in place - the allocations may only grow with the fiat prices,
+        not with copies of the pairs"""
+        tracemalloc.start()
+        data = parse_market_data(generate_tickers(5000), 1, consume=True)
+        data_size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        tracemalloc.start()
+        fiat_data = utils.prepare_fiat_data(data)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self.assertEqual(len(fiat_data), 5000)
+        self.assertLess(peak, data_size / 4)
+
+
+class TestExchangePriority(unittest.TestCase):
+    def test_priority_from_volume(self):
+        """The tier must be derived from the exchange volume"""
+        exchange = Exchange(name="Test", interval=300, volume=10 ** 10)
+        self.assertEqual(utils.get_exchange_priority(exchange), "high")
+        exchange.volume = 10
+        self.assertEqual(utils.get_exchange_priority(exchange), "low")
+        self.assertEqual(utils.get_exchange_queue(exchange), "exchanges.low")
+
+    def test_priority_no_volume(self):
+        """Exchanges without a volume must go to the default tier"""
+        exchange = Exchange(name="Test", interval=300)
+        self.assertEqual(utils.get_exchange_priority(exchange), "default")
+
+    def test_queue_order(self):
+        """The workers must consume the tier queues from the highest tier - before the default queue"""
+        tiers = [f"exchanges.{tier}" for tier, _ in settings.EXCHANGE_PRIORITY_TIERS]
+        self.assertEqual([x.name for x in settings.CELERY_QUEUES], tiers + [settings.CELERY_DEFAULT_QUEUE])
+        self.assertEqual(settings.BROKER_TRANSPORT_OPTIONS["queue_order_strategy"], "priority")
+
+    def test_priority_override(self):
+        """A manually set tier must take precedence over the volume"""
+        exchange = Exchange(name="Test", interval=300, volume=10, priority_tier="high")
+        self.assertEqual(utils.get_exchange_priority(exchange), "high")
+
+    def test_sort_by_priority(self):
+        low = Exchange(name="Low", interval=300, volume=10)
+        high = Exchange(name="High", interval=300, volume=10 ** 10)
+        new = Exchange(name="New", interval=300)
+        self.assertEqual(utils.sort_by_priority([low, new, high]), [high, new, low])
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def setUp(self):
+        self.status = ExchangeStatus()
+
+    def fail_runs(self, count):
+        for _ in range(count):
+            utils.update_circuit(self.status, success=False)
+
+    def test_opens_after_failures(self):
+        """The circuit must stay closed until the failure threshold is reached"""
+        self.fail_runs(settings.CIRCUIT_BREAKER_FAILURES - 1)
+        self.assertEqual(self.status.circuit_state, "closed")
+        self.fail_runs(1)
+        self.assertEqual(self.status.circuit_state, "open")
+        backoff = (self.status.retry_after - timezone.now()).total_seconds()
+        self.assertAlmostEqual(backoff, settings.CIRCUIT_BREAKER_BACKOFF, delta=5)
+
+    def test_failed_probe_doubles_backoff(self):
+        """A failed half-open probe must open the circuit with a doubled backoff"""
+        self.fail_runs(settings.CIRCUIT_BREAKER_FAILURES)
+        self.status.circuit_state = "half-open"
+        self.fail_runs(1)
+        self.assertEqual(self.status.circuit_state, "open")
+        backoff = (self.status.retry_after - timezone.now()).total_seconds()
+        self.assertAlmostEqual(backoff, settings.CIRCUIT_BREAKER_BACKOFF * 2, delta=5)
+
+    def test_backoff_is_capped(self):
+        self.fail_runs(settings.CIRCUIT_BREAKER_FAILURES + 50)
+        backoff = (self.status.retry_after - timezone.now()).total_seconds()
+        self.assertLessEqual(backoff, settings.CIRCUIT_BREAKER_MAX_BACKOFF)
+
+    def test_success_closes(self):
+        self.fail_runs(settings.CIRCUIT_BREAKER_FAILURES)
+        self.status.circuit_state = "half-open"
+        utils.update_circuit(self.status, success=True)
+        self.assertEqual(self.status.circuit_state, "closed")
+        self.assertEqual(self.status.consecutive_failures, 0)
+        self.assertIsNone(self.status.retry_after)
+
+
+class TestPackExchangeBatches(unittest.TestCase):
+    def setUp(self):
+        self.exchanges = [Exchange(id=i, name=f"Test{i}", interval=300) for i in range(1, 6)]
+
+    @override_settings(EXCHANGE_BATCH_CAPACITY=100, EXCHANGE_BATCH_MAX_SIZE=10)
+    def test_capacity(self):
+        """No batch must exceed the pair capacity"""
+        pairs = {1: 60, 2: 50, 3: 40, 4: 30, 5: 20}
+        batches = utils.pack_exchange_batches(self.exchanges, pairs)
+        self.assertEqual(sum(len(x) for x in batches), len(self.exchanges))
+        for batch in batches:
+            self.assertLessEqual(sum(pairs[x.id] for x in batch), 100)
+        self.assertEqual(len(batches), 2)
+
+    @override_settings(EXCHANGE_BATCH_CAPACITY=1000, EXCHANGE_BATCH_MAX_SIZE=2)
+    def test_max_size(self):
+        """No batch must exceed the max number of exchanges"""
+        pairs = {x.id: 10 for x in self.exchanges}
+        batches = utils.pack_exchange_batches(self.exchanges, pairs)
+        self.assertEqual([len(x) for x in batches], [2, 2, 1])
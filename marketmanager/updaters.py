@@ -1,10 +1,16 @@
 import logging
+from functools import partial
 from django.utils import timezone
-from django.db import transaction, utils
+from django.db import transaction
 from django.conf import settings
 
-from api.models import Exchange, Market, CurrencyFiatPrices, FiatMarketModel, PairsMarketModel
+from api.models import Market, CurrencyFiatPrices, FiatMarketModel, PairsMarketModel
 from applib.tools import appRequest
+from marketmanager.cache import bump_market_versions
+from marketmanager.runcontext import ExchangeRunContext
+from marketmanager.snapshots import write_market_snapshot
+from marketmanager.stream import build_update, publish_update
+from marketmanager.utils import chunked
 
 model_map = {
     "fiat": FiatMarketModel,
@@ -12,14 +18,24 @@ model_map = {
 }
 
 
+def write_points(points: dict):
+    """Write the collected points of several exchanges to InfluxDB - a single write per model."""
+    for model, data in points.items():
+        if data:
+            model_map[model](data=data).save()
+
+
 class InfluxUpdater:
     """Handle inserts of timeseries to InfluxDB. We have 2 cases:
     * Markets were the base is in fiat
-    * Markets were the base is another cryptocurrency"""
-    def __init__(self, exchange_id: int, data: dict, fiat_data: dict, task_id: str = None):
+    * Markets were the base is another cryptocurrency
+    If changed is passed only the market pairs in it are written."""
+    def __init__(self, exchange_id: int, data: dict, fiat_data: dict, task_id: str = None,
+                 changed: set = None):
         self.exchange_id = exchange_id
         self.data = data
         self.fiat_data = fiat_data
+        self.changed = changed
         extra = {"task_id": task_id, "exchange": self.exchange_id}
         self.logger = logging.getLogger("marketmanager-celery")
         self.logger = logging.LoggerAdapter(self.logger, extra)
@@ -35,24 +51,43 @@ class InfluxUpdater:
         if exc:
             self.logger.warning(f"Error occurred while trying to write to Influxdb. Exception: {exc}")
 
-    def _write_fiat(self):
-        """Write Market fiat data to Influx"""
-        self.logger.info("Writing fiat data to InfluxDB")
+    def get_fiat_points(self):
+        """Transform the fiat data to InfluxDB points"""
         data = []
         for currency, price in self.fiat_data.items():
             self.logger.debug(f"Working on currency {currency}. Price: {price}")
             values = {"currency": currency, "price": price, "exchange_id": self.exchange_id}
             data.append(values)
-        self._create("fiat", data)
+        return data
+
+    def iter_pairs_points(self):
+        """Transform the market pairs data to InfluxDB points one at a time"""
+        for symbol, values in self.data.items():
+            if self.changed is not None and symbol not in self.changed:
+                continue
+            self.logger.debug(f"Working on symbol {symbol}")
+            yield {**values, "symbol": symbol}
+
+    def get_pairs_points(self):
+        """Transform the market pairs data to InfluxDB points"""
+        return list(self.iter_pairs_points())
+
+    def get_points(self):
+        """Get all the points of the exchange per model without writing them"""
+        return {"pairs": self.get_pairs_points(), "fiat": self.get_fiat_points()}
+
+    def _write_fiat(self):
+        """Write Market fiat data to Influx"""
+        self.logger.info("Writing fiat data to InfluxDB")
+        self._create("fiat", self.get_fiat_points())
         self.logger.info("Finished writing fiat data.")
 
     def _write_pairs(self):
         """Write Market pair data to Influx"""
-        self.logger.info("Transforming market pairs data for InfluxDB")
-        for symbol, values in self.data.items():
-            self.logger.debug(f"Working on symbol {symbol}")
-            values["symbol"] = symbol
-        self._create("pairs", list(self.data.values()))
+        self.logger.info("Writing market pairs data to InfluxDB")
+        # Encode and write in chunks so only a chunk of points is kept in memory
+        for chunk in chunked(self.iter_pairs_points(), settings.INFLUX_WRITE_CHUNK_SIZE):
+            self._create("pairs", chunk)
         self.logger.info("Finished writing market pairs.")
 
     def write(self):
@@ -62,13 +97,22 @@ class InfluxUpdater:
 
 
 class ExchangeUpdater:
-    """Insert/Update an exchanges market data"""
-    def __init__(self, exchange_id: int, data: dict, fiat_data: dict = {}, task_id: str = None):
+    """Insert/Update an exchanges market data.
+    If changed is passed only the existing markets in it are updated.
+    The exchange changes are kept in the run context - without a passed context the updater loads
+    its own and writes it at the end of run()."""
+    def __init__(self, exchange_id: int, data: dict, fiat_data: dict = {}, task_id: str = None,
+                 price_cache: dict = None, changed: set = None, run_context: ExchangeRunContext = None):
         self.exchange_id = exchange_id
-        self.exchange = Exchange.objects.get(id=self.exchange_id)
+        self.owns_context = run_context is None
+        self.run_context = run_context or ExchangeRunContext.load(exchange_id)
+        self.exchange = self.run_context.exchange
         self.market_data = data
         self.fiat_data = fiat_data
         self.task_id = task_id
+        self.changed = changed
+        # Price lookups which can be shared by the updaters of several exchanges
+        self.price_cache = price_cache if price_cache is not None else {}
         extra = {"task_id": task_id, "exchange": self.exchange}
         self.logger = logging.getLogger("marketmanager-celery")
         self.logger = logging.LoggerAdapter(self.logger, extra)
@@ -80,13 +124,18 @@ class ExchangeUpdater:
             output[i[key]] = i[value]
         return output
 
+    def _cached_prices(self, key, method):
+        """Get a price lookup from the shared price cache or run it."""
+        if key not in self.price_cache:
+            self.price_cache[key] = method()
+        return self.price_cache[key]
+
     @transaction.atomic
     def create_markets(self):
         """Method for creation of market data."""
         self.logger.info("Starting creation of markets")
-        for name, data in self.market_data.items():
-            market = Market(name=name, **data)
-            market.save()
+        markets = [Market(name=name, **data) for name, data in self.market_data.items()]
+        Market.objects.bulk_create(markets, batch_size=settings.MARKET_BULK_BATCH_SIZE)
 
     def calculate_pair_volume(self, name: str, values: dict,
                               fiat_symbol_rates: dict, currency_prices: dict):
@@ -118,7 +167,7 @@ class ExchangeUpdater:
 
     def get_local_fiat_prices(self):
         """Get markets which have a quote in fiat."""
-        quote_markets = Market.objects.filter(quote__in=settings.FIAT_SYMBOLS).values()
+        quote_markets = Market.objects.filter(quote__in=settings.FIAT_SYMBOLS, active=True).values()
         return self.create_map(quote_markets, "base", "last")
 
     def get_fiat_symbol_rates(self):
@@ -156,53 +205,95 @@ class ExchangeUpdater:
 
     @transaction.atomic
     def update_existing_markets(self):
-        """Update existing markets data."""
-        current_data = Market.objects.select_for_update().filter(exchange=self.exchange)
-        for market in current_data:
-            # Check if the name is in the market data - if yes update it
-            if market.name in self.market_data:
+        """Update existing markets data and create the new ones.
+        The markets are upserted in chunks of MARKET_BULK_BATCH_SIZE - only the markets of the
+        current chunk are loaded from the DB. Markets missing from the data are deactivated in the
+        same transaction."""
+        names = self.market_data.keys()
+        if self.changed is not None:
+            # Skip the markets which didn't change
+            names = [x for x in names if x in self.changed]
+        now = timezone.now()
+        written = False
+        # The written markets of the real-time update
+        streamed = {}
+        for chunk in chunked(names, settings.MARKET_BULK_BATCH_SIZE):
+            current_data = Market.objects.select_for_update().filter(exchange=self.exchange, name__in=chunk)
+            updated = []
+            fields = {"updated"}
+            for market in current_data:
                 msg = "Found match in market_data. {}".format(self.market_data[market.name])
                 self.logger.debug(msg)
                 for key, value in self.market_data[market.name].items():
                     if key != "exchange_id":
                         # Skip the exchange key as it must remain the same
                         setattr(market, key, value)
-                market.save()
-                # Delete the item form the list
-                del self.market_data[market.name]
-        # We have gone through the existing ones now we have to create the new
-        self.create_markets()
+                        fields.add(key)
+                if not market.active:
+                    # The market is listed again
+                    market.active = True
+                    fields.add("active")
+                # bulk_update doesn't handle auto_now fields
+                market.updated = now
+                updated.append(market)
+            if updated:
+                Market.objects.bulk_update(updated, fields)
+            existing = {x.name for x in updated}
+            new = [Market(name=x, **self.market_data[x]) for x in chunk if x not in existing]
+            if new:
+                Market.objects.bulk_create(new)
+            written = written or bool(updated or new)
+            if settings.MARKET_STREAM_ENABLED:
+                streamed.update((x.name, self.market_data[x.name]) for x in updated)
+                streamed.update((x.name, self.market_data[x.name]) for x in new)
+        written = self.deactivate_missing_markets() or written
+        if written:
+            # The cached market responses are invalidated only once the changes are visible
+            transaction.on_commit(partial(bump_market_versions, self.exchange.id))
+            transaction.on_commit(partial(write_market_snapshot, self.exchange.id))
+        if streamed:
+            transaction.on_commit(partial(publish_update, self.exchange.id,
+                                          build_update(self.exchange.id, streamed)))
+
+    def deactivate_missing_markets(self) -> int:
+        """Mark the markets of the exchange which are missing from the data as inactive.
+        Returns the number of deactivated markets."""
+        if not self.market_data:
+            return 0
+        missing = Market.objects.filter(exchange=self.exchange, active=True).exclude(
+            name__in=list(self.market_data.keys()))
+        # update() skips auto_now - the feed clients syncing with ?since= must get the deactivation
+        count = missing.update(active=False, updated=timezone.now())
+        if count:
+            self.logger.info(f"Deactivated {count} markets missing from the exchange data")
+        return count
 
     def run(self):
         """Main run method - create/update the market data passed in."""
         current_time = timezone.now().timestamp()
         self.logger.info("Starting update!")
-        # Fetch the old data by filtering on source id
-        self.logger.info("Fetching old data...")
-        current_data = Market.objects.filter(exchange=self.exchange).count()
         self.summarize_data()
         self.update_fiat_prices()
-        if not current_data:
-            self.create_markets()
-        else:
-            self.logger.info(f"We have to work on {current_data} entries. Starting update.")
-            self.update_existing_markets()
+        self.logger.info(f"We have to work on {len(self.market_data)} entries. Starting update.")
+        self.update_existing_markets()
         time_delta = timezone.now().timestamp() - current_time
         self.logger.info("Update finished in: {} seconds".format(time_delta))
         self.updateExchange()
+        if self.owns_context:
+            self.run_context.flush()
         return "Updater finished successfully"
 
     def summarize_data(self):
         """Create a summary of the market data we have for the exchange."""
         # Get the current prices
-        base_prices = self.get_base_prices()
+        base_prices = self._cached_prices("base_prices", self.get_base_prices)
         if base_prices and self.fiat_data:
             currency_prices = {**base_prices, **self.fiat_data}
         elif self.fiat_data:
             currency_prices = self.fiat_data
         else:
             currency_prices = base_prices
-        fiat_symbol_rates = self.get_fiat_symbol_rates()
+        fiat_symbol_rates = self._cached_prices("fiat_symbol_rates", self.get_fiat_symbol_rates)
         self.logger.debug(f"Base prices: {currency_prices}")
         if not currency_prices:
             self.logger.error("Can't summarize exchange data due to no currency fiat prices")
@@ -222,30 +313,29 @@ class ExchangeUpdater:
         self.exchange.volume = exchange_volume
         self.exchange.top_pair = top_pair
         self.exchange.top_pair_volume = top_pair_volume
-        self.exchange.save()
-        msg = "Exchange volume and top pairs saved successfully!"
+        msg = "Exchange volume and top pairs summarized successfully!"
         msg += f"Volume: {exchange_volume}, Top Pair: {top_pair}, Top Pair Volume: {top_pair_volume}"
         self.logger.info(msg)
 
     def update_fiat_prices(self):
+        """Update the fiat prices of the exchange currencies in bulk."""
         existing_qs = CurrencyFiatPrices.objects.filter(currency__in=list(self.fiat_data.keys()),
                                                         exchange=self.exchange)
         existing_map = {x.currency: x for x in existing_qs}
+        new = []
         for currency, price in self.fiat_data.items():
             if currency in existing_map:
                 existing_map[currency].price = price
-                existing_map[currency].save()
             else:
-                try:
-                    obj = CurrencyFiatPrices(currency=currency, exchange=self.exchange, price=price)
-                    obj.save()
-                except utils.IntegrityError:
-                    continue
+                new.append(CurrencyFiatPrices(currency=currency, exchange=self.exchange, price=price))
+        if existing_map:
+            CurrencyFiatPrices.objects.bulk_update(existing_map.values(), ["price"],
+                                                   batch_size=settings.MARKET_BULK_BATCH_SIZE)
+        if new:
+            # Currencies priced by another exchange already are skipped(the currency is unique)
+            CurrencyFiatPrices.objects.bulk_create(new, batch_size=settings.MARKET_BULK_BATCH_SIZE,
+                                                   ignore_conflicts=True)
 
-    @transaction.atomic
     def updateExchange(self):
-        """Patch the exchange last updated timestamp."""
-        self.logger.info("Updating exchange summary")
+        """Patch the exchange last updated timestamp(written with the run context)."""
         self.exchange.last_data_fetch = timezone.now()
-        self.exchange.save()
-        self.logger.info("Exchange summary update finished successfully!")
@@ -1,9 +1,11 @@
 import ccxt
 import logging
+from datetime import timedelta
 from django.utils import timezone
 from django.conf import settings
 
 from api.models import Exchange, ExchangeStatus, FiatMarketModel
+from marketmanager.runcontext import ExchangeRunContext
 
 logger = logging.getLogger("marketmanager")
 
@@ -31,33 +33,120 @@ def get_exchange_details(name):
     return {"api_url": api_url, "url": url, "logo": logo}
 
 
-def set_running_status(exchange: Exchange, running: bool):
-    """Set the exchange status running status.
-    This function assumes the ExchangeStatus exists, otherwise it will raise the DoesNotExist exception.
+def chunked(iterable, size: int):
+    """Yield lists of up to size items from the iterable."""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def get_exchange_priority(exchange: Exchange) -> str:
+    """Get the fetch priority tier of the exchange.
+    A manually set tier takes precedence, otherwise the tier is derived from the exchange volume.
     """
-    logger.info(f"Updating ExchangeStatus for {exchange.id}")
-    try:
-        status = ExchangeStatus.objects.get(exchange=exchange)
-    except ExchangeStatus.DoesNotExist:
-        status = ExchangeStatus(exchange=exchange)
-        status.save()
-    status.running = running
-    status.time_started = timezone.now()
-    status.save()
+    if exchange.priority_tier:
+        return exchange.priority_tier
+    if exchange.volume is None:
+        return settings.EXCHANGE_DEFAULT_PRIORITY_TIER
+    for tier, min_volume in settings.EXCHANGE_PRIORITY_TIERS:
+        if exchange.volume >= min_volume:
+            return tier
+    return settings.EXCHANGE_PRIORITY_TIERS[-1][0]
+
+
+def get_exchange_queue(exchange: Exchange) -> str:
+    """Get the celery queue name for the exchange fetch tasks."""
+    return "exchanges.{}".format(get_exchange_priority(exchange))
+
+
+def sort_by_priority(exchanges):
+    """Sort the exchanges by priority tier and then by volume - highest first."""
+    ranks = {tier: rank for rank, (tier, _) in enumerate(settings.EXCHANGE_PRIORITY_TIERS)}
+    return sorted(exchanges, key=lambda x: (ranks[get_exchange_priority(x)], -(x.volume or 0)))
+
+
+def pack_exchange_batches(exchanges: list, pairs: dict) -> list:
+    """Bin-pack the exchanges into batches by their pair count(first fit decreasing).
+    A batch holds up to EXCHANGE_BATCH_CAPACITY pairs and EXCHANGE_BATCH_MAX_SIZE exchanges.
+    """
+    batches = []
+    for exchange in sorted(exchanges, key=lambda x: pairs[x.id], reverse=True):
+        for batch in batches:
+            if len(batch["exchanges"]) >= settings.EXCHANGE_BATCH_MAX_SIZE:
+                continue
+            if batch["pairs"] + pairs[exchange.id] <= settings.EXCHANGE_BATCH_CAPACITY:
+                batch["exchanges"].append(exchange)
+                batch["pairs"] += pairs[exchange.id]
+                break
+        else:
+            batches.append({"exchanges": [exchange], "pairs": pairs[exchange.id]})
+    return [x["exchanges"] for x in batches]
+
+
+def set_running_status(run: ExchangeRunContext, running: bool):
+    """Set the running status of the exchange run and write it right away."""
+    logger.info(f"Updating ExchangeStatus for {run.exchange.id}")
+    run.status.running = running
+    run.status.time_started = timezone.now()
+    run.flush()
+
+
+def update_circuit(status: ExchangeStatus, success: bool):
+    """Feed a run outcome to the exchange circuit breaker(doesn't save the status).
+    The circuit opens after CIRCUIT_BREAKER_FAILURES consecutive failures and the backoff doubles
+    with each further failure. A failed half-open probe opens the circuit again.
+    """
+    if success:
+        status.consecutive_failures = 0
+        status.circuit_state = "closed"
+        status.retry_after = None
+        return
+    status.consecutive_failures += 1
+    threshold = settings.CIRCUIT_BREAKER_FAILURES
+    if status.circuit_state != "half-open" and status.consecutive_failures < threshold:
+        return
+    exponent = max(status.consecutive_failures - threshold, 0)
+    backoff = min(settings.CIRCUIT_BREAKER_BACKOFF * 2 ** exponent, settings.CIRCUIT_BREAKER_MAX_BACKOFF)
+    status.circuit_state = "open"
+    status.retry_after = timezone.now() + timedelta(seconds=backoff)
+    logger.warning(f"Circuit opened for exchange {status.exchange_id} for {backoff} seconds")
+
+
+def finish_run(run: ExchangeRunContext, success: bool, message: str = None, pairs: int = None):
+    """Mark the exchange run as finished and feed its outcome to the circuit breaker.
+    All changes of the run are written here."""
+    logger.info(f"Finishing run for {run.exchange.id}. Success: {success}")
+    status = run.status
+    update_circuit(status, success)
+    if pairs is not None:
+        status.last_run_pairs = pairs
+    status.running = False
+    status.last_run = timezone.now()
+    status.last_run_status = message
+    run.flush()
 
 
 def prepare_fiat_data(data, limit_to_exchange=False):
     """Prepare the market pairs for fiat insertion.
     We must map out all quotes and bases so they have a corresponding value in fiat prior to insertion.
-    If limit_to_exchange is True then filter fiat rates only from current exchange if any
+    If limit_to_exchange is True then filter fiat rates only from current exchange if any.
+    The data is scanned once - the pairs which can't be resolved during the scan are kept aside and
+    resolved after the missing quote prices are fetched from InfluxDB.
     """
     tags_for_fetch = []
     initial_quote_map = {}
-    base_map = {}
-    for symbol, values in data.items():
+    unresolved = []
+    exchange_id = None
+    for values in data.values():
         base = values["base"]
         quote = values["quote"]
         last = values["last"]
+        exchange_id = values["exchange_id"]
         if last == 0:
             continue
         if base not in initial_quote_map and quote in settings.FIAT_SYMBOLS:
@@ -67,24 +156,25 @@ def prepare_fiat_data(data, limit_to_exchange=False):
         else:
             if quote not in tags_for_fetch and quote not in settings.FIAT_SYMBOLS:
                 tags_for_fetch.append(quote)
-            if base not in base_map:
-                base_map[base] = data[symbol]
+            unresolved.append((base, quote, last))
+    # Quotes resolved later in the scan don't have to be fetched
+    tags_for_fetch = [x for x in tags_for_fetch if x not in initial_quote_map]
     if tags_for_fetch:
         tags = {"currency": tags_for_fetch}
         if limit_to_exchange:
-            tags = {"exchange_id": data[symbol]["exchange_id"]}
+            tags = {"exchange_id": exchange_id}
         results = FiatMarketModel(data=tags).filter("10m")
         quote_map = {x["currency"]: x["price"] for x in results}
     else:
         quote_map = {}
     quote_map = {**quote_map, **initial_quote_map}
-    for symbol, values in data.items():
-        if values["base"] in quote_map:
+    for base, quote, last in unresolved:
+        if base in quote_map:
             continue
-        if values["quote"] in settings.FIAT_SYMBOLS and values["last"] > 0:
-            quote_map[base] = values["last"]
-        elif values["quote"] not in quote_map:
-            logger.warning(f"Couldn't find quote {values['quote']} for base {base}")
+        if quote in settings.FIAT_SYMBOLS:
+            quote_map[base] = last
+        elif quote not in quote_map:
+            logger.warning(f"Couldn't find quote {quote} for base {base}")
         else:
-            quote_map[base] = quote_map[values["quote"]] * values["last"]
+            quote_map[base] = quote_map[quote] * last
     return quote_map